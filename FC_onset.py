@@ -0,0 +1,113 @@
+"""
+Dedalus script for the linear onset of fully compressible convection.
+
+Solves the linearized FC equations for the growth rates of a batch of horizontal
+wavenumbers, kx = (2*pi/(aspect*Lz))*(1, 2, ..., n_kx), which are distributed
+across processes.  If --critical is flagged, instead finds the critical Rayleigh
+number of each wavenumber, splitting the wavenumbers across processes.
+
+Usage:
+    FC_onset.py [options]
+
+Options:
+    --atmosphere=<atmo>        Atmosphere: polytrope or linear [default: polytrope]
+    --equations=<eqns>         Equation set: 2D, 3D, or MHD [default: 2D]
+    --Rayleigh=<Rayleigh>      Rayleigh number [default: 1e3]
+    --Prandtl=<Prandtl>        Prandtl number = nu/kappa [default: 1]
+    --MagneticPrandtl=<Pm>     Magnetic Prandtl number (MHD only) [default: 1]
+    --Taylor=<Taylor>          If specified, Taylor number
+    --epsilon=<eps>            Superadiabatic excess (polytrope only) [default: 1e-4]
+    --n_rho=<n_rho>            Number of density scale heights (polytrope only) [default: 3]
+    --gamma=<gamma>            Adiabatic index (polytrope only) [default: 5/3]
+    --aspect=<aspect>          Aspect ratio that sets the wavenumber spacing [default: 4]
+    --n_kx=<n>                 Number of horizontal wavenumbers [default: 16]
+    --nz=<nz>                  Vertical resolution [default: 64]
+
+    --FT                       If flagged, use FT boundary conditions (default is TT)
+    --FF                       If flagged, use FF boundary conditions (default is TT)
+    --SS                       If flagged, use SS boundary conditions (default is TT)
+
+    --NS                       If flagged, use no-slip BCs (default is stress-free, SF)
+
+    --critical                 If flagged, find the critical Rayleigh number of each wavenumber
+    --Ra_min=<Ra>              Lower bracket of the critical Rayleigh number [default: 1e1]
+    --Ra_max=<Ra>              Upper bracket of the critical Rayleigh number [default: 1e6]
+    --n_modes=<n>              Number of eigenvalues found near the target at each wavenumber [default: 10]
+    --target=<sigma>           Target eigenvalue of the shift-invert eigensolves [default: 0]
+"""
+import logging
+from fractions import Fraction
+
+import numpy as np
+from docopt import docopt
+
+from logic.fc_equations      import FCEquations2D, FCEquations3D, FCMHDEquations
+from logic.polytrope         import Polytrope
+from logic.linear_atmosphere import LinearAtmosphere
+from logic.onset             import OnsetEVP
+
+logger = logging.getLogger(__name__)
+args = docopt(__doc__)
+
+### 1. Atmosphere, equations, and BCs
+if args['--atmosphere'] == 'polytrope':
+    atmo_class  = Polytrope
+    atmo_args   = (float(args['--n_rho']), float(args['--epsilon']))
+    atmo_kwargs = {'gamma' : float(Fraction(args['--gamma']))}
+    Lz = Polytrope(*atmo_args, **atmo_kwargs).Lz
+elif args['--atmosphere'] == 'linear':
+    atmo_class, atmo_args, atmo_kwargs = LinearAtmosphere, (), {}
+    Lz = LinearAtmosphere.Lz
+else:
+    raise ValueError("Unknown atmosphere {}".format(args['--atmosphere']))
+
+parameters = {'Pr' : float(args['--Prandtl'])}
+if args['--Taylor'] is not None:
+    parameters['Ta'] = float(args['--Taylor'])
+if args['--equations'] == '2D':
+    equations = FCEquations2D()
+elif args['--equations'] == '3D':
+    equations = FCEquations3D()
+elif args['--equations'] == 'MHD':
+    equations = FCMHDEquations()
+    parameters['Pm'] = float(args['--MagneticPrandtl'])
+else:
+    raise ValueError("Unknown equation set {}".format(args['--equations']))
+
+bcs = ['temp_L', 'temp_R', 'stressfree', 'impenetrable']
+if args['--FT']:
+    bcs.remove('temp_L')
+    bcs.append('flux_L')
+elif args['--FF']:
+    bcs.remove('temp_L')
+    bcs.remove('temp_R')
+    bcs.append('flux_L')
+    bcs.append('flux_R')
+elif args['--SS']:
+    bcs.remove('temp_L')
+    bcs.remove('temp_R')
+    bcs.append('entropy_L')
+    bcs.append('entropy_R')
+
+if args['--NS']:
+    bcs.remove('stressfree')
+    bcs.append('noslip')
+
+if args['--equations'] == 'MHD':
+    bcs.append('noHorizB')
+
+### 2. Solve
+dk = 2*np.pi/(float(args['--aspect'])*Lz)
+kx = dk*np.arange(1, int(args['--n_kx'])+1)
+evp = OnsetEVP(equations, atmo_class, atmo_args, atmo_kwargs, bcs, int(args['--nz']), kx, **parameters)
+
+n_modes = int(args['--n_modes'])
+target  = complex(args['--target'])
+if args['--critical']:
+    kx, Ra_crit = evp.critical_Ra(float(args['--Ra_min']), float(args['--Ra_max']), n_modes=n_modes, target=target)
+    for k, Ra in zip(kx, Ra_crit):
+        logger.info('kx = {:.5e}, Ra_crit = {:.5e}'.format(k, Ra))
+else:
+    kx, growth, frequency = evp.growth_rates(float(args['--Rayleigh']), n_modes=n_modes, target=target)
+    for k, sigma_r, sigma_i in zip(kx, growth, frequency):
+        logger.info('kx = {:.5e}, growth = {:.5e}, frequency = {:.5e}'.format(k, sigma_r, sigma_i))
@@ -0,0 +1,56 @@
+"""
+Dedalus script for the TT-to-FT structure BVPs of a sweep of polytropic TT runs.
+
+Averages the TT profiles and scalars of each run (e.g., the runs of a Ra sweep,
+in sweep order) and solves its TT-to-FT structure BVP, spreading the runs
+across processes so that neighboring runs warm-start each other's solves.
+The FT structure and rescaling factors of each run, which the FT runs get
+from --tt_to_ft_dir in Polytrope_2D_FC_convection.py, are logged and saved.
+
+Usage:
+    FC_tt_to_ft_sweep.py [options] <tt_dirs>...
+
+Options:
+    --epsilon=<eps>            Superadiabatic excess of the TT runs [default: 1e-4]
+    --n_rho=<n_rho>            Number of density scale heights of the TT runs [default: 3]
+    --gamma=<gamma>            Adiabatic index of the TT runs [default: 5/3]
+    --tt_to_ft_time=<t>        Averaging window, in t_buoy, to measure TT data over [default: 100]
+    --out=<file>               HDF5 file to save the results to [default: tt_to_ft_sweep.h5]
+"""
+import logging
+from fractions import Fraction
+
+import h5py
+import numpy as np
+from docopt import docopt
+from mpi4py import MPI
+
+from logic.polytrope import Polytrope
+from logic.tt_to_ft  import structure_bvp_sweep
+
+logger = logging.getLogger(__name__)
+args = docopt(__doc__)
+
+epsilon     = float(args['--epsilon'])
+atmo_args   = (float(args['--n_rho']), epsilon)
+atmo_kwargs = {'gamma' : float(Fraction(args['--gamma']))}
+atmosphere  = Polytrope(*atmo_args, **atmo_kwargs)
+
+approx_t_buoy = np.sqrt(atmosphere.Lz/epsilon)
+paths   = args['<tt_dirs>']
+results = structure_bvp_sweep(atmosphere, atmo_args, atmo_kwargs, paths, float(args['--tt_to_ft_time'])*approx_t_buoy)
+
+if MPI.COMM_WORLD.rank == 0:
+    with h5py.File(args['--out'], 'w') as f:
+        for i, (path, result) in enumerate(zip(paths, results)):
+            checkpoint_TT, T1_FT, ln_rho1_FT, dS_factor, dT_ad_factor, FT_Ra_factor = result
+            logger.info('{}: dS factor {:.5e}, dT_ad factor {:.5e}, FT Ra factor {:.5e}'.format(path, dS_factor, dT_ad_factor, FT_Ra_factor))
+            run = f.create_group('run_{:d}'.format(i))
+            run.attrs['tt_dir']        = path
+            run.attrs['checkpoint_TT'] = str(checkpoint_TT)
+            run.attrs['dS_factor']     = dS_factor
+            run.attrs['dT_ad_factor']  = dT_ad_factor
+            run.attrs['FT_Ra_factor']  = FT_Ra_factor
+            run['T1_FT']      = T1_FT
+            run['ln_rho1_FT'] = ln_rho1_FT
+    logger.info('saved TT-to-FT structures of {} runs to {}'.format(len(paths), args['--out']))
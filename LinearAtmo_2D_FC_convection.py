@@ -18,10 +18,14 @@ Options:
     --run_time_buoy=<time>     Run time, in buoyancy times
     --run_time_diff=<time_>    Run time, in diffusion times [default: 1]
 
-    --restart=<file>           Restart from checkpoint file
+    --restart=<file>           Restart from checkpoint file, an unmerged checkpoint set folder, or 'latest' for the newest consistent checkpoint level
     --overwrite                If flagged, force file mode to overwrite
     --seed=<seed>              RNG seed for initial conditoins [default: 42]
 
+    --FT                       If flagged, use FT boundary conditions (default is TT)
+    --tt_to_ft_dir=<dir>       Path to output directory of TT run to restart from
+    --tt_to_ft_time=<t>        Averaging window, in t_buoy, to measure TT data over [default: 100]
+
     --label=<label>            Optional additional case name label
     --root_dir=<dir>           Root directory for output [default: ./]
     --safety=<s>               CFL safety factor [default: 0.4]
@@ -40,23 +44,31 @@ from dedalus import public as de
 from dedalus.extras import flow_tools
 from dedalus.tools  import post
 
-from logic.output        import initialize_output
-from logic.checkpointing import Checkpoint
+from logic.output        import OUTPUT_OPTIONS, output_from_args, trigger_from_args
+from logic.checkpointing import Checkpoint, CHECKPOINT_OPTIONS, checkpoint_from_args, set_checkpoint_from_args
+from logic.archive       import consolidate_analysis
+from logic.virtual_merge import merge_virtual
+from logic.handlers      import flush_handlers
+from logic.staging       import finish_staging
 from logic.fc_equations  import FCEquations2D
 from logic.linear_atmosphere import LinearAtmosphere
+from logic.tt_to_ft      import tt_to_ft, tt_to_ft_preliminaries
+from logic.accelerated_evolution import AE_OPTIONS, ae_from_args
 
 logger = logging.getLogger(__name__)
-args = docopt(__doc__)
+args = docopt(__doc__ + OUTPUT_OPTIONS + CHECKPOINT_OPTIONS + AE_OPTIONS)
 
 ### 1. Read in command-line args, set up data directory
 data_dir = args['--root_dir'] + '/' + sys.argv[0].split('.py')[0]
 
 
 data_dir += "_Ra{}_Pr{}_a{}".format(args['--Rayleigh'], args['--Prandtl'], args['--aspect'])
+if args['--FT']:
+    data_dir += '_FT'
 if args['--label'] is not None:
     data_dir += "_{}".format(args['--label'])
 data_dir += '/'
-if MPI.COMM_WORLD.rank == 0:
+if MPI.COMM_WORLD.rank == 0 and args['--tt_to_ft_dir'] is None:
     if not os.path.exists('{:s}/'.format(data_dir)):
         os.makedirs('{:s}/'.format(data_dir))
     logdir = os.path.join(data_dir,'logs')
@@ -101,6 +113,23 @@ atmosphere = LinearAtmosphere(domain, problem)
 Ra = float(args['--Rayleigh'])
 Pr = float(args['--Prandtl'])
 t_buoy, t_diff = atmosphere.set_parameters(Ra=Ra, Pr=Pr, aspect=aspect)
+if args['--tt_to_ft_dir'] is not None and args['--FT']:
+    # The buoyancy time of the linear atmosphere doesn't depend on Ra
+    tt_to_ft_args = tt_to_ft_preliminaries(atmosphere, (), {}, args['--tt_to_ft_dir'], float(args['--tt_to_ft_time'])*t_buoy)
+    ra_factor = tt_to_ft_args[-1]
+    Ra *= ra_factor
+    t_buoy, t_diff = atmosphere.set_parameters(Ra=Ra, Pr=Pr, aspect=aspect)
+
+    logger.info('updated Ra to {:.2e}'.format(Ra))
+    ra_str_split = data_dir.split('Ra')
+    data_dir = '{:s}Ra{:.2e}{:s}'.format(ra_str_split[0], Ra, data_dir.split(args['--Rayleigh'])[-1])
+    if MPI.COMM_WORLD.rank == 0:
+        if not os.path.exists('{:s}/'.format(data_dir)):
+            os.makedirs('{:s}/'.format(data_dir))
+        logdir = os.path.join(data_dir,'logs')
+        if not os.path.exists(logdir):
+            os.mkdir(logdir)
+    logger.info("saving run in: {}".format(data_dir))
 
 
 ### 4.Setup equations and Boundary Conditions
@@ -110,6 +139,9 @@ for k, eqn in equations.equations.items():
     problem.add_equation(eqn)
 
 bcs = ['temp', 'stressfree', 'impenetrable']
+if args['--FT']:
+    bcs.remove('temp')
+    bcs += ['temp_R', 'flux_L']
 for k, bc in equations.BCs.items():
     for bc_type in bcs:
         if bc_type in k:
@@ -117,7 +149,7 @@ for k, bc in equations.BCs.items():
             problem.add_bc(bc[0], condition=bc[1])
 
 ### 5. Build solver
-# Note: SBDF2 timestepper does not currently work with AE.
+# Multistep timesteppers (e.g., SBDF2) don't work with AE, which rejects them.
 #ts = de.timesteppers.SBDF2
 if args['--RK443']:
     ts = de.timesteppers.RK443
@@ -128,11 +160,15 @@ solver = problem.build_solver(ts)
 logger.info('Solver built')
 
 ### 6. Set initial conditions: noise or loaded checkpoint
-checkpoint = Checkpoint(data_dir)
+checkpoint = checkpoint_from_args(args, data_dir)
 checkpoint_dt = 100
 restart = args['--restart']
 not_corrected_times = True
-if restart is None:
+if args['--tt_to_ft_dir'] is not None and args['--FT']:
+    logger.info("Starting FT run from TT state: {:s}".format(args['--tt_to_ft_dir']))
+    solver, dt = tt_to_ft(solver, checkpoint, atmosphere, *tt_to_ft_args[:-1])
+    mode = 'overwrite'
+elif restart is None:
     x_de = domain.grid(0, scales=domain.dealias)
     y_de = domain.grid(1, scales=domain.dealias)
     z_de = domain.grid(-1, scales=domain.dealias)
@@ -157,7 +193,7 @@ else:
     dt = checkpoint.restart(restart, solver)
     mode = 'append'
     not_corrected_times = False
-checkpoint.set_checkpoint(solver, sim_dt=checkpoint_dt, mode=mode)
+set_checkpoint_from_args(args, checkpoint, solver, mode, sim_dt=checkpoint_dt)
    
 
 ### 7. Set simulation stop parameters, output, and CFL
@@ -169,13 +205,17 @@ solver.stop_wall_time = run_time_wall*3600.
 #TODO: Check max_dt, cfl, etc.
 max_dt    = np.min((1e-1, t_diff, t_buoy))
 if dt is None: dt = max_dt
-analysis_tasks = initialize_output(solver, domain, data_dir, mode=mode, magnetic=False, threeD=False)
+analysis_tasks, scheduler = output_from_args(args, solver, domain, data_dir, checkpoint, mode, t_buoy, magnetic=False,
+                                             threeD=False)
 
 # CFL
 CFL = flow_tools.CFL(solver, initial_dt=dt, cadence=1, safety=cfl_safety,
                      max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1)
 CFL.add_velocities(('u', 'w'))
 
+# Accelerated evolution
+ae = ae_from_args(args, solver, LinearAtmosphere, (), {}, t_buoy, bc_type='FT' if args['--FT'] else 'TT')
+
 
 ### 8. Setup flow tracking for terminal output, including rolling averages
 #TODO: define these properly, probably only need Nu, KE, log string
@@ -183,6 +223,8 @@ flow = flow_tools.GlobalFlowProperty(solver, cadence=1)
 flow.add_property("Re_rms", name='Re')
 flow.add_property("KE", name='KE')
 
+trigger_from_args(args, scheduler, flow, t_buoy)
+
 Hermitian_cadence = 100
 first_step = True
 # Main loop
@@ -197,7 +239,12 @@ try:
         if first_step: first_step = False
 
         dt = CFL.compute_dt()
+        if scheduler is not None:
+            scheduler.evaluate(dt)
         solver.step(dt) #, trim=True)
+        if ae is not None and ae.update():
+            # Velocities were rescaled; restart the CFL from a rescaled step
+            CFL.stored_dt = dt/ae.velocity_factor
 
         # Solve for blow-up over long timescales in 3D due to hermitian-ness
         effective_iter = solver.iteration - start_iter
@@ -229,17 +276,31 @@ finally:
         final_checkpoint = Checkpoint(data_dir, checkpoint_name='final_checkpoint')
         final_checkpoint.set_checkpoint(solver, wall_dt=1, mode=mode)
         solver.step(dt) #clean this up in the future...works for now.
-        post.merge_process_files(data_dir+'/final_checkpoint/', cleanup=False)
+        if args['--merge_virtual']:
+            merge_virtual(data_dir+'/final_checkpoint/')
+        else:
+            post.merge_process_files(data_dir+'/final_checkpoint/', cleanup=False)
     except:
         raise
         print('cannot save final checkpoint')
     finally:
+        flush_handlers(analysis_tasks.values())
+        finish_staging(list(analysis_tasks.values()) + [checkpoint.checkpoint], comm=domain.dist.comm_cart)
         logger.info('beginning join operation')
-        post.merge_analysis(data_dir+'checkpoint')
+        if args['--merge_virtual']:
+            merge_virtual(data_dir+'checkpoint')
+        else:
+            post.merge_analysis(data_dir+'checkpoint')
 
         for key, task in analysis_tasks.items():
+            if key in ['probes', 'modes', 'frames']: continue # already gathered
             logger.info(task.base_path)
-            post.merge_analysis(task.base_path)
+            if args['--merge_virtual'] and key == 'volumes':
+                merge_virtual(task.base_path)
+            else:
+                post.merge_analysis(task.base_path)
+        if args['--consolidate']:
+            consolidate_analysis(analysis_tasks)
 
         logger.info(40*"=")
         logger.info('Iterations: {:d}'.format(n_iter_loop))
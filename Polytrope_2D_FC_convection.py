@@ -27,7 +27,7 @@ Options:
     --run_time_buoy=<time>     Run time, in buoyancy times [default: 500]
     --run_time_diff=<time_>    Run time, in diffusion times
 
-    --restart=<file>           Restart from checkpoint file
+    --restart=<file>           Restart from checkpoint file, an unmerged checkpoint set folder, or 'latest' for the newest consistent checkpoint level
     --overwrite                If flagged, force file mode to overwrite
     --seed=<seed>              RNG seed for initial conditoins [default: 42]
 
@@ -47,22 +47,29 @@ import time
 from fractions import Fraction
 
 import numpy as np
-from docopt import docopt
+from docopt import docopt, DocoptExit
 from mpi4py import MPI
 
 from dedalus import public as de
 from dedalus.extras import flow_tools
 from dedalus.tools  import post
 
-from logic.output        import initialize_output
-from logic.checkpointing import Checkpoint
+from logic.output        import OUTPUT_OPTIONS, output_from_args, trigger_from_args
+from logic.checkpointing import Checkpoint, CHECKPOINT_OPTIONS, checkpoint_from_args, set_checkpoint_from_args
+from logic.archive       import consolidate_analysis
+from logic.virtual_merge import merge_virtual
+from logic.handlers      import flush_handlers
+from logic.staging       import finish_staging
 from logic.fc_equations  import FCEquations2D
 from logic.polytrope     import Polytrope
 from logic.functions     import global_noise
 from logic.tt_to_ft      import tt_to_ft, tt_to_ft_preliminaries
+from logic.accelerated_evolution import AE_OPTIONS, ae_from_args
 
 logger = logging.getLogger(__name__)
-args = docopt(__doc__)
+args = docopt(__doc__ + OUTPUT_OPTIONS + CHECKPOINT_OPTIONS + AE_OPTIONS)
+if args['--AE'] and args['--SS']:
+    raise DocoptExit('AE is not implemented for SS boundary conditions')
 
 ### 1. Read in command-line args, set up data directory
 data_dir = args['--root_dir'] + '/' + sys.argv[0].split('.py')[0]
@@ -192,7 +199,7 @@ for k, bc in equations.BCs.items():
             problem.add_bc(bc[0], condition=bc[1])
 
 ### 5. Build solver
-# Note: SBDF2 timestepper does not currently work with AE.
+# Multistep timesteppers (e.g., SBDF2) don't work with AE, which rejects them.
 #ts = de.timesteppers.SBDF2
 if args['--RK222']:
     ts = de.timesteppers.RK222
@@ -203,7 +210,7 @@ solver = problem.build_solver(ts)
 logger.info('Solver built')
 
 ### 6. Set initial conditions: noise or loaded checkpoint
-checkpoint = Checkpoint(data_dir)
+checkpoint = checkpoint_from_args(args, data_dir)
 checkpoint_dt = 25*t_buoy
 restart = args['--restart']
 not_corrected_times = True
@@ -231,7 +238,7 @@ else:
     dt = checkpoint.restart(restart, solver)
     mode = 'append'
     not_corrected_times = False
-checkpoint.set_checkpoint(solver, sim_dt=checkpoint_dt, mode=mode)
+set_checkpoint_from_args(args, checkpoint, solver, mode, sim_dt=checkpoint_dt)
    
 
 ### 7. Set simulation stop parameters, output, and CFL
@@ -243,14 +250,20 @@ solver.stop_wall_time = run_time_wall*3600.
 #TODO: Check max_dt, cfl, etc.
 max_dt    = 0.2*t_buoy
 if dt is None: dt = max_dt
-analysis_tasks = initialize_output(solver, domain, data_dir, mode=mode, magnetic=False, threeD=False,
-                                    output_dt = 0.2*t_buoy)
+analysis_tasks, scheduler = output_from_args(args, solver, domain, data_dir, checkpoint, mode, t_buoy, magnetic=False,
+                                             threeD=False, output_dt=0.2*t_buoy)
 
 # CFL
 CFL = flow_tools.CFL(solver, initial_dt=dt, cadence=1, safety=cfl_safety,
                      max_change=1.5, min_change=0.5, max_dt=max_dt, threshold=0.1)
 CFL.add_velocities(('u', 'w'))
 
+# Accelerated evolution
+if args['--FF']:   bc_type = 'FF'
+elif args['--FT']: bc_type = 'FT'
+else:              bc_type = 'TT'
+ae = ae_from_args(args, solver, Polytrope, atmo_args, atmo_kwargs, t_buoy, bc_type=bc_type)
+
 
 ### 8. Setup flow tracking for terminal output, including rolling averages
 #TODO: define these properly, probably only need Nu, KE, log string
@@ -260,6 +273,8 @@ flow.add_property("Nu", name='Nu')
 flow.add_property("Ma_rms", name='Ma')
 flow.add_property("KE", name='KE')
 
+trigger_from_args(args, scheduler, flow, t_buoy)
+
 Hermitian_cadence = 100
 first_step = True
 # Main loop
@@ -274,7 +289,12 @@ try:
         if first_step: first_step = False
 
         dt = CFL.compute_dt()
+        if scheduler is not None:
+            scheduler.evaluate(dt)
         solver.step(dt) #, trim=True)
+        if ae is not None and ae.update():
+            # Velocities were rescaled; restart the CFL from a rescaled step
+            CFL.stored_dt = dt/ae.velocity_factor
 
         # Solve for blow-up over long timescales in 3D due to hermitian-ness
         effective_iter = solver.iteration - start_iter
@@ -308,17 +328,31 @@ finally:
         final_checkpoint = Checkpoint(data_dir, checkpoint_name='final_checkpoint')
         final_checkpoint.set_checkpoint(solver, wall_dt=1, mode=mode)
         solver.step(dt) #clean this up in the future...works for now.
-        post.merge_process_files(data_dir+'/final_checkpoint/', cleanup=False)
+        if args['--merge_virtual']:
+            merge_virtual(data_dir+'/final_checkpoint/')
+        else:
+            post.merge_process_files(data_dir+'/final_checkpoint/', cleanup=False)
     except:
         raise
         print('cannot save final checkpoint')
     finally:
+        flush_handlers(analysis_tasks.values())
+        finish_staging(list(analysis_tasks.values()) + [checkpoint.checkpoint], comm=domain.dist.comm_cart)
         logger.info('beginning join operation')
-        post.merge_analysis(data_dir+'checkpoint')
+        if args['--merge_virtual']:
+            merge_virtual(data_dir+'checkpoint')
+        else:
+            post.merge_analysis(data_dir+'checkpoint')
 
         for key, task in analysis_tasks.items():
+            if key in ['probes', 'modes', 'frames']: continue # already gathered
             logger.info(task.base_path)
-            post.merge_analysis(task.base_path)
+            if args['--merge_virtual'] and key == 'volumes':
+                merge_virtual(task.base_path)
+            else:
+                post.merge_analysis(task.base_path)
+        if args['--consolidate']:
+            consolidate_analysis(analysis_tasks)
 
         logger.info(40*"=")
         logger.info('Iterations: {:d}'.format(n_iter_loop))
@@ -0,0 +1,315 @@
+import logging
+from collections import OrderedDict
+
+import numpy as np
+import dedalus.public as de
+
+from logic.tt_to_ft import bvp_atmosphere, reset_mean_state
+from logic.ae_tools import add_profile_sample, mean_profiles, superadiabatic_jump, velocity_factor, state_change
+
+logger = logging.getLogger(__name__)
+
+# Accelerated evolution options shared by the drivers; append to a driver's docopt string.
+AE_OPTIONS = """
+    --AE                       If flagged, use accelerated evolution (AE) to reach thermal equilibrium faster
+    --AE_wait=<t>              Time, in t_buoy, to let convection adjust before each AE average [default: 10]
+    --AE_window=<t>            Averaging window, in t_buoy, of each AE BVP solve [default: 20]
+    --AE_convergence=<f>       AE ends once a BVP solve changes the state by less than this [default: 0.01]
+"""
+
+class AcceleratedEvolution():
+    """
+    Accelerated evolution (AE) of a convective simulation towards thermal equilibrium.
+
+    Convection equilibrates over a few buoyancy times, but the mean thermodynamic
+    state only relaxes over thermal diffusion times.  In AE mode, horizontally-averaged
+    profiles are periodically averaged in-situ over a window of the convective
+    evolution, and a 1D BVP is solved for the mean state in which conduction and
+    the (rescaled) convective flux carry a constant total flux.  The mean T1 and
+    ln_rho1 are then reset to that state, and the fluctuations are rescaled.
+
+    The convective flux is assumed to follow free-fall scaling with the
+    superadiabatic temperature jump across the domain, dT_sad: velocities scale
+    by a factor a = sqrt(dT_sad/dT_sad_evolved), T1 fluctuations by a**2, and the
+    convective flux by a**3.  The BVP is
+
+        K*dz(T1) = -K*T0_z - F_tot + a**3*F_conv
+        (T0 + T1)*dz(ln_rho1) = -dz(T1) - T1*ln_rho0_z + a**2*UdotGradw
+        dz(M1) = rho0*(exp(ln_rho1) - 1)
+
+    for constant F_tot and a, with M1 = 0 at both boundaries, the closure
+    a**2*dT_sad_evolved = dT_sad, and thermal boundary conditions matching the
+    simulation's (TT, FT, or FF).
+
+    Attributes:
+    -----------
+    solver : Dedalus IVP solver
+        The solver of the simulation being evolved
+    handler : Dedalus DictionaryHandler
+        Evaluates the averaged profiles in-situ
+    bc_type : string
+        Thermal boundary conditions of the simulation ('TT', 'FT', or 'FF')
+    wait_time, window_time : floats
+        Sim time to wait after the start (or a reset) before averaging, and to average over
+    convergence : float
+        AE ends once a solve changes the state by less than this: both |a - 1| and
+        the largest change of the mean T1, relative to dT_sad, must fall below it
+    max_solves : int
+        AE ends after this many BVP solves
+    done : bool
+        Whether AE has ended
+    n_solves : int
+        Number of BVP solves so far
+    velocity_factor : float
+        The velocity factor, a, of the most recent solve
+    """
+
+    def __init__(self, solver, atmo_class, atmo_args, atmo_kwargs, bc_type='TT', wait_time=10, window_time=20,
+                 convergence=0.01, max_solves=10, cadence=10, magnetic=False, tol=1e-10, max_iter=50):
+        """
+        Initialize AE mode and add its in-situ averaging tasks to the solver.
+
+        Parameters
+        ----------
+        solver : Dedalus IVP solver
+            The solver of the simulation being evolved, with a Runge-Kutta (single step) timestepper
+        atmo_class : The class type of the atmosphere object (Polytrope or LinearAtmosphere)
+        atmo_args : tuple
+            args for atmo_class.__init__()
+        atmo_kwargs : dict
+            kwargs for atmo_class.__init__()
+        bc_type : string, optional
+            Thermal boundary conditions of the simulation ('TT', 'FT', or 'FF')
+        wait_time : float, optional
+            Sim time to let convection adjust after the start (or a reset) before averaging
+        window_time : float, optional
+            Sim time to average profiles over before each BVP solve
+        convergence : float, optional
+            AE ends once a solve changes the velocities and the mean T1 (relative to dT_sad) by less than this
+        max_solves : int, optional
+            AE ends after this many BVP solves
+        cadence : int, optional
+            Iterations between in-situ samples of the profiles
+        magnetic : bool, optional
+            If True, the magnetic energy fluxes (ohm_flux_z and poynt_flux_z) are included in the convective flux
+        tol, max_iter : optional
+            Newton iteration tolerance and maximum number of iterations of the BVP
+        """
+        if bc_type not in ['TT', 'FT', 'FF']:
+            raise ValueError("AE is not implemented for {} boundary conditions".format(bc_type))
+        if isinstance(solver.timestepper, de.timesteppers.MultistepIMEX):
+            # The step history of multistep schemes would not match the reset state
+            raise ValueError("AE is not implemented for multistep timesteppers (e.g., SBDF2); use a Runge-Kutta timestepper")
+        self.solver      = solver
+        self.bc_type     = bc_type
+        self.wait_time   = wait_time
+        self.window_time = window_time
+        self.convergence = convergence
+        self.max_solves  = max_solves
+        self.tol         = tol
+        self.max_iter    = max_iter
+
+        domain          = solver.domain
+        self.comm       = domain.dist.comm_cart
+        self.nz         = domain.bases[-1].base_grid_size
+        self.z_slice    = domain.dist.grid_layout.slices(scales=1)[-1]
+        self.atmo_class, self.atmo_args, self.atmo_kwargs = atmo_class, atmo_args, atmo_kwargs
+        self.K          = solver.problem.parameters['K']
+        self.bvp        = None
+        self.state      = None
+
+        conv_flux = 'conv_flux + ohm_flux_z + poynt_flux_z' if magnetic else 'conv_flux'
+        self.handler = solver.evaluator.add_dictionary_handler(iter=cadence)
+        self.handler.add_task("plane_avg({})".format(conv_flux), name='F_conv', scales=1)
+        self.handler.add_task("plane_avg(UdotGrad(w, w_z))",     name='UdotGradw', scales=1)
+        self.handler.add_task("plane_avg(T1)",                   name='T1', scales=1)
+        self.last_iter_div = self.handler.last_iter_div
+
+        self.done            = False
+        self.n_solves        = 0
+        self.velocity_factor = 1
+        self._start_window(solver.sim_time)
+
+    def _start_window(self, sim_time):
+        """ Restart the in-situ averages, with the next window starting after the wait time """
+        self.window_start = sim_time + self.wait_time
+        self.sums         = OrderedDict([(task['name'], np.zeros(self.nz)) for task in self.handler.tasks])
+        self.counts       = np.zeros(self.nz)
+        self.n_samples    = 0
+
+    def _sample(self):
+        """ Add the local part of the handler's newest profiles to the sums, and their number of points to the counts """
+        data = OrderedDict()
+        for name, field in self.handler.fields.items():
+            field.set_scales(1, keep_data=True)
+            data[name] = field['g']
+        add_profile_sample(self.sums, self.counts, data, self.z_slice)
+        self.n_samples += 1
+
+    def update(self):
+        """
+        Sample the in-situ profiles, and at the end of an averaging window solve the
+        BVP and reset the simulation's mean state.  Call once per iteration, after
+        solver.step().
+
+        Returns
+        -------
+        reset : bool
+            True if the simulation's state was reset on this call
+        """
+        if self.done:
+            return False
+        sim_time = self.solver.sim_time
+        if self.handler.last_iter_div != self.last_iter_div:
+            self.last_iter_div = self.handler.last_iter_div
+            if sim_time > self.window_start:
+                self._sample()
+        if sim_time < self.window_start + self.window_time:
+            return False
+
+        # Solve the BVP on the first process and broadcast the new mean state
+        profiles = mean_profiles(self.comm, self.sums, self.counts)
+        if profiles is None:
+            return False
+        buffer = None
+        if self.comm.rank == 0:
+            try:
+                T1, ln_rho1, F_tot, a = self.solve_bvp(profiles)
+                change = state_change(a, T1, profiles['T1'], self.dT0_sad)
+                buffer = np.concatenate((T1, ln_rho1, [F_tot, a, change]))
+            except Exception as e:
+                buffer = e
+        buffer = self.comm.bcast(buffer, root=0)
+        if isinstance(buffer, Exception):
+            raise buffer
+        T1, ln_rho1 = buffer[:self.nz], buffer[self.nz:2*self.nz]
+        F_tot, a, change = buffer[2*self.nz:]
+
+        reset_mean_state(self.solver, T1, ln_rho1, a**2, a)
+        self.n_solves       += 1
+        self.velocity_factor = a
+        logger.info('AE solve {}: F_tot = {:.3e}, velocity factor = {:.3e}, change = {:.3e}'.format(self.n_solves, F_tot, a, change))
+        if change < self.convergence or self.n_solves >= self.max_solves:
+            self.done = True
+            logger.info('AE finished after {} solves'.format(self.n_solves))
+        self._start_window(sim_time)
+        return True
+
+    def _build_bvp(self):
+        """ Build the AE BVP on the first process (once; it is reused by every solve) """
+        atmosphere, domain, problem, Lz = bvp_atmosphere(self.atmo_class, self.atmo_args, self.atmo_kwargs, self.nz,
+                                                         ['T1', 'ln_rho1', 'M1', 'F_tot', 'a'])
+        self.atmosphere = atmosphere
+        self.parameters = OrderedDict()
+        for name in ['F_conv', 'UdotGradw', 'T1_evolved', 'dT_sad_ratio', 'T1_top']:
+            self.parameters[name] = domain.new_field()
+            problem.parameters[name] = self.parameters[name]
+        T0 = atmosphere.T0
+        self.dT0_sad = np.mean(T0.interpolate(z=0)['g'] - T0.interpolate(z=Lz)['g']) - atmosphere.g*Lz/atmosphere.Cp
+        problem.parameters['K']       = self.K
+        problem.parameters['F_bot']   = -self.K*np.mean(atmosphere.T0_z.interpolate(z=0)['g'])
+        problem.parameters['dT0_sad'] = self.dT0_sad
+
+        problem.add_equation("K*dz(T1) = -K*T0_z - F_tot + a**3*F_conv")
+        problem.add_equation("(T0 + T1)*dz(ln_rho1) = -dz(T1) - T1*ln_rho0_z + a**2*UdotGradw")
+        problem.add_equation("dz(M1) = rho0*(exp(ln_rho1) - 1)")
+        problem.add_equation("dz(F_tot) = 0")
+        problem.add_equation("dz(a) = 0")
+        problem.add_bc(" left(M1) = 0")
+        problem.add_bc("right(M1) = 0")
+        problem.add_bc("right(T1) = right(T1_top)")
+        if self.bc_type == 'TT':
+            problem.add_bc("left(T1) = 0")
+        else:
+            problem.add_bc("left(F_tot) = F_bot")
+        # Superadiabatic temperature jump closure, a**2 = dT_sad / dT_sad_evolved (see velocity_factor()),
+        # with dT_sad_ratio = dT0_sad / dT_sad_evolved
+        problem.add_bc("left(a**2) = left(dT_sad_ratio)*(1 + (left(T1) - right(T1))/dT0_sad)")
+        self.Lz = Lz
+        self.problem = problem
+        self.bvp = problem.build_solver()
+
+    def solve_bvp(self, profiles):
+        """
+        Solve the AE BVP for the equilibrated mean state, warm-started from the previous solve.
+
+        Parameters
+        ----------
+        profiles : OrderedDict
+            Averaged 'F_conv', 'UdotGradw', and 'T1' profiles, on the z grid (scales=1)
+
+        Returns
+        -------
+        T1, ln_rho1 : NumPy arrays
+            The new mean T1 and ln_rho1 profiles
+        F_tot, a : floats
+            The total flux and velocity factor of the new state
+        """
+        if self.bvp is None:
+            self._build_bvp()
+        for name in ['F_conv', 'UdotGradw']:
+            self.parameters[name]['g'] = profiles[name]
+
+        # The closure is relative to the evolved superadiabatic jump; the top
+        # temperature is held by FT/TT boundary conditions, and kept at its
+        # evolved value with FF boundary conditions.
+        T1_evolved = self.parameters['T1_evolved']
+        T1_evolved['g'] = profiles['T1']
+        T1_bot = np.mean(T1_evolved.interpolate(z=0)['g'])
+        T1_top = np.mean(T1_evolved.interpolate(z=self.Lz)['g'])
+        self.parameters['dT_sad_ratio']['g'] = self.dT0_sad/superadiabatic_jump(self.dT0_sad, T1_bot, T1_top)
+        self.parameters['T1_top']['g'] = T1_top if self.bc_type == 'FF' else 0
+
+        state = self.bvp.state
+        if self.state is None:
+            state['T1']['g'] = profiles['T1']
+            state['F_tot']['g'] = np.mean(profiles['F_conv']) - self.K*np.mean(self.atmosphere.T0_z['g'])
+            state['a']['g'] = 1
+        else:
+            for field, coeffs in zip(state.fields, self.state):
+                field['c'] = coeffs
+
+        pert = self.bvp.perturbations.data
+        pert.fill(1+self.tol)
+        n_iter = 0
+        while np.sum(np.abs(pert)) > self.tol:
+            if n_iter >= self.max_iter:
+                raise RuntimeError("AE BVP did not converge in {} iterations".format(self.max_iter))
+            self.bvp.newton_iteration()
+            n_iter += 1
+            logger.debug('pert norm: {} / a: {:.3e}'.format(np.sum(np.abs(pert)), np.mean(state['a']['g'])))
+        logger.info('AE BVP converged in {} iterations'.format(n_iter))
+        self.state = [np.copy(field['c']) for field in state.fields]
+
+        a = np.mean(state['a']['g'])
+        a_closure = velocity_factor(self.dT0_sad, np.mean(state['T1'].interpolate(z=0)['g']),
+                                    np.mean(state['T1'].interpolate(z=self.Lz)['g']), T1_bot, T1_top)
+        if not np.isclose(a, a_closure, rtol=1e-6):
+            logger.warning('AE velocity factor {:.6e} does not match its closure, {:.6e}'.format(a, a_closure))
+        for field in state.fields:
+            field.set_scales(1, keep_data=True)
+        return np.copy(state['T1']['g']), np.copy(state['ln_rho1']['g']), np.mean(state['F_tot']['g']), a
+
+def ae_from_args(args, solver, atmo_class, atmo_args, atmo_kwargs, t_buoy, **kwargs):
+    """
+    The accelerated evolution of a driver's parsed AE_OPTIONS, if any.
+
+    Parameters
+    ----------
+    args : dict
+        The driver's docopt arguments
+    solver, atmo_class, atmo_args, atmo_kwargs : As in AcceleratedEvolution()
+    t_buoy : float
+        The buoyancy time, in which the AE wait and window times are given
+    **kwargs : Additional keyword arguments for AcceleratedEvolution() (e.g., bc_type, magnetic)
+
+    Returns
+    -------
+    ae : AcceleratedEvolution
+        The accelerated evolution, or None if --AE was not flagged
+    """
+    if not args['--AE']:
+        return None
+    return AcceleratedEvolution(solver, atmo_class, atmo_args, atmo_kwargs,
+                                wait_time=float(args['--AE_wait'])*t_buoy, window_time=float(args['--AE_window'])*t_buoy,
+                                convergence=float(args['--AE_convergence']), **kwargs)
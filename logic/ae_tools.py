@@ -0,0 +1,83 @@
+"""
+Tools for accelerated evolution (AE) which only need NumPy: the in-situ
+averages of horizontally-averaged profiles, and the free-fall closure of the AE
+BVP.  Collective functions take an mpi4py communicator.
+"""
+from collections import OrderedDict
+
+import numpy as np
+
+
+def add_profile_sample(sums, counts, data, z_slice):
+    """
+    Add one sample of the local part of horizontally-averaged profiles to running sums.
+
+    Parameters
+    ----------
+    sums : OrderedDict
+        For each profile, the sums over samples and horizontal points at each
+        global z point (NumPy array, updated in place)
+    counts : NumPy array
+        The number of points summed at each global z point (updated in place)
+    data : dict
+        For each profile, the local grid data of this process (z last)
+    z_slice : slice
+        The local slice of the global z points
+    """
+    count = 0
+    for name, local in data.items():
+        if local.size > 0:
+            sums[name][z_slice] += np.sum(local, axis=tuple(range(local.ndim-1)))
+            count = local.size // local.shape[-1]
+    counts[z_slice] += count
+
+def mean_profiles(comm, sums, counts):
+    """
+    The global averaged profiles of running sums (collective).  Each z is
+    divided by its own global count of summed points, as processes which
+    share z points (e.g., in 2D, or in 3D with a 2D mesh) each hold only a
+    part of the horizontal planes.
+
+    Parameters
+    ----------
+    comm : mpi4py Comm
+        The communicator of the processes holding the sums
+    sums, counts : As in add_profile_sample()
+
+    Returns
+    -------
+    profiles : OrderedDict
+        For each profile, its mean at each global z point (None if some z point has no samples)
+    """
+    names  = list(sums.keys())
+    nz     = len(counts)
+    buffer = np.concatenate([sums[name] for name in names] + [counts])
+    total  = np.zeros_like(buffer)
+    comm.Allreduce(buffer, total)
+    if np.any(total[-nz:] == 0):
+        return None
+    return OrderedDict([(name, total[i*nz:(i+1)*nz]/total[-nz:]) for i, name in enumerate(names)])
+
+def superadiabatic_jump(dT0_sad, T1_bot, T1_top):
+    """ The superadiabatic temperature jump across the domain, dT_sad, of an atmosphere (whose jump is dT0_sad) plus T1 """
+    return dT0_sad + T1_bot - T1_top
+
+def velocity_factor(dT0_sad, T1_bot, T1_top, T1_evolved_bot, T1_evolved_top):
+    """
+    The velocity factor, a, of a new mean state under free-fall scaling,
+    a**2 = dT_sad/dT_sad_evolved: the closure of the AE BVP.
+
+    Parameters
+    ----------
+    dT0_sad : float
+        The superadiabatic temperature jump of the atmosphere
+    T1_bot, T1_top : floats
+        The mean T1 of the new state at the bottom and top of the domain
+    T1_evolved_bot, T1_evolved_top : floats
+        The mean T1 of the evolved (averaged) state at the bottom and top of the domain
+    """
+    return np.sqrt(superadiabatic_jump(dT0_sad, T1_bot, T1_top)/superadiabatic_jump(dT0_sad, T1_evolved_bot, T1_evolved_top))
+
+def state_change(a, T1, T1_evolved, dT0_sad):
+    """ The change of an AE solve: the larger of |a - 1| and the largest change of the mean T1, relative to dT0_sad """
+    return max(np.abs(a - 1), np.max(np.abs(T1 - T1_evolved))/dT0_sad)
@@ -0,0 +1,262 @@
+"""
+Tools for consolidating Dedalus analysis sets into a single, read-optimized
+archive file per handler.
+
+An archive for the handler directory data_dir/profiles/ lives at
+data_dir/profiles.h5.  It has the same scales/ and tasks/ layout as a merged
+Dedalus set file, so anything that can read a set file can read an archive, but:
+    - time is a single extendable, chunked leading axis across all sets.
+    - scales/set_number records which set each write came from.
+    - scales/sim_time is a strictly increasing index, so a time window can be
+      turned into a write slice without touching the task data.  Writes are
+      ordered by sim_time rather than write_number, which restarts at 1 after
+      an overwrite-mode restart.
+"""
+import logging
+import pathlib
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+TIME_SCALES = ['sim_time', 'world_time', 'wall_time', 'timestep', 'iteration', 'write_number']
+CHUNK_BYTES = 2**20
+
+
+def set_number(path):
+    """ Returns the set number of a Dedalus set file or folder, e.g. profiles_s12.h5 -> 12 """
+    return int(pathlib.Path(path).stem.split('_s')[-1])
+
+def archive_path(handler_path):
+    """ Returns the archive file path associated with a handler directory """
+    return pathlib.Path(handler_path).with_suffix('.h5')
+
+def _copy_static(item, group, name):
+    """ Copy the data (but not the dimension-scale bookkeeping) of a static scale into group """
+    if isinstance(item, h5py.Group):
+        sub_group = group.create_group(name)
+        for k, sub_item in item.items():
+            _copy_static(sub_item, sub_group, k)
+    else:
+        group.create_dataset(name, data=item[()])
+
+def _setup_archive(archive, set_file, chunk_writes):
+    """
+    Create the extendable scale and task datasets of a new archive, using a
+    merged set file as a template.
+
+    Parameters
+    ----------
+    archive : h5py File
+        The (empty) archive file
+    set_file : h5py File
+        A merged Dedalus set file from the handler being archived
+    chunk_writes : int
+        Maximum number of writes per chunk
+    """
+    archive.attrs['handler_name'] = set_file.attrs['handler_name']
+    scales = archive.create_group('scales')
+    for k in set_file['scales']:
+        if k in TIME_SCALES:
+            dtype = set_file['scales'][k].dtype
+            scales.create_dataset(k, shape=(0,), maxshape=(None,), dtype=dtype, chunks=(chunk_writes,))
+        else:
+            # Spatial grids & coefficient elements don't change in time.
+            _copy_static(set_file['scales'][k], scales, k)
+    scales.create_dataset('set_number', shape=(0,), maxshape=(None,), dtype=np.int32, chunks=(chunk_writes,))
+
+    tasks = archive.create_group('tasks')
+    for k, dset in set_file['tasks'].items():
+        shape = dset.shape[1:]
+        write_bytes = max(1, int(np.prod(shape))*dset.dtype.itemsize)
+        n_chunk = int(np.clip(CHUNK_BYTES // write_bytes, 1, chunk_writes))
+        arch_dset = tasks.create_dataset(k, shape=(0,)+shape, maxshape=(None,)+shape, dtype=dset.dtype, chunks=(n_chunk,)+shape)
+        for attr, value in dset.attrs.items():
+            if attr in ['DIMENSION_LIST']: continue
+            arch_dset.attrs[attr] = value
+
+def _append_set(archive, set_file, num, last_time):
+    """
+    Append all writes in a merged set file with sim_time later than last_time to the archive.
+
+    Returns
+    -------
+    n_new : int
+        The number of writes appended
+    """
+    sim_time = set_file['scales/sim_time'][()]
+    first = int(np.searchsorted(sim_time, last_time, side='right'))
+    n_new = len(sim_time) - first
+    if n_new <= 0:
+        return 0
+    src = slice(first, first+n_new)
+
+    n_old = archive['scales/write_number'].shape[0]
+    if n_old > 0 and set_file['scales/write_number'][first] <= archive['scales/write_number'][-1]:
+        logger.info('write numbers restart at {} in set {} (an overwrite-mode restart?); archiving by sim_time'.format(set_file['scales/write_number'][first], num))
+    dest = slice(n_old, n_old+n_new)
+    for k in TIME_SCALES:
+        if k not in archive['scales']: continue
+        archive['scales'][k].resize((n_old+n_new,))
+        archive['scales'][k][dest] = set_file['scales'][k][src]
+    archive['scales/set_number'].resize((n_old+n_new,))
+    archive['scales/set_number'][dest] = num
+    for k, dset in archive['tasks'].items():
+        dset.resize(n_old+n_new, axis=0)
+        dset[dest] = set_file['tasks'][k][src]
+    return n_new
+
+def consolidate_handler(handler_path, archive_file=None, chunk_writes=256, cleanup=False):
+    """
+    Consolidate the merged set files of a Dedalus file handler into one archive.
+    Can be called repeatedly as a run progresses (or across restarts); only
+    writes with sim_time later than the last archived write are appended.
+
+    Parameters
+    ----------
+    handler_path : string or pathlib Path
+        Path to the handler directory, e.g., data_dir/profiles/
+    archive_file : string or pathlib Path, optional
+        Path to the archive file.  If None, use handler_path.h5
+    chunk_writes : int, optional
+        Maximum number of writes per HDF5 chunk along the time axis
+    cleanup : bool, optional
+        If True, delete set files once they are fully archived.
+    """
+    handler_path = pathlib.Path(handler_path)
+    if archive_file is None:
+        archive_file = archive_path(handler_path)
+    set_files = sorted(handler_path.glob('{:s}_s*.h5'.format(handler_path.stem)), key=set_number)
+    if len(set_files) == 0:
+        logger.info('no merged sets to archive in {}'.format(handler_path))
+        return archive_file
+
+    with h5py.File(str(archive_file), 'a') as archive:
+        if 'tasks' not in archive:
+            with h5py.File(str(set_files[0]), 'r') as f:
+                _setup_archive(archive, f, chunk_writes)
+        sim_time = archive['scales/sim_time']
+        last_time = sim_time[-1] if sim_time.shape[0] > 0 else -np.inf
+
+        n_total = 0
+        for path in set_files:
+            with h5py.File(str(path), 'r') as f:
+                n_new = _append_set(archive, f, set_number(path), last_time)
+                if n_new > 0:
+                    last_time = archive['scales/sim_time'][-1]
+            n_total += n_new
+        archive.attrs['writes'] = archive['scales/write_number'].shape[0]
+    logger.info('archived {} new writes from {} into {}'.format(n_total, handler_path, archive_file))
+
+    if cleanup:
+        for path in set_files:
+            path.unlink()
+    return archive_file
+
+def consolidate_analysis(analysis_tasks, keys=('profile', 'scalar'), comm=None, **kwargs):
+    """
+    Consolidate (already merged) analysis handlers into archives, on the root process.
+
+    Parameters
+    ----------
+    analysis_tasks : OrderedDict
+        Dedalus file handlers, as returned by logic.output.initialize_output()
+    keys : tuple, optional
+        Keys of the handlers in analysis_tasks to consolidate
+    comm : mpi4py Comm, optional
+        Communicator that merged the handler output (default: MPI.COMM_WORLD)
+    **kwargs : Additional keyword arguments for consolidate_handler()
+    """
+    if comm is None:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    comm.Barrier()
+    if comm.rank == 0:
+        for k in keys:
+            if k in analysis_tasks.keys():
+                consolidate_handler(analysis_tasks[k].base_path, **kwargs)
+    comm.Barrier()
+
+def find_writes(archive, start_time=-np.inf, end_time=np.inf):
+    """
+    Use the sim_time index of an archive to find the writes within a time window.
+
+    Parameters
+    ----------
+    archive : h5py File
+        An open archive file
+    start_time, end_time : floats, optional
+        The (inclusive) sim_time window
+
+    Returns
+    -------
+    writes : slice
+        The write indices inside the time window
+    """
+    sim_time = archive['scales/sim_time'][()]
+    start = np.searchsorted(sim_time, start_time, side='left')
+    end   = np.searchsorted(sim_time, end_time, side='right')
+    return slice(int(start), int(end))
+
+def window_means(handler_path, tasks, avg_time, chunk_writes=256):
+    """
+    Time-average tasks of a file handler over the last avg_time of its output,
+    in a single streaming pass.  The sim_time scales of the handler's archive
+    (if any) and merged set files form an index that selects exactly the writes
+    inside the window, skipping writes already in earlier sources (by sim_time,
+    since write numbers restart after overwrite-mode restarts); each source file is then opened once,
+    and the selected writes of all tasks are read in hyperslabs of chunk_writes
+    writes and summed into running means.
+
+    Parameters
+    ----------
+    handler_path : string or pathlib Path
+        Path to the handler directory, e.g., data_dir/profiles/
+    tasks : list
+        Names of the tasks to average
+    avg_time : float
+        Length of the averaging window, ending at the last write
+    chunk_writes : int, optional
+        Maximum number of writes to read at once
+
+    Returns
+    -------
+    means : OrderedDict
+        The time-averaged (squeezed) data of each task
+    n_writes : int
+        The number of writes averaged over
+    """
+    handler_path = pathlib.Path(handler_path)
+    sources = sorted(handler_path.glob('{:s}_s*.h5'.format(handler_path.stem)), key=set_number)
+    if archive_path(handler_path).exists():
+        sources = [archive_path(handler_path)] + sources
+
+    # Index: each source's writes which are later than those of earlier sources
+    index, last_time = [], -np.inf
+    for path in sources:
+        with h5py.File(str(path), 'r') as f:
+            sim_time = f['scales/sim_time'][()]
+        first = int(np.searchsorted(sim_time, last_time, side='right'))
+        if first < len(sim_time):
+            index.append((path, sim_time, first))
+            last_time = sim_time[-1]
+    if len(index) == 0:
+        raise ValueError("No output to average in {}".format(handler_path))
+    start_time = index[-1][1][-1] - avg_time
+
+    sums = OrderedDict([(k, 0) for k in tasks])
+    n_writes = 0
+    for path, sim_time, first in index:
+        if sim_time[-1] < start_time:
+            continue
+        start = max(first, int(np.searchsorted(sim_time, start_time, side='left')))
+        with h5py.File(str(path), 'r') as f:
+            for i in range(start, len(sim_time), chunk_writes):
+                block = slice(i, min(i+chunk_writes, len(sim_time)))
+                for k in tasks:
+                    sums[k] = sums[k] + np.sum(f['tasks'][k][block], axis=0)
+                n_writes += block.stop - block.start
+    means = OrderedDict([(k, np.squeeze(v/n_writes)) for k, v in sums.items()])
+    return means, n_writes
@@ -0,0 +1,694 @@
+"""
+Checkpoint file tools which only need NumPy and h5py: checkpoint intervals and
+retention policies, CRC-32 checksums of written data, scans of shared and
+node-local checkpoint sets, restarts from unified files and per-process sets,
+and double-buffered asynchronous writes.  Collective functions take an mpi4py
+communicator; solvers are used through their Dedalus interfaces.
+"""
+import logging
+import pathlib
+import queue
+import threading
+import zlib
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__.split('.')[-1])
+
+
+def optimal_interval(cost, mtbf):
+    """
+    The checkpoint interval which minimizes the expected wall time lost to
+    writing checkpoints and redoing work after failures, from Daly's
+    higher-order extension of Young's sqrt(2*cost*mtbf).
+
+    Parameters
+    ----------
+    cost : float
+        Wall time to write a checkpoint
+    mtbf : float
+        Expected mean time between failures
+
+    Returns
+    -------
+    interval : float
+        Wall time of computation between checkpoints
+    """
+    if cost >= 2*mtbf:
+        return mtbf
+    ratio = cost/(2*mtbf)
+    return np.sqrt(2*cost*mtbf)*(1 + np.sqrt(ratio)/3 + ratio/9) - cost
+
+def expected_overhead(interval, cost, mtbf):
+    """
+    Expected fractions of wall time spent writing checkpoints, cost/interval,
+    and redoing work lost after failures, (interval + cost)/(2*mtbf).
+    """
+    return cost/interval, (interval + cost)/(2*mtbf)
+
+def crc32(data):
+    """ CRC-32 checksum of the bytes of a NumPy array """
+    return zlib.crc32(np.ascontiguousarray(data).tobytes()) & 0xffffffff
+
+def add_checksums(file, crcs, index):
+    """ Store the CRC-32 of write index of each task dataset in its 'crc32' attribute """
+    for name, crc in crcs.items():
+        dset = file['tasks'][name]
+        values = np.zeros(dset.shape[0], dtype=np.uint32)
+        if 'crc32' in dset.attrs:
+            old = dset.attrs['crc32']
+            values[:len(old)] = old[:len(values)]
+        values[index] = crc
+        dset.attrs['crc32'] = values
+
+def verify_checksums(path, index=-1):
+    """
+    Verify the CRC-32 checksums of the task data of one write in a checkpoint file.
+
+    Joined files (from post.merge_process_files() or merge_virtual()) have no
+    CRC-32s of their own, as each CRC-32 covers one process' piece, so the
+    process files of the set (e.g., checkpoint_s1/ next to checkpoint_s1.h5)
+    are verified instead, if they are present; joined files whose process files
+    have been deleted cannot be verified.  Virtual datasets also read through
+    the fletcher32 filters of their process files.
+
+    Returns
+    -------
+    n_checked : int
+        The number of datasets whose checksums were verified
+
+    Raises
+    ------
+    ValueError : if a checksum does not match, if a checksummed task has no
+        writes, or if a file written with checksums (its 'checksum' attribute
+        is set) has none to verify
+    """
+    path = pathlib.Path(path)
+    n_checked = 0
+    with h5py.File(str(path), 'r') as file:
+        checksummed = bool(file.attrs.get('checksum', False))
+        for name, dset in file['tasks'].items():
+            if 'crc32' not in dset.attrs:
+                continue
+            if dset.shape[0] == 0:
+                raise ValueError("{} has no writes of task {}; it was not completely written".format(path, name))
+            write = index % dset.shape[0]
+            if crc32(dset[write]) != dset.attrs['crc32'][write]:
+                raise ValueError("Checksum mismatch in {}, task {}, write {}".format(path, name, write))
+            n_checked += 1
+    if n_checked == 0:
+        set_path = path.with_suffix('')
+        if set_path.is_dir():
+            for proc_path in sorted(set_path.glob('{:s}_p*.h5'.format(set_path.stem))):
+                n_checked += verify_checksums(proc_path, index)
+            checksummed = checksummed or n_checked > 0
+        elif not checksummed:
+            logger.debug("{} has no checksums to verify".format(path))
+    if checksummed and n_checked == 0:
+        raise ValueError("{} was written with checksums, but none were found".format(path))
+    return n_checked
+
+def set_time(paths):
+    """ The sim_time of the first write of a checkpoint set, from its merged file or a process file """
+    files = [p for p in paths if p.is_file()] + [f for p in paths if p.is_dir() for f in sorted(p.glob('*.h5'))]
+    for f in files:
+        try:
+            with h5py.File(str(f), 'r') as cp_file:
+                return cp_file['scales/sim_time'][0]
+        except (OSError, KeyError, IndexError):
+            continue
+    return np.nan
+
+def set_bytes(paths):
+    """ The total size of a checkpoint set, including its merged file and process files """
+    n_bytes = 0
+    for p in paths:
+        if p.is_dir():
+            n_bytes += sum(f.stat().st_size for f in p.glob('*') if f.is_file())
+        else:
+            n_bytes += p.stat().st_size
+    return n_bytes
+
+def select_evictions(sets, newest, keep_last=None, keep_every=None, max_bytes=None):
+    """
+    Choose which checkpoint sets to delete under a retention policy.
+    Sets at or after the newest verified set are never deleted, and neither
+    are the newest keep_last sets.  Sets kept by keep_every are evicted
+    (oldest first, with a warning) only if max_bytes cannot otherwise be met.
+
+    Parameters
+    ----------
+    sets : OrderedDict
+        For each set number, a dict with the 'sim_time' and 'bytes' of the set
+    newest : int
+        The newest set which has been completely written by all processes
+    keep_last : int, optional
+        Keep this many of the newest (verified) sets
+    keep_every : float, optional
+        Keep the first set in each interval of this much sim time
+    max_bytes : float, optional
+        Evict the oldest remaining sets, other than the newest keep_last,
+        until all sets fit in this many bytes
+
+    Returns
+    -------
+    evict : list
+        Set numbers to delete
+    """
+    candidates = [n for n in sets.keys() if n < newest]
+    protected, every = set(), set()
+    if keep_last is not None:
+        protected.update(sorted([n for n in sets.keys() if n <= newest])[-keep_last:])
+    if keep_every is not None:
+        intervals = set()
+        for n in sorted(sets.keys()):
+            interval = np.floor(sets[n]['sim_time']/keep_every)
+            if np.isfinite(interval) and interval not in intervals:
+                intervals.add(interval)
+                every.add(n)
+    if keep_last is None and keep_every is None:
+        keep = set(candidates)
+    else:
+        keep = protected | every
+    evict = [n for n in candidates if n not in keep]
+
+    if max_bytes is not None:
+        remaining = [n for n in candidates if n not in evict and n not in protected]
+        total = sum(sets[n]['bytes'] for n in sets.keys() if n not in evict)
+        while total > max_bytes and len(remaining) > 0:
+            n = remaining.pop(0)
+            if n in every:
+                logger.warning('evicting checkpoint set {}, kept by keep_every, to fit in max_bytes'.format(n))
+            evict.append(n)
+            total -= sets[n]['bytes']
+        if total > max_bytes:
+            logger.warning('checkpoint sets use {:.3g} bytes > max_bytes {:.3g}, but the rest are protected'.format(total, max_bytes))
+    return sorted(evict)
+
+def read_header(file, index):
+    """ Read the time scales of write index of a checkpoint file (ValueError if it has no writes) """
+    scales = file['scales']
+    if scales['write_number'].shape[0] == 0:
+        raise ValueError("Checkpoint {} has no writes; it was not completely written".format(file.filename))
+    return {'write_num' : scales['write_number'][index],
+            'dt'        : scales['timestep'][index] if 'timestep' in scales else None,
+            'iteration' : scales['iteration'][index],
+            'sim_time'  : scales['sim_time'][index],
+            'index'     : index % scales['write_number'].shape[0]}
+
+def scan_process_set(set_path):
+    """
+    Read the layout of an unmerged per-process set.
+
+    Parameters
+    ----------
+    set_path : pathlib Path
+        The per-process set folder, e.g. checkpoint/checkpoint_s1/
+
+    Returns
+    -------
+    pieces : list
+        For each process file, (path, {task name : (start, count)})
+    tasks : dict
+        For each task name, its global shape, grid_space, and dtype
+    """
+    pieces, tasks = [], {}
+    for proc_path in sorted(set_path.glob('{:s}_p*.h5'.format(set_path.stem))):
+        proc_pieces = {}
+        with h5py.File(str(proc_path), 'r') as f:
+            if not f.attrs.get('complete', True):
+                raise ValueError("Process file {} was not completely written".format(proc_path))
+            for name, dset in f['tasks'].items():
+                proc_pieces[name] = (np.array(dset.attrs['start']), np.array(dset.attrs['count']))
+                if name not in tasks:
+                    tasks[name] = {'global_shape' : np.array(dset.attrs['global_shape']),
+                                   'grid_space'   : np.array(dset.attrs['grid_space']),
+                                   'dtype'        : dset.dtype}
+        pieces.append((proc_path, proc_pieces))
+    return pieces, tasks
+
+def set_solver_time(solver, header):
+    """ Set the iteration and sim time of a solver from a checkpoint header, as in solver.load_state() """
+    solver.iteration = solver.initial_iteration = header['iteration']
+    solver.sim_time = solver.initial_sim_time = header['sim_time']
+    logger.info("Loading iteration: {}".format(solver.iteration))
+    logger.info("Loading write: {}".format(header['write_num']))
+    logger.info("Loading sim time: {}".format(solver.sim_time))
+    logger.info("Loading timestep: {}".format(header['dt']))
+
+def match_layout(domain, grid_space, global_shape):
+    """
+    Find the layout and scales of saved data, as in solver.load_state().
+
+    Parameters
+    ----------
+    domain : Dedalus Domain object
+        The domain of the solver
+    grid_space : array of bools
+        The grid_space attribute of the saved dataset
+    global_shape : array of ints
+        The global (spatial) shape of the saved dataset
+
+    Returns
+    -------
+    layout : Dedalus Layout object
+        The layout of the saved data
+    scales : tuple
+        The scales of the saved data
+    """
+    for layout in domain.dist.layouts:
+        if np.allclose(layout.grid_space, grid_space):
+            break
+    else:
+        raise ValueError("No matching layout")
+    scales = np.array(global_shape) / layout.global_shape(scales=1)
+    scales[~np.array(layout.grid_space)] = 1
+    return layout, tuple(scales)
+
+def load_hyperslabs(solver, path, index=-1, comm=None, collective=False):
+    """
+    Load the solver state from a unified checkpoint file, like solver.load_state(),
+    with memory and I/O that stay flat per process as the job scales:
+        - the root process reads the time scales and broadcasts them,
+        - each process reads only the hyperslab of its local layout slices,
+          straight into a buffer of its local shape (h5py read_direct), and
+        - if h5py is built with MPI and collective is True, the file is opened
+          with the mpio driver and the hyperslabs are read collectively.
+
+    Parameters
+    ----------
+    solver : Dedalus IVP solver
+        The solver whose state is loaded
+    path : string or pathlib Path
+        The unified checkpoint file (merged or virtually merged)
+    index : int, optional
+        The write within the file to load
+    comm : mpi4py Comm, optional
+        The communicator of the solver's domain (default: domain.dist.comm_cart)
+    collective : bool, optional
+        If True, use collective MPI-IO reads when available
+
+    Returns
+    -------
+    write_num : int
+        The write number of the loaded state
+    dt : float
+        The timestep of the loaded state
+    """
+    domain = solver.domain
+    if comm is None:
+        comm = domain.dist.comm_cart
+    logger.info("Loading solver state from: {}".format(path))
+    header = None
+    if comm.rank == 0:
+        try:
+            with h5py.File(str(path), 'r') as f:
+                header = read_header(f, index)
+        except ValueError as e:
+            header = {'error' : e}
+    header = comm.bcast(header, root=0)
+    if 'error' in header:
+        raise header['error']
+    index = header['index']
+    set_solver_time(solver, header)
+
+    collective = collective and h5py.get_config().mpi and comm.size > 1
+    if collective:
+        file = h5py.File(str(path), 'r', driver='mpio', comm=comm)
+    else:
+        file = h5py.File(str(path), 'r')
+    with file:
+        for field in solver.state.fields:
+            dset = file['tasks'][field.name]
+            layout, scales = match_layout(domain, dset.attrs['grid_space'], dset.shape[1:])
+            local_data = np.empty(layout.local_shape(scales), dtype=dset.dtype)
+            source = np.s_[(index,) + tuple(layout.slices(scales))]
+            if collective:
+                with dset.collective:
+                    dset.read_direct(local_data, source_sel=source)
+            elif local_data.size > 0:
+                dset.read_direct(local_data, source_sel=source)
+            field.set_scales(scales, keep_data=False)
+            field[layout] = local_data
+            field.set_scales(domain.dealias, keep_data=True)
+    return header['write_num'], header['dt']
+
+def load_process_set(solver, set_path, index=-1, comm=None):
+    """
+    Load the solver state from an unmerged per-process set, like solver.load_state().
+    The root process scans the set and broadcasts its layout; each process then
+    reads the hyperslabs of the per-process files that overlap its local data.
+
+    Parameters
+    ----------
+    solver : Dedalus IVP solver
+        The solver whose state is loaded
+    set_path : string or pathlib Path
+        The per-process set folder, e.g. checkpoint/checkpoint_s1/
+    index : int, optional
+        The write within the set to load
+    comm : mpi4py Comm, optional
+        The communicator of the solver's domain (default: domain.dist.comm_cart)
+
+    Returns
+    -------
+    write_num : int
+        The write number of the loaded state
+    dt : float
+        The timestep of the loaded state
+    """
+    set_path = pathlib.Path(set_path)
+    domain = solver.domain
+    if comm is None:
+        comm = domain.dist.comm_cart
+    logger.info("Loading solver state from per-process set: {}".format(set_path))
+
+    header = None
+    if comm.rank == 0:
+        try:
+            pieces, tasks = scan_process_set(set_path)
+            if len(pieces) == 0:
+                raise FileNotFoundError("No process files found in {}".format(set_path))
+            with h5py.File(str(pieces[0][0]), 'r') as f:
+                header = read_header(f, index)
+            header['pieces'], header['tasks'] = pieces, tasks
+        except (FileNotFoundError, ValueError) as e:
+            header = {'error' : e}
+    header = comm.bcast(header, root=0)
+    if 'error' in header:
+        # Raise on all processes, rather than leaving the others waiting
+        raise header['error']
+
+    # Each process verifies the checksums of a share of the process files
+    error, n_checked = None, 0
+    for proc_path, proc_pieces in header['pieces'][comm.rank::comm.size]:
+        try:
+            n_checked += verify_checksums(proc_path, index)
+        except ValueError as e:
+            error = e
+    errors = [e for e in comm.allgather(error) if e is not None]
+    if len(errors) > 0:
+        raise errors[0]
+    n_checked = comm.allreduce(n_checked)
+    logger.info("Verified {} checksums".format(n_checked))
+    index = header['index']
+
+    set_solver_time(solver, header)
+
+    files = {}
+    for field in solver.state.fields:
+        task = header['tasks'][field.name]
+        layout, scales = match_layout(domain, task['grid_space'], task['global_shape'])
+        local_slices = layout.slices(scales)
+        local_data = np.zeros(layout.local_shape(scales), dtype=task['dtype'])
+
+        # Copy the overlap of each process piece with the local data
+        for proc_path, proc_pieces in header['pieces']:
+            start, count = proc_pieces[field.name]
+            src, dest = [], []
+            for sl, s, c in zip(local_slices, start, count):
+                lo, hi = max(sl.start, s), min(sl.stop, s + c)
+                if hi <= lo:
+                    break
+                src.append(slice(lo - s, hi - s))
+                dest.append(slice(lo - sl.start, hi - sl.start))
+            else:
+                if proc_path not in files:
+                    files[proc_path] = h5py.File(str(proc_path), 'r')
+                local_data[tuple(dest)] = files[proc_path]['tasks'][field.name][(index,) + tuple(src)]
+
+        field.set_scales(scales, keep_data=False)
+        field[layout] = local_data
+        field.set_scales(domain.dealias, keep_data=True)
+    for f in files.values():
+        f.close()
+    logger.info("Read from {} of {} process files".format(len(files), len(header['pieces'])))
+    return header['write_num'], header['dt']
+
+def set_file_path(base_path, set_num, rank):
+    """ Path to a process' file in a per-process set, base_path/base_sN/base_sN_pR.h5 """
+    stem = base_path.stem
+    return base_path.joinpath('{:s}_s{:d}'.format(stem, set_num), '{:s}_s{:d}_p{:d}.h5'.format(stem, set_num, rank))
+
+def remove_set_file(path):
+    """ Remove a per-process set file, and its set folder once it is empty """
+    path.unlink()
+    try:
+        path.parent.rmdir()
+    except OSError:
+        pass # Other processes on this node still have files in the set
+
+def partner_shift(names):
+    """
+    The smallest rank shift which pairs every process with a partner on another
+    node, given the processor name of each rank, or 1 if all processes share a node.
+    """
+    size = len(names)
+    for shift in range(1, size):
+        if all([names[r] != names[(r + shift) % size] for r in range(size)]):
+            return shift
+    logger.warning('all processes share a node; partner checkpoint copies will not survive a node failure')
+    return 1
+
+def exchange_pieces(comm, pieces, dest, source, received=None):
+    """
+    Send a process' state pieces to dest, and receive those of source (collective).
+    The layout of the pieces is fixed, so it is only sent (pickled) when received
+    is None; the data is sent from and received into NumPy buffers.
+
+    Parameters
+    ----------
+    comm : mpi4py Comm
+        The communicator of the processes
+    pieces : OrderedDict
+        The pieces to send, as returned by ProcessFileHandler.get_pieces()
+    dest, source : int
+        The ranks to send to and receive from
+    received : OrderedDict, optional
+        The pieces returned by the previous exchange, whose buffers are reused
+
+    Returns
+    -------
+    received : OrderedDict
+        The pieces of source
+    """
+    if received is None:
+        layout = OrderedDict()
+        for name, piece in pieces.items():
+            layout[name] = {k : v for k, v in piece.items() if k != 'data'}
+            layout[name]['dtype'] = piece['data'].dtype
+        received = comm.sendrecv(layout, dest=dest, source=source)
+        for piece in received.values():
+            piece['data'] = np.empty(tuple(int(c) for c in piece['count']), dtype=piece.pop('dtype'))
+    for name, piece in pieces.items():
+        comm.Sendrecv(np.ascontiguousarray(piece['data']), dest=dest, recvbuf=received[name]['data'], source=source)
+    return received
+
+def local_sets(base_path, partner_path, rank):
+    """
+    Find a process' node-local checkpoint files.
+
+    Returns
+    -------
+    own_sets : dict
+        For each set number, the path of the process' own file
+    held_sets : list
+        (set number, source rank, path) of each partner copy held by the process
+    """
+    own_sets, held_sets = {}, []
+    for path in base_path.glob('{:s}_s*/*_p{:d}.h5'.format(base_path.stem, rank)):
+        own_sets[int(path.parent.name.split('_s')[-1])] = path
+    for path in partner_path.glob('{:s}_s*/*.h5'.format(partner_path.stem)):
+        try:
+            with h5py.File(str(path), 'r') as f:
+                if f.attrs.get('holder', None) != rank:
+                    continue # Node-local directory shared with other processes
+        except OSError:
+            continue
+        held_sets.append((int(path.parent.name.split('_s')[-1]), int(path.stem.split('_p')[-1]), path))
+    return own_sets, held_sets
+
+def local_set_time(path, size):
+    """ The sim_time of a complete node-local set file written by size processes, or None """
+    try:
+        with h5py.File(str(path), 'r') as f:
+            if not f.attrs.get('complete', False) or f.attrs['mpi_size'] != size or f['scales/sim_time'].shape[0] == 0:
+                return None
+            return f['scales/sim_time'][-1]
+    except (OSError, KeyError):
+        return None
+
+def newest_local_set(base_path, partner_path, comm):
+    """
+    Find the newest node-local checkpoint set which can be restarted: one in
+    which the state of every process is in a complete file, either its own or
+    a partner copy, written with the same number of processes (collective).
+
+    Returns
+    -------
+    set_num : int
+        The set number (None if there is no such set)
+    sim_time : float
+        The sim_time of the set
+    holders : dict
+        For each rank without its own file, the rank which holds its partner copy
+    """
+    own_sets, held_sets = local_sets(base_path, partner_path, comm.rank)
+    own, held = {}, []
+    for n, path in own_sets.items():
+        sim_time = local_set_time(path, comm.size)
+        if sim_time is not None:
+            own[n] = sim_time
+    for n, r, path in held_sets:
+        sim_time = local_set_time(path, comm.size)
+        if sim_time is not None:
+            held.append((n, r, comm.rank, sim_time))
+    all_own = comm.allgather(own)
+    all_held = [h for proc_held in comm.allgather(held) for h in proc_held]
+
+    set_nums = set([n for proc_own in all_own for n in proc_own]) | set([h[0] for h in all_held])
+    for n in sorted(set_nums, reverse=True):
+        holders, sim_time = {}, None
+        for r in range(comm.size):
+            if n in all_own[r]:
+                sim_time = all_own[r][n]
+                continue
+            copies = [h for h in all_held if h[0] == n and h[1] == r]
+            if len(copies) == 0:
+                break
+            holders[r], sim_time = copies[0][2], copies[0][3]
+        else:
+            return n, sim_time, holders
+    return None, None, {}
+
+def read_local_file(path):
+    """ Read the header and the last write of each task of a node-local set file """
+    pieces = {}
+    with h5py.File(str(path), 'r') as f:
+        header = read_header(f, -1)
+        for name, dset in f['tasks'].items():
+            pieces[name] = {'data'         : dset[-1],
+                            'global_shape' : np.array(dset.attrs['global_shape']),
+                            'start'        : np.array(dset.attrs['start']),
+                            'count'        : np.array(dset.attrs['count']),
+                            'grid_space'   : np.array(dset.attrs['grid_space'])}
+    return header, pieces
+
+def newest_shared_set(checkpoint_dir, comm):
+    """
+    Find the newest complete checkpoint set on the shared filesystem: a
+    merged file marked complete, or a per-process set folder whose complete
+    files cover the global data (the root process scans, collective).
+
+    Returns
+    -------
+    path : pathlib Path
+        The merged file or set folder (None if there is no complete set)
+    sim_time : float
+        The sim_time of the set
+    """
+    result = (None, None)
+    if comm.rank == 0:
+        set_paths = {}
+        for path in checkpoint_dir.glob('{:s}_s*'.format(checkpoint_dir.stem)):
+            set_paths.setdefault(int(path.stem.split('_s')[-1]), []).append(path)
+        for n in sorted(set_paths.keys(), reverse=True):
+            # Merged files first
+            for path in sorted(set_paths[n], key=lambda p: p.is_dir()):
+                try:
+                    if path.is_dir():
+                        pieces, tasks = scan_process_set(path)
+                        covered = [sum([np.prod(proc[name][1]) for p, proc in pieces if name in proc]) == np.prod(task['global_shape'])
+                                   for name, task in tasks.items()]
+                        if len(tasks) == 0 or not all(covered):
+                            continue
+                    else:
+                        with h5py.File(str(path), 'r') as f:
+                            if not f.attrs.get('complete', True) or f['scales/sim_time'].shape[0] == 0:
+                                continue
+                except (OSError, KeyError, ValueError):
+                    continue
+                result = (path, set_time([path]))
+                break
+            if result[0] is not None:
+                break
+    return comm.bcast(result, root=0)
+
+
+class DoubleBufferedWriter:
+    """
+    Writes data asynchronously from two preallocated memory buffers: copy()
+    copies the data into a free buffer and queues it, and a background thread
+    passes each queued buffer to a write function.  copy() only blocks while
+    both buffers are still waiting to be written, so at most one write is
+    pending while the next is copied.
+
+    Attributes:
+    -----------
+    buffers : list
+        The two buffers, each a dict of NumPy arrays by name (None until first used)
+    buffer_free : list
+        For each buffer, a threading.Event which is set while it can be filled
+    n_copies : int
+        Number of copies made
+    write : function
+        Called as write(buffer, *args) on the writer thread for each copy(data, *args);
+        it must not make MPI calls.
+    """
+
+    def __init__(self, write):
+        """
+        Start the writer thread.
+
+        Parameters
+        ----------
+        write : function
+            As in class-level docstring
+        """
+        self.write = write
+        self.buffers = [None, None]
+        self.buffer_free = [threading.Event(), threading.Event()]
+        for event in self.buffer_free:
+            event.set()
+        self.n_copies = 0
+        self.write_queue = queue.Queue()
+        self.writer = threading.Thread(target=self._run_writer, daemon=True)
+        self.writer.start()
+
+    def copy(self, data, *args):
+        """
+        Copy data into a free buffer (waiting for one if needed), and queue it to be written.
+
+        Parameters
+        ----------
+        data : dict
+            NumPy arrays by name; they keep the same shapes and dtypes from copy to copy
+        *args : Additional arguments for the write function
+        """
+        slot = self.n_copies % 2
+        self.buffer_free[slot].wait()
+        if self.buffers[slot] is None:
+            self.buffers[slot] = dict()
+        for name, array in data.items():
+            if name not in self.buffers[slot]:
+                self.buffers[slot][name] = np.empty_like(array)
+            np.copyto(self.buffers[slot][name], array)
+        self.buffer_free[slot].clear()
+        self.n_copies += 1
+        self.write_queue.put((slot, args))
+
+    def _run_writer(self):
+        while True:
+            slot, args = self.write_queue.get()
+            try:
+                self.write(self.buffers[slot], *args)
+            except Exception as e:
+                logger.error('failed asynchronous write {}: {}'.format(args, e))
+            self.buffer_free[slot].set()
+            self.write_queue.task_done()
+
+    def wait(self):
+        """ Wait for all queued writes to finish """
+        self.write_queue.join()
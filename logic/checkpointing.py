@@ -1,17 +1,399 @@
 """
 A simple checkpointing class, written by Jeff Oishi, during the implementation
 of checkpointing-related functionality in dedalus (append mode, etc.)
+
+Tools for checkpoint files which don't need Dedalus or MPI (checkpoint
+intervals, retention, checksums, set scans, restart loaders and asynchronous
+writes) are in logic.checkpoint_files.
 """
 import pathlib 
+import shutil
+import time
+from collections import OrderedDict
 import h5py
 import numpy as np
 import logging
 import re
+from mpi4py import MPI
+from logic.staging import StagedFileHandler
+from logic.handlers import ProcessFileHandler, TIME_SCALES, write_count, setup_base_path
+from logic.checkpoint_files import optimal_interval, expected_overhead, crc32, add_checksums, verify_checksums, \
+                                   set_time, set_bytes, select_evictions, read_header, scan_process_set, \
+                                   set_file_path, remove_set_file, local_sets, newest_local_set, read_local_file, \
+                                   newest_shared_set, set_solver_time, match_layout, load_hyperslabs, load_process_set, \
+                                   partner_shift, exchange_pieces, DoubleBufferedWriter
 logger = logging.getLogger(__name__.split('.')[-1])
 
+# Checkpoint options shared by the drivers; append to a driver's docopt string.
+CHECKPOINT_OPTIONS = """
+    --async_checkpoint         If flagged, write checkpoints from memory buffers in a background thread
+    --keep_checkpoints=<n>     If specified, only keep the last n checkpoint sets
+    --keep_checkpoint_every=<t>  If specified, also keep one checkpoint set per t sim time units
+    --checkpoint_GB=<GB>       If specified, evict the oldest checkpoint sets to stay under this size
+    --checkpoint_compression=<c>  If specified, losslessly compress checkpoints with this filter (gzip or lzf)
+    --checkpoint_checksum      If flagged, write checkpoint checksums, which are verified on restart
+    --checkpoint_MTBF=<hr>     If specified, expected hours between node failures; checkpoints are then written at the cost-optimal wall time interval
+    --local_checkpoint_dir=<dir>  If specified, also write frequent checkpoints to this node-local directory
+    --local_checkpoint_wall=<min>  Wall time minutes between node-local checkpoints [default: 10]
+    --partner_checkpoint       If flagged, also copy each node-local checkpoint to a process on another node
+"""
+
+class CheckpointHandler(StagedFileHandler):
+    """
+    A Dedalus FileHandler for checkpoint output.  Before each checkpoint
+    is written, buffered output handlers are flushed, so that all output 
+    up to the checkpoint is on disk when the checkpoint is.  Checkpoints
+    can be staged to node-local storage (see logic.staging).
+
+    With async_write, each checkpoint is copied into one of two preallocated
+    buffers and written by a background thread while the solver continues.
+    Each file carries a 'complete' attribute, which is only set to True once
+    all of its data has been written; restarts refuse incomplete files.
+
+    Task datasets can be losslessly compressed (gzip or lzf, with byte shuffling)
+    and checksummed: HDF5 fletcher32 checksums on each chunk, plus a 'crc32'
+    attribute with a CRC-32 of the in-memory data of each write, which restart
+    verifies before loading.  Checksummed files carry a 'checksum' attribute, so
+    a checksummed file that has lost its checksums fails verification.
+
+    A retention policy (keep_last, keep_every, max_bytes) evicts old checkpoint
+    sets after each write, but only sets older than the newest set that every
+    process has completely written (and, if staging, drained), and, with
+    checksums, only once that set's checksums have been verified.
+
+    Given the expected mean time between failures (mtbf), each write is timed
+    (the slowest process sets the cost; with async_write, only the blocking
+    copy counts), and after each write the handler switches to the wall-clock
+    cadence which minimizes the expected lost time, from optimal_interval().
+    The initial cadence (e.g., sim_dt) only sets when the first cost is measured.
+    """
+    def __init__(self, *args, flush_handlers=[], async_write=False, keep_last=None, keep_every=None, max_bytes=None,
+                 compression=None, compression_opts=None, checksum=False, mtbf=None, **kwargs):
+        """
+        Parameters
+        ----------
+        flush_handlers : list, optional
+            Handlers with a flush() method to flush, or a save_state() method to call, before each write.
+        async_write : bool, optional
+            If True, write checkpoints asynchronously from double buffers (requires max_writes=1).
+        keep_last, keep_every, max_bytes : optional
+            Retention policy; see select_evictions()
+        compression : string, optional
+            HDF5 compression filter for task datasets, 'gzip' or 'lzf'
+        compression_opts : int, optional
+            Compression level for gzip
+        checksum : bool, optional
+            If True, store fletcher32 and CRC-32 checksums of the task data
+        mtbf : float, optional
+            Expected mean time between failures (wall seconds); if given, set the
+            cadence from the measured write cost
+        *args, **kwargs : Additional arguments for the StagedFileHandler
+        """
+        self.compression = compression
+        self.compression_opts = compression_opts
+        self.checksum = checksum
+        super(CheckpointHandler, self).__init__(*args, **kwargs)
+        self.flush_handlers = flush_handlers
+        self.async_write = async_write
+        self.retention = {'keep_last' : keep_last, 'keep_every' : keep_every, 'max_bytes' : max_bytes}
+        self.completed_sets = set()
+        self.verified_sets = set()
+        self.mtbf = mtbf
+        self.write_costs = []
+        if async_write:
+            if self.parallel or self.max_writes != 1:
+                raise ValueError("Asynchronous checkpoints are only implemented for per-process files with max_writes=1")
+            self.writer = DoubleBufferedWriter(self._write_buffer)
+            # Each write starts a new set; number them after any existing sets.
+            comm = self.domain.dist.comm_cart
+            next_set = None
+            if comm.rank == 0:
+                set_nums = [int(p.stem.split('_s')[-1]) for p in self.base_path.glob('{:s}_s*'.format(self.base_path.stem))]
+                if self.stage_path is not None:
+                    set_nums += [int(p.stem.split('_s')[-1]) for p in self.stage_path.glob('{:s}_s*'.format(self.base_path.stem))]
+                next_set = max(set_nums) + 1 if len(set_nums) > 0 else 1
+            self.next_set = comm.bcast(next_set, root=0)
+
+    def process(self, **kw):
+        for handler in self.flush_handlers:
+            if hasattr(handler, 'flush'):
+                handler.flush()
+            if hasattr(handler, 'save_state'):
+                handler.save_state(kw.get('sim_time', 0))
+        start = time.time()
+        if self.async_write:
+            self._process_async(**kw)
+        else:
+            super(CheckpointHandler, self).process(**kw)
+        if any([v is not None for v in self.retention.values()]):
+            self.apply_retention()
+        if self.mtbf is not None:
+            self.update_interval(time.time() - start, kw.get('wall_time', 0))
+
+    def update_interval(self, elapsed, wall_time):
+        """ Record the cost of a write (collective), and set the wall-clock cadence from the mean cost """
+        cost = self.domain.dist.comm_cart.allreduce(elapsed, op=MPI.MAX)
+        self.write_costs.append(cost)
+        mean_cost = np.mean(self.write_costs)
+        interval = optimal_interval(mean_cost, self.mtbf)
+        if not np.isclose(interval, self.wall_dt):
+            checkpoint_fraction, lost_fraction = expected_overhead(interval, mean_cost, self.mtbf)
+            logger.info('checkpoint cost {:.3g} s, MTBF {:.3g} s: writing every {:.3g} s of wall time'.format(mean_cost, self.mtbf, interval))
+            logger.info('expected overhead {:.2%} writing checkpoints + {:.2%} lost work after failures'.format(checkpoint_fraction, lost_fraction))
+        self.wall_dt = interval
+        self.last_wall_div = wall_time // interval
+        self.sim_dt = self.iter = np.inf
+
+    def setup_file(self, file):
+        """ Set up a new file, with compressed and/or checksummed task datasets """
+        super(CheckpointHandler, self).setup_file(file)
+        if self.compression is None and not self.checksum:
+            return
+        file.attrs['checksum'] = self.checksum
+        tasks = file['tasks']
+        for name in list(tasks.keys()):
+            old = tasks[name]
+            new = tasks.create_dataset('{:s}_filtered'.format(name), shape=old.shape, maxshape=old.maxshape, dtype=old.dtype,
+                                       chunks=True, compression=self.compression, compression_opts=self.compression_opts,
+                                       shuffle=self.compression is not None, fletcher32=self.checksum)
+            for k, v in old.attrs.items():
+                if k in ['DIMENSION_LIST']: continue
+                new.attrs[k] = v
+            for i, dim in enumerate(old.dims):
+                new.dims[i].label = dim.label
+                for scale in list(dim.values()):
+                    new.dims[i].attach_scale(scale)
+                    old.dims[i].detach_scale(scale)
+            del tasks[name]
+            tasks.move('{:s}_filtered'.format(name), name)
+
+    def finalize_write(self):
+        """ Record the CRC-32 of each task's data for the write just made """
+        self.completed_sets.add(self.set_num)
+        if not self.checksum:
+            return
+        crcs = {}
+        for task in self.tasks:
+            out = task['out']
+            constant = np.array(task['operator'].meta[:]['constant'], dtype=bool)
+            count = write_count(out.layout, task['scales'], constant)
+            crcs[task['name']] = crc32(out.data[tuple(slice(int(c)) for c in count)])
+        with h5py.File(str(self.current_path), 'r+') as file:
+            add_checksums(file, crcs, self.file_write_num - 1)
+
+    def apply_retention(self):
+        """ Evict checkpoint sets according to the retention policy (collective) """
+        comm = self.domain.dist.comm_cart
+        safe = [n for n in list(self.completed_sets) if self.drainer is None or n in self.drainer.drained]
+        newest = comm.allreduce(max(safe) if len(safe) > 0 else 0, op=MPI.MIN)
+        if newest == 0 or comm.rank != 0:
+            return
+        set_paths = OrderedDict()
+        for path in self.base_path.glob('{:s}_s*'.format(self.base_path.stem)):
+            set_paths.setdefault(int(path.stem.split('_s')[-1]), []).append(path)
+        if self.checksum and newest not in self.verified_sets:
+            try:
+                n_checked = 0
+                for path in set_paths.get(newest, []):
+                    if path.is_dir():
+                        n_checked += sum(verify_checksums(f) for f in path.glob('{:s}_p*.h5'.format(path.stem)))
+                    elif not path.with_suffix('').is_dir():
+                        n_checked += verify_checksums(path)
+            except (OSError, ValueError) as e:
+                logger.error('not evicting checkpoint sets: set {} failed verification: {}'.format(newest, e))
+                return
+            logger.debug('verified {} checksums of checkpoint set {}'.format(n_checked, newest))
+            self.verified_sets.add(newest)
+        sets = OrderedDict()
+        for n in sorted(set_paths.keys()):
+            sets[n] = {'sim_time' : set_time(set_paths[n]), 'bytes' : set_bytes(set_paths[n])}
+        for n in select_evictions(sets, newest, **self.retention):
+            logger.info('evicting checkpoint set {} (sim_time {:.3e})'.format(n, sets[n]['sim_time']))
+            for path in set_paths[n]:
+                if path.is_dir():
+                    shutil.rmtree(str(path))
+                else:
+                    path.unlink()
+
+    def _process_async(self, **kw):
+        """ Copy the checkpoint into a free buffer, and queue it to be written """
+        data = OrderedDict()
+        for task in self.tasks:
+            out = task['out']
+            out.set_scales(task['scales'], keep_data=True)
+            out.require_layout(task['layout'])
+            constant = np.array(task['operator'].meta[:]['constant'], dtype=bool)
+            count = write_count(out.layout, task['scales'], constant)
+            data[task['name']] = out.data[tuple(slice(int(c)) for c in count)]
+
+        self.set_num = self.next_set
+        self.next_set += 1
+        self.total_write_num += 1
+        scales = {k : kw.get(k, 0) for k in TIME_SCALES}
+        scales['write_number'] = self.total_write_num
+        self.writer.copy(data, self.set_num, self.current_path, scales)
+
+    def _write_buffer(self, buffer, set_num, path, scales):
+        """ Write a buffered checkpoint to its own per-process file (writer thread; no MPI calls) """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with h5py.File(str(path), 'w') as file:
+            self.setup_file(file)
+            file.attrs['set_number'] = set_num
+            file.attrs['complete'] = False
+            file.flush()
+            for k, v in scales.items():
+                if k not in file['scales']: continue
+                file['scales'][k].resize(1, axis=0)
+                file['scales'][k][0] = v
+            for name, data in buffer.items():
+                dset = file['tasks'][name]
+                dset.resize(1, axis=0)
+                dset[0] = data
+            file.attrs['writes'] = 1
+            if self.checksum:
+                add_checksums(file, {name : crc32(data) for name, data in buffer.items()}, 0)
+            file.flush()
+            file.attrs['complete'] = True
+        self.completed_sets.add(set_num)
+        logger.debug('wrote checkpoint {}'.format(path))
+        if self.drainer is not None:
+            self.drainer.drain([set_num])
+
+    def wait(self):
+        """ Wait for all queued asynchronous checkpoint writes to finish """
+        if self.async_write:
+            self.writer.wait()
+
+    def finish_drain(self):
+        """ Finish asynchronous writes, then drain any staged sets """
+        self.wait()
+        super(CheckpointHandler, self).finish_drain()
+
+class LocalCheckpointHandler(ProcessFileHandler):
+    """
+    The frequent, cheap level of a multi-level checkpoint scheme.  Each process
+    writes its local state to its own file on node-local storage,
+
+        local_dir/base/base_sN/base_sN_pR.h5,
+
+    starting a new set with each write and keeping only the last keep_last sets
+    (at least 2, so that one set is complete on every process even if a process
+    fails mid-write).  With partner=True, each process also sends its state to
+    a partner process on another node, which writes it to
+
+        local_dir/base_partner/base_partner_sN/base_partner_sN_pR.h5,
+
+    where R is the rank of the process the state belongs to, so that a set
+    survives the loss of any one node.  The partner is a fixed rank shift,
+    the smallest one that puts every partner on another node.
+
+    Local sets can only be restarted with the same process mesh; see
+    newest_local_set() and load_local_set().
+
+    Attributes:
+    -----------
+    keep_last : int
+        Number of sets to keep
+    partner : int
+        Rank that receives this process' state (None if no partner copies)
+    partner_path : pathlib Path
+        Directory of the partner copies held by this process
+    partner_pieces : OrderedDict
+        The last state received from partner_source, whose buffers are reused
+    partner_source : int
+        Rank whose state this process holds (None if no partner copies)
+    """
+
+    def __init__(self, base_path, domain, vars, keep_last=2, partner=False, mode='overwrite', **kw):
+        """
+        Initialize the handler.
+
+        Parameters
+        ----------
+        base_path : string or pathlib Path
+            The node-local directory of the checkpoint level
+        domain : Dedalus Domain object
+            The domain of the simulation
+        vars : dict
+            Variables for parsing task strings (e.g., solver.evaluator.vars)
+        keep_last : int, optional
+            As in class-level docstring
+        partner : bool, optional
+            If True, keep a copy of each process' state on a partner process
+        mode : string, optional
+            "overwrite" clears the node-local directories; "append" keeps their
+            sets and numbers new sets after them.
+        **kw : Additional keyword arguments (e.g., wall_dt) for the Dedalus Handler
+        """
+        super(LocalCheckpointHandler, self).__init__(base_path, domain, vars, max_writes=1, mode=mode, **kw)
+        self.keep_last = max(2, keep_last)
+        self.partner = self.partner_source = None
+        self.partner_pieces = None
+        if partner and self.comm.size > 1:
+            shift = partner_shift(self.comm.allgather(MPI.Get_processor_name()))
+            self.partner = (self.comm.rank + shift) % self.comm.size
+            self.partner_source = (self.comm.rank - shift) % self.comm.size
+
+    def setup_base_path(self, mode):
+        """
+        Create (or, in "overwrite" mode, clear) the node-local directories of the
+        level and its partner copies, and return the first unused set number (collective).
+        """
+        self.partner_path = self.base_path.parent.joinpath('{:s}_partner'.format(self.base_path.stem))
+        # Node-local directories are only seen by the processes on each node,
+        # so the first process of each node sets them up.
+        node_comm = self.comm.Split_type(MPI.COMM_TYPE_SHARED)
+        for path in [self.base_path, self.partner_path]:
+            setup_base_path(path, node_comm, mode)
+        node_comm.Free()
+        own_sets, held_sets = local_sets(self.base_path, self.partner_path, self.comm.rank)
+        set_nums = list(own_sets.keys()) + [n for n, r, p in held_sets]
+        return self.comm.allreduce(max(set_nums) if len(set_nums) > 0 else 0, op=MPI.MAX) + 1
+
+    def process(self, **kw):
+        """ Write a new local set, exchange partner copies (collective), and evict old sets """
+        if self.total_write_num > 0:
+            self.set_num += 1
+        self.total_write_num += 1
+        self.file_write_num = 1
+        pieces = self.get_pieces()
+        self.write(pieces, **kw)
+        if self.partner is not None:
+            self.partner_pieces = exchange_pieces(self.comm, pieces, self.partner, self.partner_source,
+                                                  received=self.partner_pieces)
+            self.write(self.partner_pieces, path=set_file_path(self.partner_path, self.set_num, self.partner_source), rank=self.partner_source, **kw)
+        own_sets, held_sets = local_sets(self.base_path, self.partner_path, self.comm.rank)
+        for n, path in own_sets.items():
+            if n <= self.set_num - self.keep_last:
+                remove_set_file(path)
+        for n, r, path in held_sets:
+            if n <= self.set_num - self.keep_last:
+                remove_set_file(path)
+
+    def setup_file(self, file, pieces):
+        """ Set up a new file, which is marked incomplete until its write has finished """
+        super(LocalCheckpointHandler, self).setup_file(file, pieces)
+        file.attrs['complete'] = False
+
+    def write(self, pieces, path=None, rank=None, **kw):
+        """ Write the pieces of a process' state (by default this process), and mark the file complete """
+        if path is None:
+            path = self.current_path
+        if rank is not None:
+            # Mark partner copies with the process that holds them
+            path.parent.mkdir(parents=True, exist_ok=True)
+            with h5py.File(str(path), 'w') as file:
+                file.attrs['holder'] = self.comm.rank
+        super(LocalCheckpointHandler, self).write(pieces, path=path, **kw)
+        with h5py.File(str(path), 'r+') as file:
+            if rank is not None:
+                file.attrs['mpi_rank'] = rank
+            file.attrs['complete'] = True
+
 class Checkpoint:
     """Simple checkpointing."""
-    def __init__(self, data_dir, checkpoint_name="checkpoint", excluded_dirs=[], layout = 'c'):
+    def __init__(self, data_dir, checkpoint_name="checkpoint", excluded_dirs=[], layout = 'c',
+                 keep_last=None, keep_every=None, max_bytes=None, local_dir=None, partner=False):
         """Initialize checkpoint save file.  
         
 
@@ -27,6 +409,16 @@ class Checkpoint:
             If there are directories OTHER than dedalus output directories in the specified data_dir, checkpointing
                 will crash on initialization.  This is a full list of directories to be EXCLUDED 
                 from checkpointing. 
+        keep_last : int, optional
+            Retention policy: keep only the last keep_last checkpoint sets
+        keep_every : float, optional
+            Retention policy: also keep one checkpoint set per keep_every sim time units
+        max_bytes : float, optional
+            Retention policy: evict the oldest checkpoint sets to stay under this many bytes
+        local_dir : str, optional
+            Node-local directory for a frequent checkpoint level (see set_local_checkpoint())
+        partner : bool, optional
+            If True, the local level also keeps a copy of each process' state on a partner node
         """ 
 
         self.data_dir = pathlib.Path(data_dir)
@@ -34,12 +426,19 @@ class Checkpoint:
         self.excluded_dirs = excluded_dirs
         self.checkpoint_dir = self.data_dir.joinpath(self.name)
         self.layout = layout
+        self.flush_handlers = []
+        self.retention = {'keep_last' : keep_last, 'keep_every' : keep_every, 'max_bytes' : max_bytes}
+        self.local_path = None
+        if local_dir is not None:
+            self.local_path = pathlib.Path(local_dir).resolve().joinpath('{:s}_local'.format(self.name))
+        self.partner = partner
 
         # this should be set via some kind of global option
         self.set_re = re.compile("[\w]*_s([0-9]+)")
 
     def set_checkpoint(self, solver, wall_dt=np.inf, sim_dt=np.inf, iter=np.inf,
-                                     parallel=False, mode="append"):
+                                     parallel=False, mode="append", stage_dir=None, async_write=False,
+                                     compression=None, compression_opts=None, checksum=False, mtbf=None):
         """
 
         Parameters
@@ -56,24 +455,93 @@ class Checkpoint:
             If "overwrite", checkpoints will always write checkpoint file 1.  If
             "append," new checkpoints will be created but old checkpoints will
             not be erased
+        stage_dir : string, optional
+            If not None, write checkpoints to this node-local directory and drain them to data_dir in the background
+        async_write : bool, optional
+            If True, copy checkpoints into memory and write them in a background thread (see CheckpointHandler)
+        compression : string, optional
+            Lossless compression of checkpoint data, 'gzip' or 'lzf'
+        compression_opts : int, optional
+            gzip compression level
+        checksum : bool, optional
+            If True, write checksums of the checkpoint data, which restart() verifies
+        mtbf : float, optional
+            Expected mean time between failures (wall seconds).  If given, checkpoints
+            are written at the cost-optimal wall time interval once the first one has
+            been timed (see CheckpointHandler).
         """
 
-        self.checkpoint = solver.evaluator.add_file_handler(self.checkpoint_dir,
-                                                            wall_dt=wall_dt,
-                                                            sim_dt=sim_dt,
-                                                            iter=iter,max_writes=1,
-                                                            parallel=parallel,
-                                                            mode=mode)
+        self.checkpoint = CheckpointHandler(self.checkpoint_dir, solver.domain, solver.evaluator.vars,
+                                            flush_handlers=self.flush_handlers,
+                                            wall_dt=wall_dt,
+                                            sim_dt=sim_dt,
+                                            iter=iter,max_writes=1,
+                                            parallel=parallel,
+                                            mode=mode,
+                                            stage_dir=stage_dir,
+                                            async_write=async_write,
+                                            compression=compression,
+                                            compression_opts=compression_opts,
+                                            checksum=checksum,
+                                            mtbf=mtbf,
+                                            **self.retention)
+        solver.evaluator.add_handler(self.checkpoint)
         self.checkpoint.add_system(solver.state, layout = self.layout)
 
+    def set_local_checkpoint(self, solver, wall_dt=np.inf, sim_dt=np.inf, iter=np.inf, mode="append", keep_last=2):
+        """
+        Add the frequent, node-local checkpoint level (see LocalCheckpointHandler).
+
+        Parameters
+        ----------
+        wall_dt, sim_dt, iter : optional
+            Cadences of the local level, as in set_checkpoint()
+        mode : string, optional
+            If "overwrite", remove existing local sets; if "append", keep them
+        keep_last : int, optional
+            Number of local sets to keep
+        """
+        if self.local_path is None:
+            raise ValueError("Checkpoint was initialized without a local_dir")
+        self.local_checkpoint = LocalCheckpointHandler(self.local_path, solver.domain, solver.evaluator.vars,
+                                                       keep_last=keep_last,
+                                                       partner=self.partner,
+                                                       mode=mode,
+                                                       wall_dt=wall_dt,
+                                                       sim_dt=sim_dt,
+                                                       iter=iter)
+        solver.evaluator.add_handler(self.local_checkpoint)
+        self.local_checkpoint.add_system(solver.state, layout = self.layout)
+
+    def add_flush_handlers(self, handlers):
+        """
+        Register buffered output handlers to be flushed, and handlers with in-memory
+        state to save their state, before each checkpoint write.
+
+        Parameters
+        ----------
+        handlers : list
+            Handlers with a flush() method (e.g., logic.handlers.BufferedFileHandler objects)
+            or a save_state(sim_time) method (e.g., logic.handlers.TimeAverageHandler objects)
+        """
+        for handler in handlers:
+            if hasattr(handler, 'flush') or hasattr(handler, 'save_state'):
+                self.flush_handlers.append(handler)
+
     def restart(self, checkpoint_file, solver, cp_record=-1):
         """Restart from checkpoint save file.  
 
-        This file must, at present, be a single unified HDF5 file
-        (e.g., if parallel=False on write-out, the data must be joined
-        before restart).
+        This can be a single unified HDF5 file (e.g., checkpoint_s1.h5), or
+        an unmerged per-process set folder (e.g., checkpoint_s1/), in which
+        case each process reads only the pieces of the per-process files that
+        overlap its local data, even if the process mesh has changed.
+
+        If checkpoint_file is "latest", restart from the newest consistent
+        checkpoint level (see restart_latest()).
 
         """ 
+        if str(checkpoint_file) == 'latest':
+            return self.restart_latest(solver, cp_record)
         logger.info(checkpoint_file)
         f = pathlib.Path(checkpoint_file)
         stem = f.stem
@@ -83,6 +551,145 @@ class Checkpoint:
         except:
             raise FileNotFoundError("Output filename not as expected.")
             
-        write, dt = solver.load_state(checkpoint_file, cp_record)
+        if f.is_dir():
+            write, dt = load_process_set(solver, f, cp_record)
+        else:
+            with h5py.File(str(f), 'r') as cp_file:
+                if not cp_file.attrs.get('complete', True):
+                    raise ValueError("Checkpoint {} was not completely written".format(f))
+            n_checked = verify_checksums(f, cp_record)
+            logger.info("Verified {} checksums in {}".format(n_checked, f))
+            write, dt = load_hyperslabs(solver, f, cp_record)
 
         return dt
+
+    def restart_latest(self, solver, cp_record=-1):
+        """
+        Restart from the newest consistent checkpoint: the newest node-local set
+        in which every process' state is available (its own file or a partner
+        copy), or the newest complete set on the shared filesystem, whichever
+        has the later sim_time.
+        """
+        comm = solver.domain.dist.comm_cart
+        shared_path, shared_time = newest_shared_set(self.checkpoint_dir, comm)
+        local_set, local_time, holders = None, None, {}
+        if self.local_path is not None:
+            partner_path = self.local_path.parent.joinpath('{:s}_partner'.format(self.local_path.stem))
+            local_set, local_time, holders = newest_local_set(self.local_path, partner_path, comm)
+        if local_set is not None and (shared_path is None or local_time > shared_time):
+            logger.info("restarting from node-local checkpoint set {} (sim_time {:.3e}; shared: {})".format(local_set, local_time, shared_path))
+            write, dt = load_local_set(solver, self.local_path, partner_path, local_set, holders, comm=comm)
+            return dt
+        if shared_path is None:
+            raise FileNotFoundError("No complete checkpoint found in {}".format(self.checkpoint_dir))
+        logger.info("restarting from shared checkpoint {} (sim_time {:.3e})".format(shared_path, shared_time))
+        return self.restart(shared_path, solver, cp_record)
+
+def checkpoint_from_args(args, data_dir, **kwargs):
+    """
+    The Checkpoint of a driver, with the retention policy and node-local level of its parsed CHECKPOINT_OPTIONS.
+
+    Parameters
+    ----------
+    args : dict
+        The driver's docopt arguments
+    data_dir : str
+        Base directory for storing checkpoints
+    **kwargs : Additional keyword arguments for Checkpoint()
+
+    Returns
+    -------
+    checkpoint : Checkpoint
+    """
+    keep_last, keep_every, max_bytes = args['--keep_checkpoints'], args['--keep_checkpoint_every'], args['--checkpoint_GB']
+    if keep_last is not None:  keep_last = int(keep_last)
+    if keep_every is not None: keep_every = float(keep_every)
+    if max_bytes is not None:  max_bytes = float(max_bytes)*1e9
+    return Checkpoint(data_dir, keep_last=keep_last, keep_every=keep_every, max_bytes=max_bytes,
+                      local_dir=args['--local_checkpoint_dir'], partner=args['--partner_checkpoint'], **kwargs)
+
+def set_checkpoint_from_args(args, checkpoint, solver, mode, **kwargs):
+    """
+    Add the checkpoint handlers of a driver's parsed CHECKPOINT_OPTIONS to its solver:
+    the shared level and, if --local_checkpoint_dir was given, the node-local level.
+
+    Parameters
+    ----------
+    args : dict
+        The driver's docopt arguments, which must include OUTPUT_OPTIONS (for --stage_dir)
+    checkpoint : Checkpoint
+        The driver's checkpoint
+    solver : dedalus solver
+        The solver to checkpoint
+    mode : string
+        File mode, "overwrite" or "append"
+    **kwargs : Additional keyword arguments for Checkpoint.set_checkpoint() (e.g., sim_dt)
+    """
+    mtbf = args['--checkpoint_MTBF']
+    if mtbf is not None:
+        mtbf = float(mtbf)*3600
+    checkpoint.set_checkpoint(solver, mode=mode, stage_dir=args['--stage_dir'],
+                              async_write=args['--async_checkpoint'], compression=args['--checkpoint_compression'],
+                              checksum=args['--checkpoint_checksum'], mtbf=mtbf, **kwargs)
+    if args['--local_checkpoint_dir'] is not None:
+        checkpoint.set_local_checkpoint(solver, wall_dt=float(args['--local_checkpoint_wall'])*60, mode=mode)
+
+def load_local_set(solver, base_path, partner_path, set_num, holders, comm=None):
+    """
+    Load the solver state from a node-local checkpoint set (collective).  Each
+    process reads its own file; the state of processes without one is read
+    from its partner copy and sent to them.  The process mesh must match the
+    one the set was written with.
+
+    Parameters
+    ----------
+    solver : Dedalus IVP solver
+        The solver whose state is loaded
+    base_path, partner_path : pathlib Paths
+        The node-local directories of the level and of its partner copies
+    set_num : int
+        The set to load
+    holders : dict
+        For each rank without its own file, the rank holding its copy, from newest_local_set()
+    comm : mpi4py Comm, optional
+        The communicator of the solver's domain (default: domain.dist.comm_cart)
+
+    Returns
+    -------
+    write_num : int
+        The write number of the loaded state
+    dt : float
+        The timestep of the loaded state
+    """
+    domain = solver.domain
+    if comm is None:
+        comm = domain.dist.comm_cart
+    header, pieces = None, None
+    if comm.rank not in holders:
+        header, pieces = read_local_file(set_file_path(base_path, set_num, comm.rank))
+    for r in sorted(holders.keys()):
+        if comm.rank == holders[r]:
+            comm.send(read_local_file(set_file_path(partner_path, set_num, r)), dest=r)
+        elif comm.rank == r:
+            header, pieces = comm.recv(source=holders[r])
+    if len(holders) > 0:
+        logger.info("Recovered {} process states from partner copies".format(len(holders)))
+
+    layouts = {}
+    matches = True
+    for field in solver.state.fields:
+        piece = pieces[field.name]
+        layout, scales = match_layout(domain, piece['grid_space'], piece['global_shape'])
+        matches &= np.array_equal(layout.start(scales), piece['start'])
+        matches &= np.array_equal(layout.local_shape(scales), piece['count'])
+        layouts[field.name] = (layout, scales)
+    if not comm.allreduce(bool(matches), op=MPI.LAND):
+        raise ValueError("Node-local checkpoint set {} was written with a different process mesh".format(set_num))
+
+    set_solver_time(solver, header)
+    for field in solver.state.fields:
+        layout, scales = layouts[field.name]
+        field.set_scales(scales, keep_data=False)
+        field[layout] = pieces[field.name]['data']
+        field.set_scales(domain.dealias, keep_data=True)
+    return header['write_num'], header['dt']
@@ -6,10 +6,45 @@ from collections import OrderedDict
 
 
 
+def pencil_noise(global_shape, slices, seed=42):
+    """
+    Draw the local piece of a global grid of standard normal noise, pencil by
+    pencil along the first axis (which is local in grid space).  Each pencil
+    is drawn from its own Philox stream, keyed by the seed, whose counter
+    starts at the pencil's global index: [0, 0, 0, iz] in 2D, and
+    [0, 0, iy, iz] in 3D, with counter word 0 the least significant.  Streams
+    of neighboring pencils are therefore at least 2**128 counters (2**130
+    64-bit draws) apart, and never overlap.  The same noise is drawn on any
+    number of processes, with only the local data drawn and in memory.
+
+    Parameters
+    ----------
+    global_shape : tuple of ints
+        The global grid shape
+    slices      : tuple of slices
+        The local slices of the global grid
+    seed        : int, optional
+        The key of the Philox streams
+
+    Returns
+    -------
+    noise       : NumPy array
+        The local noise
+    """
+    noise = np.zeros(tuple(sl.stop - sl.start for sl in slices))
+    for index in np.ndindex(*noise.shape[1:]):
+        pencil = [int(sl.start + i) for sl, i in zip(slices[1:], index)]
+        rand = np.random.Generator(np.random.Philox(counter=[0]*(4-len(pencil)) + pencil, key=seed))
+        noise[(slice(None),) + index] = rand.standard_normal(global_shape[0])[slices[0]]
+    return noise
+
 def global_noise(domain, seed=42, **kwargs):
     """
     Create a field fielled with random noise of order 1.  Modify seed to
-    get varying noise, keep seed the same to directly compare runs.
+    get varying noise, keep seed the same to directly compare runs.  The
+    noise is drawn with pencil_noise(), so it is the same on any process
+    mesh; for a given seed, it differs from the noise of earlier versions,
+    which drew the global grid from np.random.RandomState(seed).
 
     Parameters
     ----------
@@ -18,13 +53,12 @@ def global_noise(domain, seed=42, **kwargs):
     seed        : int, optional
         The seed used in determining the random noise field
     kwargs      : dict, optional
-        Additional keyword arguments for the filter_field() function
+        Additional keyword arguments for the filter_field() function (e.g., frac, shape)
     """
-    # Random perturbations, initialized globally for same results in parallel
+    # Random perturbations, drawn locally for the same results in parallel
     gshape = domain.dist.grid_layout.global_shape(scales=domain.dealias)
     slices = domain.dist.grid_layout.slices(scales=domain.dealias)
-    rand = np.random.RandomState(seed=seed)
-    noise = rand.standard_normal(gshape)[slices]
+    noise = pencil_noise(gshape, slices, seed=seed)
 
     # filter in k-space
     noise_field = domain.new_field()
@@ -34,26 +68,81 @@ def global_noise(domain, seed=42, **kwargs):
 
     return noise_field
 
-def filter_field(field, frac=0.25):
+def spectral_mask(domain, frac=0.25, shape='box', alpha=36, order=8):
+    """
+    Build a filter mask for the local coefficient-space data of a domain.
+    Modes are measured by their normalized mode number along each axis, from 0
+    to 1: |kx|/max(|kx|) (and |ky|/max(|ky|)) for the horizontal Fourier bases,
+    and n/(N-1) for the Chebyshev index n along z.
+
+    Parameters
+    ----------
+    domain  : A Dedalus Domain object
+        Contains information about the simulation domain
+    frac    : float or tuple, optional
+        The cutoff normalized mode number; a tuple sets a cutoff for each axis.
+    shape   : string, optional
+        'box' keeps modes below the cutoff along every axis (like filtering by
+        reducing the field's scales); 'ellipsoid' keeps modes inside the
+        ellipsoid with the cutoffs as semi-axes (a sphere for a float frac);
+        'exponential' keeps modes below the cutoffs and smoothly tapers those
+        above them, by exp(-alpha*((k - frac)/(1 - frac))**order) along each axis.
+    alpha   : float, optional
+        Strength of the exponential taper (the highest mode is multiplied by exp(-alpha))
+    order   : int, optional
+        Order of the exponential taper
+
+    Returns
+    -------
+    mask    : NumPy array
+        Mask to multiply the local coefficient data by
+    """
+    layout = domain.dist.coeff_layout
+    slices = layout.slices(scales=1)
+    global_shape = layout.global_shape(scales=1)
+    fracs = np.array(frac, dtype=np.float64, ndmin=1)*np.ones(domain.dim)
+    mask = np.ones(layout.local_shape(scales=1))
+    radius_sq = 0
+    for axis, basis in enumerate(domain.bases):
+        if axis < domain.dim-1:
+            modes = np.abs(basis.wavenumbers)
+        else:
+            modes = np.arange(global_shape[axis], dtype=np.float64)
+        modes = modes/max(np.max(modes), 1e-16)
+        modes = modes[slices[axis]].reshape([-1 if i == axis else 1 for i in range(domain.dim)])
+        if shape == 'box':
+            mask = mask*(modes < fracs[axis])
+        elif shape == 'ellipsoid':
+            radius_sq = radius_sq + (modes/fracs[axis])**2
+        elif shape == 'exponential':
+            eta = np.clip((modes - fracs[axis])/(1 - fracs[axis]), 0, None)
+            mask = mask*np.exp(-alpha*eta**order)
+        else:
+            raise ValueError("Unknown filter shape {}".format(shape))
+    if shape == 'ellipsoid':
+        mask = mask*(radius_sq < 1)
+    return mask
+
+def filter_field(field, frac=0.25, shape='box', **kwargs):
     """
-    Filter a field in coefficient space by cutting off all coefficient above
-    a given threshold.  This is accomplished by reducing the scale of the field,
-    and then forcing the field into coefficient and then grid space.
+    Filter a field in coefficient space by multiplying its coefficients, in
+    place, by a spectral_mask().  The field is left in coefficient space; no
+    change of scales or transform back to grid space is needed.
 
     Parameters
     ----------
     field   : a Field object from the Dedalus package
         The field to filter
-    frac    : float, optional
-        A number between 0 and 1, the fraction of coefficients to keep power in.
+    frac    : float or tuple, optional
+        The cutoff normalized mode number (see spectral_mask())
+    shape   : string, optional
+        'box', 'ellipsoid', or 'exponential' (see spectral_mask())
+    kwargs  : dict, optional
+        Additional keyword arguments for the spectral_mask() function
     """
-    dom = field.domain
-    logger.info("filtering field {} with frac={} using a set-scales approach".format(field.name,frac))
-    orig_scale = field.scales
-    field.set_scales(frac, keep_data=True)
-    field['c']
-    field['g']
-    field.set_scales(orig_scale, keep_data=True)
+    logger.info("filtering field {} with frac={} using a {} spectral mask".format(field.name, frac, shape))
+    field.require_coeff_space()
+    field.data *= spectral_mask(field.domain, frac=frac, shape=shape, **kwargs)
 
 def mpi_makedirs(data_dir):
     """Create a directory in an MPI-safe way.
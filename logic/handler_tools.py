@@ -0,0 +1,394 @@
+"""
+Tools for the custom output handlers of logic.handlers which only need NumPy
+and h5py: capturing evaluated handler output in memory and writing it to file
+later as a single block, saving and restoring the running sums of time
+averages, draining staged set files to shared storage, and the index
+arithmetic of windowed, probe, and mode output.
+"""
+import logging
+import queue
+import shutil
+import threading
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__.split('.')[-1])
+
+TIME_SCALES = ['sim_time', 'world_time', 'wall_time', 'timestep', 'iteration']
+
+
+def write_count(layout, scales, constant):
+    """
+    The local shape of the nonconstant part of a field's data; this is what
+    a per-process Dedalus file stores for each write.
+
+    Parameters
+    ----------
+    layout : Dedalus Layout object
+        The layout of the field data
+    scales : tuple
+        The scales of the field data
+    constant : NumPy array of bools
+        True along axes where the field is constant
+    """
+    count = np.array(layout.local_shape(scales))
+    first = (np.array(layout.start(scales)) == 0)
+    count[constant & first] = 1
+    count[constant & ~first] = 0
+    return count
+
+def capture_write(handler, **kw):
+    """
+    Copy the evaluated output of a handler's tasks (and the current time scales)
+    into memory, exactly as handler.process() would have written them.
+
+    Parameters
+    ----------
+    handler : Dedalus FileHandler
+        A per-process (parallel=False) file handler whose tasks have just been evaluated
+    **kw : The keyword arguments (sim_time, wall_time, etc.) passed to handler.process()
+
+    Returns
+    -------
+    record : OrderedDict
+        The time scales of the write and, in record['tasks'], copies of the task data
+    """
+    record = OrderedDict()
+    for k in TIME_SCALES:
+        record[k] = kw.get(k, 0)
+    record['tasks'] = OrderedDict()
+    for task in handler.tasks:
+        out = task['out']
+        out.set_scales(task['scales'], keep_data=True)
+        out.require_layout(task['layout'])
+        constant = np.array(task['operator'].meta[:]['constant'], dtype=bool)
+        count = write_count(out.layout, task['scales'], constant)
+        record['tasks'][task['name']] = np.copy(out.data[tuple(slice(int(c)) for c in count)])
+    return record
+
+def write_records(handler, records):
+    """
+    Write captured records to a per-process file handler's output sets,
+    one block of writes per set file.
+
+    Parameters
+    ----------
+    handler : Dedalus FileHandler
+        The (parallel=False) file handler that the records were captured from
+    records : list
+        Records returned by capture_write(), in time order.
+    """
+    records = list(records)
+    while len(records) > 0:
+        file = handler.get_file()
+        index = handler.file_write_num
+        n_writes = int(min(len(records), handler.max_writes - index))
+        block, records = records[:n_writes], records[n_writes:]
+
+        scales = file['scales']
+        for k in TIME_SCALES:
+            if k not in scales: continue
+            scales[k].resize(index+n_writes, axis=0)
+            scales[k][index:index+n_writes] = [r[k] for r in block]
+        scales['write_number'].resize(index+n_writes, axis=0)
+        scales['write_number'][index:index+n_writes] = handler.total_write_num + 1 + np.arange(n_writes)
+
+        for task in handler.tasks:
+            dset = file['tasks'][task['name']]
+            dset.resize(index+n_writes, axis=0)
+            dset[index:index+n_writes] = np.stack([r['tasks'][task['name']] for r in block])
+
+        handler.total_write_num += n_writes
+        handler.file_write_num += n_writes
+        file.attrs['writes'] = handler.file_write_num
+        file.close()
+
+def intersect_window(window, local):
+    """
+    Intersect a strided output window along one axis with the index range held by a process.
+
+    Parameters
+    ----------
+    window : slice
+        Global (start, stop, step) window of grid indices along the axis
+    local : slice
+        Global index range (with step 1) of the process' data along the axis
+
+    Returns
+    -------
+    size : int
+        Length of the full window
+    start : int
+        Window index of the first windowed point on this process (0 if there are none)
+    count : int
+        Number of windowed points on this process
+    data_slice : slice
+        The windowed points in the process' local data
+    """
+    w_start, w_stop, w_step = window.start, window.stop, window.step
+    size = len(range(w_start, w_stop, w_step))
+    # First windowed index on this process
+    lo, hi = max(w_start, local.start), min(w_stop, local.stop)
+    first = w_start + int(np.ceil((lo - w_start)/w_step))*w_step
+    count = len(range(first, hi, w_step)) if first < hi else 0
+    if count == 0:
+        return size, 0, 0, slice(0, 0)
+    return size, (first - w_start)//w_step, count, slice(first - local.start, first - local.start + count*w_step, w_step)
+
+def snap_points(points, grids):
+    """
+    Snap points to the nearest grid points.
+
+    Parameters
+    ----------
+    points : NumPy array
+        Point coordinates, shape (n_points, dim)
+    grids : list
+        The grid of each axis (e.g., basis.grid(1) of each basis)
+
+    Returns
+    -------
+    indices : NumPy array
+        The global grid indices of each snapped point, shape (n_points, dim)
+    snapped : NumPy array
+        The coordinates of each snapped point, shape (n_points, dim)
+    """
+    points = np.array(points, dtype=np.float64, ndmin=2)
+    indices = np.zeros(points.shape, dtype=int)
+    snapped = np.zeros(points.shape)
+    for axis, grid in enumerate(grids):
+        indices[:,axis] = [np.argmin(np.abs(grid - p)) for p in points[:,axis]]
+        snapped[:,axis] = grid[indices[:,axis]]
+    return indices, snapped
+
+def owned_points(indices, local_slices):
+    """
+    Find the grid points held by a process.
+
+    Parameters
+    ----------
+    indices : NumPy array
+        Global grid indices of points, shape (n_points, dim), as returned by snap_points()
+    local_slices : tuple
+        The global index range of the process' grid data along each axis
+
+    Returns
+    -------
+    owned : NumPy array
+        The indices (into the list of points) of the points held by the process
+    local_indices : tuple
+        For each axis, the local grid indices of the owned points, for indexing the process' grid data
+    """
+    owned = np.ones(len(indices), dtype=bool)
+    for axis, sl in enumerate(local_slices):
+        owned *= (indices[:,axis] >= sl.start)*(indices[:,axis] < sl.stop)
+    owned = np.where(owned)[0]
+    return owned, tuple((indices[owned,axis] - sl.start) for axis, sl in enumerate(local_slices))
+
+def mode_indices(modes, wavenumbers, names=None):
+    """
+    Find the coefficient indices of horizontal Fourier modes.
+
+    Parameters
+    ----------
+    modes : NumPy array
+        Wavenumbers of each mode, shape (n_modes, n_axes)
+    wavenumbers : list
+        The wavenumbers of each (horizontal) basis, indexed by global coefficient index
+    names : list, optional
+        Names of the bases, for error messages
+
+    Returns
+    -------
+    indices : NumPy array
+        The global coefficient indices of each mode, shape (n_modes, n_axes)
+    """
+    modes = np.array(modes, dtype=np.float64, ndmin=2)
+    if names is None:
+        names = ['axis {}'.format(axis) for axis in range(len(wavenumbers))]
+    indices = np.zeros(modes.shape, dtype=int)
+    for axis, (k_basis, name) in enumerate(zip(wavenumbers, names)):
+        for i, k in enumerate(modes[:,axis]):
+            index = np.argmin(np.abs(k_basis - k))
+            if not np.isclose(k_basis[index], k):
+                raise ValueError("{} is not a wavenumber of the {} basis".format(k, name))
+            indices[i,axis] = index
+    return indices
+
+def local_modes(indices, local_slices, data):
+    """
+    Copy out the locally held amplitudes of horizontal modes.
+
+    Parameters
+    ----------
+    indices : NumPy array
+        The global coefficient indices of each mode, as returned by mode_indices()
+    local_slices : tuple
+        The global index range of the process' data along each axis; the last is vertical
+    data : NumPy array
+        The process' data
+
+    Returns
+    -------
+    pieces : list
+        For each locally held mode, a tuple of its mode number, the global slice of the
+        last axis held by this process, and a copy of its amplitudes along that axis.
+    """
+    owned, local_indices = owned_points(indices, local_slices[:-1])
+    return [(m, local_slices[-1], np.copy(data[tuple(index[j] for index in local_indices)])) for j, m in enumerate(owned)]
+
+def save_running_sums(path, sim_time, n_samples, window_start, sums, last_sample):
+    """
+    Save the running sums of a time-averaging window, replacing path atomically.
+
+    Parameters
+    ----------
+    path : pathlib Path
+        The file to save to
+    sim_time : float
+        The sim time the sums are saved at (e.g., that of a checkpoint)
+    n_samples : int
+        The number of samples in the sums
+    window_start : float
+        The start time of the window (None if it has not started)
+    sums : OrderedDict
+        The running sums, by name
+    last_sample : dict
+        The time scales (sim_time, iteration, etc.) of the last sample
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_suffix('.tmp')
+    with h5py.File(str(tmp_path), 'w') as file:
+        file.attrs['sim_time'] = sim_time
+        file.attrs['n_samples'] = n_samples
+        file.attrs['window_start'] = window_start if window_start is not None else np.nan
+        for k, v in last_sample.items():
+            file.attrs['last_{:s}'.format(k)] = v
+        if n_samples > 0:
+            for name, data in sums.items():
+                file.create_dataset(name, data=data)
+    tmp_path.replace(path)
+
+def load_running_sums(path, sim_time):
+    """
+    Load running sums saved by save_running_sums().
+
+    Parameters
+    ----------
+    path : pathlib Path
+        The saved file
+    sim_time : float
+        The sim time to restore at; sums saved at any other time are not loaded.
+
+    Returns
+    -------
+    state : tuple
+        n_samples, window_start, sums, and last_sample, as passed to save_running_sums(),
+        or None if the sums were saved at a different time.  If n_samples is 0, the
+        others are None, an empty OrderedDict and an empty dict.
+    """
+    with h5py.File(str(path), 'r') as file:
+        if not np.isclose(file.attrs['sim_time'], sim_time, rtol=1e-12, atol=0):
+            return None
+        n_samples = int(file.attrs['n_samples'])
+        if n_samples == 0:
+            return n_samples, None, OrderedDict(), {}
+        window_start = float(file.attrs['window_start'])
+        sums = OrderedDict([(name, file[name][()]) for name in file.keys()])
+        last_sample = {k[len('last_'):] : v for k, v in file.attrs.items() if k.startswith('last_')}
+    return n_samples, window_start, sums, last_sample
+
+
+class SetDrainer:
+    """
+    A background thread which moves completed per-process set files from a stage directory to a base directory.
+
+    Attributes:
+    -----------
+    drained : set
+        Set numbers whose file for this process has been moved to base_path
+    queued : set
+        Set numbers that have been queued to be moved
+    queue : Queue
+        Set numbers waiting to be moved
+    """
+
+    def __init__(self, stage_path, base_path, rank):
+        """
+        Parameters
+        ----------
+        stage_path : pathlib Path
+            The stage directory of the handler (stage_dir/base)
+        base_path : pathlib Path
+            The (shared) output directory of the handler
+        rank : int
+            The process rank, which selects this process' files
+        """
+        self.stage_path = stage_path
+        self.base_path = base_path
+        self.rank = rank
+        self.drained = set()
+        self.queued = set()
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def file_paths(self, set_num):
+        """ The staged and final paths of this process' file in a set """
+        stem = self.base_path.stem
+        set_name = '{:s}_s{:d}'.format(stem, set_num)
+        file_name = '{:s}_p{:d}.h5'.format(set_name, self.rank)
+        return self.stage_path.joinpath(set_name, file_name), self.base_path.joinpath(set_name, file_name)
+
+    def move(self, set_num):
+        """ Move this process' file of a set from the stage directory to the base directory """
+        stage_file, final_file = self.file_paths(set_num)
+        if stage_file.exists():
+            final_file.parent.mkdir(parents=True, exist_ok=True)
+            shutil.move(str(stage_file), str(final_file))
+            try:
+                stage_file.parent.rmdir()
+            except OSError:
+                pass # Other processes on this node still have files in the set
+        self.drained.add(set_num)
+
+    def _run(self):
+        while True:
+            set_num = self.queue.get()
+            if set_num is None:
+                self.queue.task_done()
+                break
+            try:
+                self.move(set_num)
+            except Exception as e:
+                logger.error('failed to drain set {} of {}: {}'.format(set_num, self.base_path, e))
+            self.queue.task_done()
+
+    def drain(self, set_nums):
+        """ Queue sets to be moved """
+        for set_num in set_nums:
+            self.queued.add(set_num)
+            self.queue.put(set_num)
+
+    def staged_sets(self):
+        """ Set numbers with a file from this process in the stage directory """
+        stage_files = self.stage_path.glob('{:s}_s*/*_p{:d}.h5'.format(self.base_path.stem, self.rank))
+        return sorted(int(f.parent.name.split('_s')[-1]) for f in stage_files)
+
+    def recover(self, mode):
+        """
+        Handle staged files left over from a previous run: in "append" mode they are
+        moved (so that their sets are counted), in "overwrite" mode they are discarded.
+        """
+        for set_num in self.staged_sets():
+            if mode == 'append':
+                self.move(set_num)
+            else:
+                self.file_paths(set_num)[0].unlink()
+
+    def finish(self):
+        """ Wait for all queued sets to be moved, and stop the thread """
+        self.queue.put(None)
+        self.thread.join()
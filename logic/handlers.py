@@ -0,0 +1,810 @@
+"""
+Custom Dedalus output handlers.  Their Dedalus-independent tools, e.g. for
+capturing evaluated handler output in memory and writing it to file later as
+a single block, are in logic.handler_tools.
+"""
+import logging
+import pathlib
+import shutil
+from collections import OrderedDict
+
+import h5py
+import numpy as np
+from dedalus.core.evaluator import Handler, FileHandler
+from dedalus.tools.parallel import Sync
+
+from logic.handler_tools import TIME_SCALES, write_count, capture_write, write_records, intersect_window, \
+                                snap_points, owned_points, mode_indices, local_modes, \
+                                save_running_sums, load_running_sums, SetDrainer
+
+logger = logging.getLogger(__name__.split('.')[-1])
+
+
+def flush_handlers(handlers):
+    """ Flush any buffered handlers, and write any partial time-averaging windows, in a collection of handlers (at shutdown) """
+    for handler in handlers:
+        if hasattr(handler, 'flush'):
+            handler.flush()
+        if hasattr(handler, 'write_partial'):
+            handler.write_partial()
+
+def setup_base_path(base_path, comm, mode):
+    """
+    Create (or, in "overwrite" mode, clear) the output directory of a custom handler.
+
+    Parameters
+    ----------
+    base_path : pathlib Path
+        The output directory
+    comm : mpi4py Comm
+        The communicator of the handler; the root process touches the file system.
+    mode : string
+        "overwrite" or "append"
+
+    Returns
+    -------
+    set_num : int
+        The first unused set number in base_path
+    """
+    with Sync(comm):
+        if comm.rank == 0:
+            if mode == 'overwrite' and base_path.exists():
+                shutil.rmtree(str(base_path))
+            base_path.mkdir(parents=True, exist_ok=True)
+    set_nums = [int(p.stem.split('_s')[-1]) for p in base_path.glob('{:s}_s*'.format(base_path.stem))]
+    return max(set_nums) + 1 if len(set_nums) > 0 else 1
+
+
+class BufferedFileHandler(FileHandler):
+    """
+    A per-process FileHandler for low-volume output (e.g., profiles and scalars)
+    which holds writes in memory and writes them out as one block.
+
+    Attributes:
+    -----------
+    buffer : list
+        Records of writes that have not yet been written to file
+    buffer_writes : int
+        The number of writes to hold in memory before flushing
+    """
+
+    def __init__(self, *args, buffer_writes=10, **kwargs):
+        """
+        Initialize the handler.
+
+        Parameters
+        ----------
+        buffer_writes : int, optional
+            As in class-level docstring
+        *args, **kwargs : Additional arguments for the Dedalus FileHandler
+        """
+        super(BufferedFileHandler, self).__init__(*args, **kwargs)
+        if self.parallel:
+            raise ValueError("Buffered output is only implemented for per-process (parallel=False) files")
+        self.buffer_writes = buffer_writes
+        self.buffer = []
+
+    def process(self, **kw):
+        """ Copy task output to the buffer, and flush the buffer if it is full """
+        self.buffer.append(capture_write(self, **kw))
+        if len(self.buffer) >= self.buffer_writes:
+            self.flush()
+
+    def flush(self):
+        """ Write all buffered writes to file """
+        if len(self.buffer) == 0:
+            return
+        write_records(self, self.buffer)
+        self.buffer = []
+
+def add_buffered_file_handler(evaluator, filename, **kw):
+    """ Like evaluator.add_file_handler(), but creates a BufferedFileHandler """
+    handler = BufferedFileHandler(filename, evaluator.domain, evaluator.vars, **kw)
+    evaluator.add_handler(handler)
+    return handler
+
+
+class ProcessFileHandler(Handler):
+    """
+    Base class for handlers which write their own per-process set files, in the
+    same layout as Dedalus per-process (parallel=False) output:
+
+        base_path/base_sN/base_sN_pR.h5
+
+    Each task dataset carries 'global_shape', 'start', and 'count' attributes, so
+    sets can be joined with post.merge_process_files() or logic.virtual_merge.
+    Only processes which hold data for a write create a file.  By default, the
+    full local data of each task is written; subclasses override get_pieces()
+    to write something else (e.g., a window of the data).
+
+    As with logic.staging.StagedFileHandler, files can be written to a node-local
+    stage directory and drained to base_path in the background, a set at a time.
+
+    Attributes:
+    -----------
+    base_path : pathlib Path
+        The output directory of the handler
+    comm : mpi4py Comm
+        The communicator of the domain distribution
+    drainer : logic.handler_tools.SetDrainer
+        The background drain thread (None if not staging)
+    file_write_num : int
+        Number of writes in the current set
+    max_writes : int
+        Maximum number of writes per set
+    set_num : int
+        The current set number
+    stage_path : pathlib Path
+        The stage directory of this handler, stage_dir/base (None if not staging)
+    total_write_num : int
+        Total number of writes by this handler
+    """
+
+    scale_names = TIME_SCALES
+
+    def __init__(self, base_path, domain, vars, max_writes=np.inf, mode='overwrite', stage_dir=None, **kw):
+        """
+        Initialize the handler.
+
+        Parameters
+        ----------
+        base_path : string or pathlib Path
+            As in class-level docstring
+        domain : Dedalus Domain object
+            The domain of the simulation
+        vars : dict
+            Variables for parsing task strings (e.g., solver.evaluator.vars)
+        max_writes : int, optional
+            As in class-level docstring
+        mode : string, optional
+            "overwrite" deletes existing output, "append" starts a new set after existing ones
+        stage_dir : string or pathlib Path, optional
+            The node-local directory to write to before draining to base_path
+        **kw : Additional keyword arguments (e.g., sim_dt) for the Dedalus Handler
+        """
+        super(ProcessFileHandler, self).__init__(domain, vars, **kw)
+        self.base_path = pathlib.Path(base_path).resolve()
+        self.max_writes = max_writes
+        self.comm = domain.dist.comm_cart
+        self.stage_path = None
+        self.drainer = None
+        if stage_dir is not None:
+            self.stage_path = pathlib.Path(stage_dir).resolve().joinpath(self.base_path.stem)
+            self.stage_path.mkdir(parents=True, exist_ok=True)
+            self.drainer = SetDrainer(self.stage_path, self.base_path, self.comm.rank)
+            self.drainer.recover(mode)
+        self.set_num = self.setup_base_path(mode)
+        self.file_write_num = 0
+        self.total_write_num = 0
+
+    def setup_base_path(self, mode):
+        """ Create (or, in "overwrite" mode, clear) base_path, and return the first unused set number (collective) """
+        return setup_base_path(self.base_path, self.comm, mode)
+
+    @property
+    def current_path(self):
+        """ Path to this process' file in the current set, in the stage directory if staging """
+        if self.drainer is not None:
+            return self.drainer.file_paths(self.set_num)[0]
+        stem = self.base_path.stem
+        folder = self.base_path.joinpath('{:s}_s{:d}'.format(stem, self.set_num))
+        return folder.joinpath('{:s}_s{:d}_p{:d}.h5'.format(stem, self.set_num, self.comm.rank))
+
+    def get_pieces(self):
+        """
+        Return the local output of each task for this write.
+
+        Returns
+        -------
+        pieces : OrderedDict
+            For each task name, a dict with:
+                data        : NumPy array of the local data
+                global_shape: the global (spatial) shape of the task output
+                start       : the global index of the first element of data
+                count       : the shape of data
+                constant    : per-axis bools, True if the output is constant along that axis
+                grid_space  : per-axis bools, True for axes in grid space
+                scales      : the scales of the output
+                attrs       : dict, additional dataset attributes
+
+        By default, the full local data of each task, in its layout.
+        """
+        pieces = OrderedDict()
+        for task in self.tasks:
+            out = task['out']
+            out.set_scales(task['scales'], keep_data=True)
+            out.require_layout(task['layout'])
+            constant = np.array(task['operator'].meta[:]['constant'], dtype=bool)
+            count = write_count(out.layout, task['scales'], constant)
+            global_shape = np.array(out.layout.global_shape(task['scales']))
+            global_shape[constant] = 1
+            pieces[task['name']] = {'data' : np.copy(out.data[tuple(slice(int(c)) for c in count)]),
+                                    'global_shape' : global_shape,
+                                    'start' : np.array(out.layout.start(task['scales'])),
+                                    'count' : count,
+                                    'constant' : constant,
+                                    'grid_space' : out.layout.grid_space,
+                                    'scales' : task['scales'],
+                                    'attrs' : {}}
+        return pieces
+
+    def process(self, **kw):
+        """ Gather the local pieces of all tasks and write them, if this process has any data """
+        self.write_pieces(self.get_pieces(), **kw)
+
+    def write_pieces(self, pieces, **kw):
+        """ Count a write of the given pieces, and write them if this process has any data """
+        if self.file_write_num >= self.max_writes:
+            self.set_num += 1
+            self.file_write_num = 0
+        self.total_write_num += 1
+        self.file_write_num += 1
+        if any([np.prod(p['count']) > 0 for p in pieces.values()]):
+            self.write(pieces, **kw)
+        if self.drainer is not None and self.file_write_num >= self.max_writes:
+            self.drainer.drain([self.set_num])
+
+    def finish_drain(self):
+        """ Drain all remaining staged sets (including the current one) and wait for the drain to finish """
+        if self.drainer is None:
+            return
+        self.drainer.drain([n for n in self.drainer.staged_sets() if n not in self.drainer.queued])
+        self.drainer.finish()
+        logger.info('drained {} sets of {} from {}'.format(len(self.drainer.drained), self.base_path, self.stage_path))
+
+    def setup_file(self, file, pieces):
+        """ Create the scale and task datasets of a new per-process file """
+        file.attrs['set_number'] = self.set_num
+        file.attrs['handler_name'] = self.base_path.stem
+        file.attrs['mpi_rank'] = self.comm.rank
+        file.attrs['mpi_size'] = self.comm.size
+        scale_group = file.create_group('scales')
+        for k in self.scale_names + ['write_number']:
+            scale_group.create_dataset(k, shape=(0,), maxshape=(None,), dtype=np.float64 if k not in ['iteration', 'write_number'] else np.int64)
+        for axis, basis in enumerate(self.domain.bases):
+            scale_group.create_group(basis.name)
+
+        task_group = file.create_group('tasks')
+        for task_num, (name, piece) in enumerate(pieces.items()):
+            count = tuple(int(c) for c in piece['count'])
+            dset = task_group.create_dataset(name, shape=(0,)+count, maxshape=(None,)+count, dtype=piece['data'].dtype)
+            dset.attrs['global_shape'] = piece['global_shape']
+            dset.attrs['start'] = piece['start']
+            dset.attrs['count'] = count
+            dset.attrs['task_number'] = task_num
+            dset.attrs['constant'] = piece['constant']
+            dset.attrs['grid_space'] = piece['grid_space']
+            dset.attrs['scales'] = piece['scales']
+            for k, v in piece['attrs'].items():
+                dset.attrs[k] = v
+            for axis, basis in enumerate(self.domain.bases):
+                scale = piece['scales'][axis]
+                if piece['grid_space'][axis] and str(scale) not in scale_group[basis.name]:
+                    scale_group[basis.name].create_dataset(str(scale), data=basis.grid(scale))
+
+    def write(self, pieces, path=None, **kw):
+        """ Append the local pieces of all tasks to this process' file in the current set (or to path) """
+        if path is None:
+            path = self.current_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with h5py.File(str(path), 'a') as file:
+            if 'tasks' not in file:
+                self.setup_file(file, pieces)
+            index = file['scales/write_number'].shape[0]
+            for k in self.scale_names:
+                file['scales'][k].resize(index+1, axis=0)
+                file['scales'][k][index] = kw.get(k, 0)
+            file['scales/write_number'].resize(index+1, axis=0)
+            file['scales/write_number'][index] = self.total_write_num
+            for name, piece in pieces.items():
+                dset = file['tasks'][name]
+                dset.resize(index+1, axis=0)
+                dset[index] = piece['data']
+            file.attrs['writes'] = index+1
+
+class SubVolumeHandler(ProcessFileHandler):
+    """
+    A handler which writes a (region-of-interest) window of the grid data of
+    each task: a z-range and/or index windows along each basis, with optional
+    strides.  Only processes which own data in the window write.  Merged output
+    is the window itself, with shape given by the window.  Each task dataset
+    has 'window_start' and 'window_step' attributes that map window indices to
+    indices of the full basis grids in scales/.
+    """
+
+    def add_task(self, task, name=None, scales=None, z_range=None, windows=None, strides=None):
+        """
+        Add a grid-space task with an output window.
+
+        Parameters
+        ----------
+        task : string or Dedalus Operand
+            The task to write
+        name : string, optional
+            Name of the task output
+        scales : float or tuple, optional
+            Scales of the output data
+        z_range : tuple, optional
+            (z_min, z_max); if specified, only write grid points of the last basis in this range.
+        windows : dict, optional
+            Maps basis names to (start, stop) index windows.  Default is the full basis.
+        strides : dict, optional
+            Maps basis names to index strides.  Default is 1.
+        """
+        if windows is None:
+            windows = dict()
+        if strides is None:
+            strides = dict()
+        super(SubVolumeHandler, self).add_task(task, layout='g', name=name, scales=scales)
+        task = self.tasks[-1]
+        gshape = self.domain.dist.grid_layout.global_shape(task['scales'])
+        window = []
+        for axis, basis in enumerate(self.domain.bases):
+            start, stop = windows.get(basis.name, (0, gshape[axis]))
+            if axis == self.domain.dim-1 and z_range is not None:
+                z = basis.grid(task['scales'][axis])
+                good = np.where((z >= z_range[0])*(z <= z_range[1]))[0]
+                if len(good) == 0:
+                    raise ValueError("z_range {} of task {} contains no grid points (z = [{:.3e}, {:.3e}])".format(z_range, task['name'], z.min(), z.max()))
+                start, stop = good[0], good[-1]+1
+            window.append(slice(int(start), int(stop), int(strides.get(basis.name, 1))))
+        task['window'] = tuple(window)
+
+    def get_pieces(self):
+        """ Intersect the local grid data of each task with its window """
+        pieces = OrderedDict()
+        for task in self.tasks:
+            out = task['out']
+            out.set_scales(task['scales'], keep_data=True)
+            out.require_grid_space()
+            constant = np.array(task['operator'].meta[:]['constant'], dtype=bool)
+            local_slices = out.layout.slices(task['scales'])
+
+            global_shape, start, count, data_slices = [], [], [], []
+            for axis, (window, local) in enumerate(zip(task['window'], local_slices)):
+                if constant[axis]:
+                    window = slice(0, 1, 1)
+                size, w_start, n, data_slice = intersect_window(window, local)
+                global_shape.append(size)
+                start.append(w_start)
+                count.append(n)
+                data_slices.append(data_slice)
+
+            pieces[task['name']] = {'data' : out.data[tuple(data_slices)],
+                                    'global_shape' : global_shape,
+                                    'start' : start,
+                                    'count' : count,
+                                    'constant' : constant,
+                                    'grid_space' : out.layout.grid_space,
+                                    'scales' : task['scales'],
+                                    'attrs' : {'window_start' : [w.start for w in task['window']],
+                                               'window_step'  : [w.step for w in task['window']]}}
+        return pieces
+
+
+class TimeAverageHandler(ProcessFileHandler):
+    """
+    A handler which accumulates running time averages (and, optionally, second
+    moments) of its grid-space tasks, e.g., horizontal or vertical slices, in
+    memory.  Each task is sampled whenever the handler is evaluated, and the
+    averaged maps are written once per averaging window, in the Dedalus
+    per-process layout.  The partial window at the end of a run is written by
+    write_partial() (see flush_handlers()), with its (smaller) number of samples.
+
+    Means are written to tasks/<name>, and mean squares to tasks/<name>_sq.
+    scales/window_start and scales/n_samples record the start time and number
+    of samples of each window; scales/sim_time is the time of the last sample.
+
+    So that restarts continue the window in progress, the running sums are saved
+    by save_state() whenever a checkpoint is written (see
+    logic.checkpointing.Checkpoint.add_flush_handlers()), to
+    <base_path>_running_sums/p<rank>.h5, and restored on initialization if
+    they were saved at the restart time.
+
+    Attributes:
+    -----------
+    n_samples : int
+        The number of samples in the current window
+    second_moment : bool
+        If True, also average the square of each task
+    sums : OrderedDict
+        Running sums of each task (and its square) in the current window
+    window : float
+        The simulation time length of each averaging window
+    window_start : float
+        The start time of the current window
+    state_path : pathlib Path
+        The file this process' running sums are saved to
+    """
+
+    scale_names = TIME_SCALES + ['window_start', 'n_samples']
+
+    def __init__(self, *args, window=1, second_moment=True, restart_time=None, **kw):
+        """
+        Initialize the handler.
+
+        Parameters
+        ----------
+        window : float, optional
+            As in class-level docstring
+        second_moment : bool, optional
+            As in class-level docstring
+        restart_time : float, optional
+            If not None, the sim time the run restarted from; running sums saved at this time are restored.
+        *args, **kw : Additional arguments for ProcessFileHandler (set sim_dt to the sampling cadence)
+        """
+        super(TimeAverageHandler, self).__init__(*args, **kw)
+        self.window = window
+        self.second_moment = second_moment
+        self.window_start = None
+        self.n_samples = 0
+        self.sums = OrderedDict()
+        self.last_sample = {}
+        self.state_path = self.base_path.with_name('{:s}_running_sums'.format(self.base_path.stem)).joinpath('p{:d}.h5'.format(self.comm.rank))
+        if restart_time is not None:
+            self.load_state(restart_time)
+
+    def add_task(self, task, name=None, scales=None):
+        """ Add a grid-space task to average """
+        super(TimeAverageHandler, self).add_task(task, layout='g', name=name, scales=scales)
+
+    def process(self, **kw):
+        """ Add a sample of each task to the running sums, and write the averages at the end of each window """
+        sim_time = kw.get('sim_time', 0)
+        if self.window_start is None:
+            self.window_start = sim_time
+        for task in self.tasks:
+            out = task['out']
+            out.set_scales(task['scales'], keep_data=True)
+            out.require_grid_space()
+            constant = np.array(task['operator'].meta[:]['constant'], dtype=bool)
+            count = write_count(out.layout, task['scales'], constant)
+            data = out.data[tuple(slice(int(c)) for c in count)]
+            if self.n_samples == 0:
+                self.sums[task['name']] = np.zeros_like(data)
+                if self.second_moment:
+                    self.sums['{:s}_sq'.format(task['name'])] = np.zeros_like(data)
+            self.sums[task['name']] += data
+            if self.second_moment:
+                self.sums['{:s}_sq'.format(task['name'])] += data**2
+        self.n_samples += 1
+        self.last_sample = kw
+        if sim_time - self.window_start >= self.window:
+            self.write_pieces(self.get_pieces(), window_start=self.window_start, n_samples=self.n_samples, **kw)
+            self.window_start = sim_time
+            self.n_samples = 0
+
+    def write_partial(self):
+        """ Write the averages of the current, partial window (e.g., at the end of a run) """
+        if self.n_samples == 0:
+            return
+        logger.info('writing partial {} window from t = {:.4e} with {} samples'.format(self.base_path.stem, self.window_start, self.n_samples))
+        self.write_pieces(self.get_pieces(), window_start=self.window_start, n_samples=self.n_samples, **self.last_sample)
+        self.window_start = None
+        self.n_samples = 0
+
+    def save_state(self, sim_time):
+        """ Save the running sums of the current window, e.g., alongside a checkpoint written at sim_time """
+        save_running_sums(self.state_path, sim_time, self.n_samples, self.window_start, self.sums, self.last_sample)
+
+    def load_state(self, sim_time):
+        """ Restore the running sums saved at sim_time, if there are any """
+        if not self.state_path.exists():
+            return
+        state = load_running_sums(self.state_path, sim_time)
+        if state is None:
+            logger.warning('not restoring {} running sums: not saved at the restart time t = {:.6e}'.format(self.base_path.stem, sim_time))
+            return
+        self.n_samples, window_start, sums, last_sample = state
+        if self.n_samples > 0:
+            self.window_start, self.sums, self.last_sample = window_start, sums, last_sample
+        logger.info('restored {} running sums: {} samples since t = {}'.format(self.base_path.stem, self.n_samples, self.window_start))
+
+    def get_pieces(self):
+        """ The window-averaged local data of each task """
+        pieces = OrderedDict()
+        for task in self.tasks:
+            out = task['out']
+            constant = np.array(task['operator'].meta[:]['constant'], dtype=bool)
+            global_shape = np.array(out.layout.global_shape(task['scales']))
+            start = np.array(out.layout.start(task['scales']))
+            global_shape[constant] = 1
+            start[constant] = 0
+            names = [task['name']]
+            if self.second_moment:
+                names.append('{:s}_sq'.format(task['name']))
+            for name in names:
+                mean = self.sums[name]/self.n_samples
+                pieces[name] = {'data' : mean,
+                                'global_shape' : global_shape,
+                                'start' : start,
+                                'count' : mean.shape,
+                                'constant' : constant,
+                                'grid_space' : out.layout.grid_space,
+                                'scales' : task['scales'],
+                                'attrs' : {}}
+        return pieces
+
+class RootFileHandler(Handler):
+    """
+    Base class for handlers whose (small) output is gathered to the root
+    process, which writes it to base_path/base_sN.h5, in the same
+    scales/ and tasks/ layout as a merged Dedalus set file.
+
+    Attributes:
+    -----------
+    base_path : pathlib Path
+        The output directory of the handler
+    comm : mpi4py Comm
+        The communicator of the domain distribution
+    file_write_num : int
+        Number of writes in the current set (root process only)
+    max_writes : int
+        Maximum number of writes per set
+    set_num : int
+        The current set number (root process only)
+    total_write_num : int
+        Total number of writes by this handler
+    """
+
+    compression = None
+
+    def __init__(self, base_path, domain, vars, max_writes=np.inf, mode='overwrite', **kw):
+        """
+        Initialize the handler.
+
+        Parameters
+        ----------
+        base_path : string or pathlib Path
+            As in class-level docstring
+        domain : Dedalus Domain object
+            The domain of the simulation
+        vars : dict
+            Variables for parsing task strings (e.g., solver.evaluator.vars)
+        max_writes : int, optional
+            As in class-level docstring
+        mode : string, optional
+            "overwrite" or "append"
+        **kw : Additional keyword arguments (e.g., sim_dt, iter) for the Dedalus Handler
+        """
+        super(RootFileHandler, self).__init__(domain, vars, **kw)
+        self.base_path = pathlib.Path(base_path).resolve()
+        self.comm = domain.dist.comm_cart
+        self.max_writes = max_writes
+        self.set_num = setup_base_path(self.base_path, self.comm, mode)
+        self.file_write_num = 0
+        self.total_write_num = 0
+
+    def setup_file(self, file):
+        """ Add handler-specific scales and attributes to a new set file """
+        pass
+
+    def write_block(self, records, data):
+        """
+        Write a block of gathered writes to file, starting new sets as needed (root process only).
+
+        Parameters
+        ----------
+        records : list
+            For each write, a dict of the time scales (sim_time, etc.)
+        data : OrderedDict
+            For each task dataset name, a NumPy array of all writes in the block, with a leading write axis
+        """
+        start = 0
+        while start < len(records):
+            if self.file_write_num >= self.max_writes:
+                self.set_num += 1
+                self.file_write_num = 0
+            n_writes = int(min(len(records) - start, self.max_writes - self.file_write_num))
+            block = slice(start, start+n_writes)
+            path = self.base_path.joinpath('{:s}_s{:d}.h5'.format(self.base_path.stem, self.set_num))
+            with h5py.File(str(path), 'a') as file:
+                if 'tasks' not in file:
+                    file.attrs['set_number'] = self.set_num
+                    file.attrs['handler_name'] = self.base_path.stem
+                    scale_group = file.create_group('scales')
+                    for k in TIME_SCALES + ['write_number']:
+                        scale_group.create_dataset(k, shape=(0,), maxshape=(None,), dtype=np.float64 if k not in ['iteration', 'write_number'] else np.int64)
+                    task_group = file.create_group('tasks')
+                    for name, array in data.items():
+                        chunks = (1,)+array.shape[1:] if self.compression is not None else None
+                        task_group.create_dataset(name, shape=(0,)+array.shape[1:], maxshape=(None,)+array.shape[1:], dtype=array.dtype,
+                                                  chunks=chunks, compression=self.compression)
+                    self.setup_file(file)
+                index = self.file_write_num
+                for k in TIME_SCALES:
+                    file['scales'][k].resize(index+n_writes, axis=0)
+                    file['scales'][k][index:index+n_writes] = [r[k] for r in records[block]]
+                file['scales/write_number'].resize(index+n_writes, axis=0)
+                file['scales/write_number'][index:index+n_writes] = self.total_write_num + start + 1 + np.arange(n_writes)
+                for name, array in data.items():
+                    file['tasks'][name].resize(index+n_writes, axis=0)
+                    file['tasks'][name][index:index+n_writes] = array[block]
+                file.attrs['writes'] = index+n_writes
+            self.file_write_num += n_writes
+            start += n_writes
+
+class ProbeHandler(RootFileHandler):
+    """
+    A handler which samples its tasks at a few fixed points at high cadence.
+
+    Probe points are snapped to the nearest grid point (at scales=1), so values
+    are read straight from the grid data of the process which owns each point,
+    without interpolation.  Samples are held in memory and gathered to the root
+    process, which writes them to base_path/base_sN.h5 as a
+    (time x probe x field) dataset, tasks/probes.
+
+    Attributes:
+    -----------
+    buffer : list
+        Samples of the locally owned probes that have not yet been written to file
+    buffer_writes : int
+        The number of samples to hold in memory before flushing
+    indices : NumPy array
+        The global grid indices of each probe, shape (n_probes, dim)
+    owned : NumPy array
+        The indices of the probes owned by this process
+    points : NumPy array
+        The (grid-aligned) coordinates of each probe, shape (n_probes, dim)
+    """
+
+    def __init__(self, base_path, domain, vars, points, buffer_writes=100, max_writes=np.inf, mode='overwrite', **kw):
+        """
+        Initialize the handler.
+
+        Parameters
+        ----------
+        base_path : string or pathlib Path
+            The output directory of the handler
+        domain : Dedalus Domain object
+            The domain of the simulation
+        vars : dict
+            Variables for parsing task strings (e.g., solver.evaluator.vars)
+        points : list
+            Probe coordinates, e.g., [(x0, y0, z0), (x1, y1, z1)]
+        buffer_writes : int, optional
+            As in class-level docstring
+        max_writes : int, optional
+            Maximum number of samples per output file
+        mode : string, optional
+            "overwrite" or "append"
+        **kw : Additional keyword arguments (e.g., iter) for the Dedalus Handler
+        """
+        super(ProbeHandler, self).__init__(base_path, domain, vars, max_writes=max_writes, mode=mode, **kw)
+        self.buffer_writes = buffer_writes
+        self.buffer = []
+
+        points = np.array(points, dtype=np.float64, ndmin=2)
+        self.indices, self.points = snap_points(points, [basis.grid(1) for basis in domain.bases])
+        for p, g in zip(points, self.points):
+            logger.info('probe at {} snapped to grid point {}'.format(tuple(p), tuple(g)))
+        self.owned, self.local_indices = owned_points(self.indices, domain.dist.grid_layout.slices(scales=1))
+
+    def add_task(self, task, name=None):
+        """ Add a task to sample at the probe points; tasks are evaluated in grid space at scales=1 """
+        super(ProbeHandler, self).add_task(task, layout='g', name=name, scales=1)
+
+    def process(self, **kw):
+        """ Sample the locally owned probes, and flush the buffer if it is full """
+        sample = np.zeros((len(self.owned), len(self.tasks)))
+        for i, task in enumerate(self.tasks):
+            out = task['out']
+            out.set_scales(task['scales'], keep_data=True)
+            out.require_grid_space()
+            if len(self.owned) > 0:
+                sample[:,i] = out.data[self.local_indices].real
+        record = OrderedDict()
+        for k in TIME_SCALES:
+            record[k] = kw.get(k, 0)
+        record['probes'] = sample
+        self.buffer.append(record)
+        if len(self.buffer) >= self.buffer_writes:
+            self.flush()
+
+    def flush(self):
+        """ Gather all buffered samples to the root process and write them to file (collective) """
+        n_writes = len(self.buffer)
+        if n_writes == 0:
+            return
+        local = np.array([r['probes'] for r in self.buffer]).reshape((n_writes, len(self.owned), len(self.tasks)))
+        gathered = self.comm.gather((self.owned, local), root=0)
+        if self.comm.rank == 0:
+            probes = np.zeros((n_writes, len(self.points), len(self.tasks)))
+            for owned, data in gathered:
+                probes[:,owned,:] = data
+            self.write_block(self.buffer, OrderedDict([('probes', probes)]))
+        self.total_write_num += n_writes
+        self.buffer = []
+
+    def setup_file(self, file):
+        """ Record the probe locations and fields """
+        file['scales/points'] = self.points
+        file['scales/indices'] = self.indices
+        file['tasks/probes'].attrs['fields'] = [t['name'] for t in self.tasks]
+        file['tasks/probes'].attrs['bases'] = [b.name for b in self.domain.bases]
+
+class ModeHandler(RootFileHandler):
+    """
+    A handler which writes the complex amplitudes of a few horizontal Fourier
+    modes of its tasks, as a function of the last (vertical) basis.  Amplitudes
+    are taken straight from the coefficient data of the processes which own
+    each mode and gathered to the root process; nothing is transformed.
+
+    Each task is written to tasks/<name>, with shape (time x mode x nz).
+    scales/<basis name> holds the horizontal wavenumbers of each mode.
+
+    Attributes:
+    -----------
+    indices : NumPy array
+        The global coefficient indices of each mode, shape (n_modes, dim-1)
+    modes : NumPy array
+        The wavenumbers of each mode, shape (n_modes, dim-1)
+    """
+
+    def __init__(self, base_path, domain, vars, modes, z_space='c', **kw):
+        """
+        Initialize the handler.
+
+        Parameters
+        ----------
+        base_path : string or pathlib Path
+            The output directory of the handler
+        domain : Dedalus Domain object
+            The domain of the simulation
+        vars : dict
+            Variables for parsing task strings (e.g., solver.evaluator.vars)
+        modes : list
+            Wavenumbers of the horizontal modes, e.g., [(kx0, ky0), (kx1, ky1)] in 3D
+        z_space : string, optional
+            'c' writes Chebyshev coefficients along z.  'g' writes z grid data, which
+            costs one (process-local) transform along z per task.
+        **kw : Additional keyword arguments (e.g., sim_dt, max_writes, mode) for RootFileHandler
+        """
+        super(ModeHandler, self).__init__(base_path, domain, vars, **kw)
+        if z_space == 'c':
+            self.layout = domain.dist.coeff_layout
+        else:
+            self.layout = domain.dist.layouts[1]
+            if not (self.layout.grid_space[-1] and not any(self.layout.grid_space[:-1])):
+                raise ValueError("No layout with only the last axis in grid space")
+        self.modes = np.array(modes, dtype=np.float64, ndmin=2)
+        self.indices = mode_indices(self.modes, [basis.wavenumbers for basis in domain.bases[:-1]],
+                                    names=[basis.name for basis in domain.bases[:-1]])
+
+    def add_task(self, task, name=None):
+        """ Add a task whose mode amplitudes will be written """
+        super(ModeHandler, self).add_task(task, layout=self.layout, name=name, scales=1)
+
+    def process(self, **kw):
+        """ Gather the mode amplitudes of all tasks to the root process and write them (collective) """
+        pieces = []
+        for i, task in enumerate(self.tasks):
+            out = task['out']
+            out.set_scales(task['scales'], keep_data=True)
+            out.require_layout(task['layout'])
+            for m, z_slice, amplitudes in local_modes(self.indices, out.layout.slices(task['scales']), out.data):
+                pieces.append((i, m, z_slice, amplitudes))
+        gathered = self.comm.gather(pieces, root=0)
+        if self.comm.rank == 0:
+            nz = self.layout.global_shape(scales=1)[-1]
+            data = OrderedDict()
+            for task in self.tasks:
+                data[task['name']] = np.zeros((1, len(self.modes), nz), dtype=np.complex128)
+            for proc_pieces in gathered:
+                for i, m, z_slice, amplitudes in proc_pieces:
+                    data[self.tasks[i]['name']][0, m, z_slice] = amplitudes
+            record = OrderedDict()
+            for k in TIME_SCALES:
+                record[k] = kw.get(k, 0)
+            self.write_block([record], data)
+        self.total_write_num += 1
+
+    def setup_file(self, file):
+        """ Record the wavenumbers of each mode """
+        for axis, basis in enumerate(self.domain.bases[:-1]):
+            file['scales'][basis.name] = self.modes[:,axis]
+        if self.layout.grid_space[-1]:
+            z_basis = self.domain.bases[-1]
+            file['scales'][z_basis.name] = z_basis.grid(1)
+        for task in self.tasks:
+            file['tasks'][task['name']].attrs['grid_space'] = self.layout.grid_space
@@ -6,6 +6,8 @@ import numpy as np
 logger = logging.getLogger(__name__)
 
 class LinearAtmosphere():
+
+    Lz = 1 # Depth of the atmosphere
     
     def __init__(self, domain, problem):
         self.domain = domain
@@ -17,7 +19,8 @@ class LinearAtmosphere():
         self.rho0      = domain.new_field()
         self.ln_rho0_z = domain.new_field()
         for f in [self.T0, self.T0_z, self.rho0, self.ln_rho0_z]:
-            f.meta['x']['constant'] = True
+            if domain.dim > 1:
+                f.meta['x']['constant'] = True
             if domain.dim == 3:
                 f.meta['y']['constant'] = True
 
@@ -0,0 +1,261 @@
+import logging
+from collections import OrderedDict
+from copy import deepcopy
+
+import numpy as np
+from mpi4py import MPI
+from scipy.optimize import brentq
+import dedalus.public as de
+
+logger = logging.getLogger(__name__)
+
+class OnsetEVP():
+    """
+    The linear eigenvalue problem (EVP) for the onset of convection, built from
+    the same FCEquations classes, atmospheres, and BC tables as the simulations.
+
+    The background is static and unmagnetized, so the linearization of the
+    FC equations is their LHS once the viscous and diffusive LHS terms, which
+    use rho0_min, are replaced with their full linear forms (using rho0); the
+    remaining RHS terms are all nonlinear.  Time derivatives become sigma, the
+    eigenvalue, so modes grow where Re(sigma) > 0.
+
+    A batch of evenly spaced horizontal wavenumbers, kx = dk*(1, 2, ..., n), are
+    the Fourier modes of an x basis of length 2*pi/dk: Dedalus builds the matrices
+    of all of them at once, one pencil per kx, distributed across processes.
+    3D (and MHD) equation sets are solved for ky = 0 modes (rolls along y).
+
+    The EVP is built once, at the first Rayleigh number solved.  At fixed Pr,
+    Pm, and Ta, the atmospheres' diffusivities (and rotation rate) all scale as
+    Ra**(-1/2), so a new Rayleigh number rescales these scalar parameters and
+    rebuilds the pencil matrices' coefficients, rather than the whole EVP.
+
+    Attributes:
+    -----------
+    equations : an FCEquations object (e.g., FCEquations2D)
+        The equation set to linearize
+    bcs : list
+        The BC types to add, as in the drivers (e.g., ['temp', 'stressfree', 'impenetrable'])
+    kx : NumPy array
+        The horizontal wavenumbers of the batch
+    comm : mpi4py Comm
+        The processes the batch is distributed over
+    Ra : float
+        The Rayleigh number of the EVP's parameters (None until it is built)
+    domain, problem, solver, atmosphere
+        The Dedalus objects of the EVP (None until it is built)
+    """
+    # The parameters set by atmosphere.set_parameters() which scale as Ra**(-1/2)
+    diffusive_parameters = ('K', 'μ', 'η', 'Ω0')
+
+    def __init__(self, equations, atmo_class, atmo_args, atmo_kwargs, bcs, nz, kx, comm=MPI.COMM_WORLD, ncc_cutoff=1e-10, **parameters):
+        """
+        Initialize the EVP.
+
+        Parameters
+        ----------
+        equations : an FCEquations object (e.g., FCEquations2D)
+            The equation set to linearize
+        atmo_class : The class type of the atmosphere object (Polytrope or LinearAtmosphere)
+        atmo_args : tuple
+            args for atmo_class.__init__()
+        atmo_kwargs : dict
+            kwargs for atmo_class.__init__()
+        bcs : list
+            The BC types to add, as in the drivers
+        nz : int
+            Vertical resolution
+        kx : NumPy array
+            Evenly spaced horizontal wavenumbers, dk*(1, 2, ..., n)
+        comm : mpi4py Comm, optional
+            The processes to distribute the batch over
+        ncc_cutoff : float, optional
+            NCC cutoff of the problem
+        parameters : dict, optional
+            Additional keyword arguments for atmosphere.set_parameters() (e.g., Pr, Pm, Ta)
+        """
+        kx = np.array(kx, dtype=np.float64, ndmin=1)
+        if not np.allclose(kx, kx[0]*np.arange(1, len(kx)+1)):
+            raise ValueError("kx must be evenly spaced multiples of kx[0], kx[0]*(1, 2, ..., n)")
+        self.equations   = equations
+        self.atmo_class, self.atmo_args, self.atmo_kwargs = atmo_class, atmo_args, atmo_kwargs
+        self.bcs         = bcs
+        self.nz          = nz
+        self.kx          = kx
+        self.comm        = comm
+        self.ncc_cutoff  = ncc_cutoff
+        self.parameters  = parameters
+        self.Ra          = None
+        self.domain = self.problem = self.solver = self.atmosphere = None
+        self.rebuild_coeffs = False
+
+    def build_solver(self, Ra):
+        """
+        Build the EVP at a Rayleigh number, for all of the batch's wavenumbers.
+        Later Rayleigh numbers are set with set_Ra().
+
+        Parameters
+        ----------
+        Ra : float
+            The Rayleigh number
+        """
+        # Polytropes know their depth on initialization and are built on a
+        # domain later; LinearAtmospheres are built on initialization.
+        if hasattr(self.atmo_class, 'build_atmosphere'):
+            atmosphere = self.atmo_class(*self.atmo_args, **self.atmo_kwargs)
+            Lz         = atmosphere.Lz
+        else:
+            Lz         = self.atmo_class.Lz
+        Lx = 2*np.pi/self.kx[0]
+        x_basis = de.Fourier(  'x', 2*(len(self.kx)+1), interval=[0, Lx], dealias=1)
+        z_basis = de.Chebyshev('z', self.nz,            interval=[0, Lz], dealias=1)
+        self.domain = domain = de.Domain([x_basis, z_basis], grid_dtype=np.float64, comm=self.comm)
+        problem = de.EVP(domain, variables=self.equations.variables, eigenvalue='sigma', ncc_cutoff=self.ncc_cutoff)
+        if hasattr(self.atmo_class, 'build_atmosphere'):
+            atmosphere.build_atmosphere(domain, problem)
+        else:
+            atmosphere = self.atmo_class(domain, problem, *self.atmo_args, **self.atmo_kwargs)
+        atmosphere.set_parameters(Ra=Ra, **self.parameters)
+        problem.parameters['Lx'] = Lx
+        if 'Ω0' not in problem.parameters.keys():
+            problem.parameters['Ω0'] = 0
+            problem.substitutions['φ'] = '0'
+        self.atmosphere = atmosphere
+
+        # Substitutions: no y dependence, time derivatives are the eigenvalue,
+        # and the full linear viscous & diffusive terms are on the LHS
+        problem.substitutions['dy(A)'] = '0'
+        problem.substitutions['dt(A)'] = 'sigma*A'
+        # define_subs() modifies the equations object, so the build uses a copy
+        equations = deepcopy(self.equations)
+        problem = equations.define_subs(problem)
+        for v in ['u', 'v', 'w']:
+            problem.substitutions['visc_{}_L'.format(v)] = 'μ*visc_{}/rho0'.format(v)
+        problem.substitutions['diff_L'] = 'diff/rho0'
+
+        # Linearized equations and BCs: the LHS of each (the RHS is nonlinear)
+        for k, eqn in equations.equations.items():
+            logger.debug('Adding linearized eqn "{:13s}" of form: "{:s} = 0"'.format(k, eqn.split('=')[0]))
+            problem.add_equation("{:s} = 0".format(eqn.split('=')[0]))
+        for k, bc in equations.BCs.items():
+            for bc_type in self.bcs:
+                if bc_type in k:
+                    # There is no y basis; ky = 0
+                    condition = bc[1].replace('ny', '0')
+                    logger.debug('Adding linearized BC "{:15s}" of form: "{:s} = 0" (condition: {})'.format(k, bc[0].split('=')[0], condition))
+                    problem.add_bc("{:s} = 0".format(bc[0].split('=')[0]), condition=condition)
+        self.problem = problem
+        self.solver  = problem.build_solver()
+        self.Ra      = Ra
+        self.rebuild_coeffs = False
+        return self.solver
+
+    def set_Ra(self, Ra):
+        """
+        Set the Rayleigh number of a built EVP, by rescaling its diffusive
+        parameters.  The pencil matrices are rebuilt at the next solves.
+
+        Parameters
+        ----------
+        Ra : float
+            The Rayleigh number
+        """
+        if Ra == self.Ra:
+            return
+        factor = np.sqrt(self.Ra/Ra)
+        for name in self.diffusive_parameters:
+            if name in self.problem.parameters:
+                self.problem.namespace[name].value *= factor
+        self.Ra = Ra
+        self.rebuild_coeffs = True
+
+    def growth_rates(self, Ra, n_modes=10, target=0):
+        """
+        Find the fastest-growing mode at each of the batch's wavenumbers, by sparse
+        shift-invert eigensolves about a target eigenvalue.  The EVP is built at
+        the first call, and later calls set Ra (see set_Ra()).
+
+        Parameters
+        ----------
+        Ra : float
+            The Rayleigh number
+        n_modes : int, optional
+            Number of eigenvalues found near the target at each kx
+        target : complex, optional
+            The shift of the shift-invert eigensolves
+
+        Returns
+        -------
+        kx, growth, frequency : NumPy arrays
+            The wavenumbers of the batch, and the real & imaginary part of the
+            fastest-growing eigenvalue at each (on all processes)
+        """
+        if self.solver is None:
+            self.build_solver(Ra)
+        else:
+            self.set_Ra(Ra)
+        solver = self.solver
+        wavenumbers = self.domain.bases[0].wavenumbers
+        local = []
+        for pencil in solver.pencils:
+            kx = wavenumbers[pencil.global_index[0]]
+            if kx == 0:
+                continue
+            solver.solve_sparse(pencil, n_modes, target, rebuild_coeffs=self.rebuild_coeffs)
+            eigenvalues = solver.eigenvalues[np.isfinite(solver.eigenvalues)]
+            sigma = eigenvalues[np.argmax(eigenvalues.real)]
+            local.append((kx, sigma.real, sigma.imag))
+        self.rebuild_coeffs = False
+        results = sorted(sum(self.comm.allgather(local), []))
+        kx, growth, frequency = [np.array(r) for r in zip(*results)]
+        logger.info('Ra = {:.3e}: fastest growth {:.3e} at kx = {:.3e}'.format(Ra, np.max(growth), kx[np.argmax(growth)]))
+        return kx, growth, frequency
+
+    def critical_Ra(self, Ra_min, Ra_max, n_modes=10, target=0, rtol=1e-4):
+        """
+        Find the critical Rayleigh number at each of the batch's wavenumbers, where
+        the fastest-growing mode's growth rate crosses zero, by root-finding in
+        log(Ra).  The wavenumbers are split across processes, each of which finds
+        its roots independently, with a single-kx EVP which is built once.  Each
+        root-finding step is a call to growth_rates() at a new Ra; growth rates
+        are cached by log(Ra), so no Rayleigh number is solved twice.
+
+        Parameters
+        ----------
+        Ra_min, Ra_max : floats
+            Rayleigh numbers bracketing onset
+        n_modes, target : optional
+            Arguments of growth_rates()
+        rtol : float, optional
+            Relative tolerance of the critical Rayleigh numbers (an absolute
+            tolerance of rtol/ln(10) in log10(Ra))
+
+        Returns
+        -------
+        kx, Ra_crit : NumPy arrays
+            The wavenumbers of the batch and their critical Rayleigh numbers
+            (NaN where onset is not bracketed), on all processes
+        """
+        local = OrderedDict()
+        for kx in np.array_split(self.kx, self.comm.size)[self.comm.rank]:
+            evp = OnsetEVP(self.equations, self.atmo_class, self.atmo_args, self.atmo_kwargs, self.bcs, self.nz, [kx],
+                           comm=MPI.COMM_SELF, ncc_cutoff=self.ncc_cutoff, **self.parameters)
+            solves = OrderedDict()
+            def growth(log_Ra):
+                if log_Ra not in solves:
+                    solves[log_Ra] = evp.growth_rates(10**log_Ra, n_modes=n_modes, target=target)[1][0]
+                return solves[log_Ra]
+            bounds = np.log10([Ra_min, Ra_max])
+            if growth(bounds[0])*growth(bounds[1]) > 0:
+                logger.warning('onset not bracketed by Ra = [{:.3e}, {:.3e}] at kx = {:.3e}'.format(Ra_min, Ra_max, kx))
+                local[kx] = np.nan
+            else:
+                local[kx] = 10**brentq(growth, *bounds, xtol=rtol/np.log(10))
+        Ra_crit = OrderedDict()
+        for proc_local in self.comm.allgather(local):
+            Ra_crit.update(proc_local)
+        Ra_crit = np.array([Ra_crit[kx] for kx in self.kx])
+        if np.any(np.isfinite(Ra_crit)):
+            i = np.nanargmin(Ra_crit)
+            logger.info('critical Ra = {:.5e} at kx = {:.5e}'.format(Ra_crit[i], self.kx[i]))
+        return self.kx, Ra_crit
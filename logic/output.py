@@ -1,11 +1,46 @@
+import itertools
+
 import numpy as np
 import logging
 logger = logging.getLogger(__name__)
 from collections import OrderedDict
 
+from logic.rendering import FrameHandler
+from logic.staging   import add_staged_file_handler
+from logic.handlers import add_buffered_file_handler, SubVolumeHandler, TimeAverageHandler, ProbeHandler, ModeHandler
+from logic.scheduling import estimate_write_cost, OutputScheduler, OutputTrigger
+
+# Output options shared by the drivers; append to a driver's docopt string.
+OUTPUT_OPTIONS = """
+    --consolidate              If flagged, consolidate the profile & scalar sets into single time-indexed archives at the end of the run
+    --merge_virtual            If flagged, merge checkpoints & volumes with zero-copy HDF5 virtual datasets
+    --buffer_writes=<n>        If specified, hold n profile & scalar writes in memory between file writes
+    --stagger_output           If flagged, offset output handler phases so their writes don't land on the same iteration
+    --io_budget=<pts>          Max data points written per iteration; due writes over it are postponed
+    --trigger_KE=<KE>          If specified, raise the slice cadence while the average KE exceeds this value
+    --trigger_time=<t>         Duration of triggered slice output windows, in t_buoy [default: 1]
+    --trigger_factor=<f>       Factor by which triggered windows raise the slice cadence [default: 10]
+    --pre_trigger_writes=<n>   Number of high-cadence slice writes to hold in memory before a trigger [default: 0]
+    --probe_z=<z0,z1,...>      If specified, record time series at the horizontal center of the domain at these heights
+    --probe_iter=<n>           Iterations between probe samples [default: 1]
+    --max_mode=<n>             If specified, write amplitudes of horizontal Fourier modes up to this multiple of the fundamental
+    --average_window=<t>       If specified, write time-averaged slices over windows of this many t_buoy
+    --frame_stride=<n>         If specified, render quick-look RGB frames of slices, downsampled by this stride
+    --stage_dir=<dir>          If specified, write slices, volumes & checkpoints to this node-local directory, and drain them to the output directory in the background
+"""
+
+# Volume output options of the 3D drivers; append to a driver's docopt string with OUTPUT_OPTIONS.
+VOLUME_OPTIONS = """
+    --volume_z=<z0,z1>         If specified, only write volume output between these heights
+    --volume_stride=<n>        Horizontal stride of volume output [default: 1]
+"""
+
 def initialize_output(solver, domain, data_dir,
                       max_writes=10, max_vol_writes=2, output_dt=1, slice_dt_factor=5, vol_dt_factor=25,
-                      mode="overwrite", volumes_output=True, coeff_output=False, magnetic=True, threeD=True):
+                      mode="overwrite", volumes_output=True, coeff_output=False, magnetic=True, threeD=True,
+                      buffer_writes=None, volume_window=None, probe_points=None, probe_iter=1, probe_buffer=100,
+                      max_mode=None, average_window=None, frame_stride=None,
+                      stage_dir=None):
     """
     Sets up Dedalus output tasks for a Boussinesq convection run.
 
@@ -29,12 +64,41 @@ def initialize_output(solver, domain, data_dir,
         If True, write 3D volumes
     coeff_output    : bool, optional
         If True, write coefficient data
+    buffer_writes   : int, optional
+        If not None, hold this many profile and scalar writes in memory and write them to file as one block.
+        Call flush() on those handlers (e.g., through logic.handlers.flush_handlers) before exiting.
+    volume_window   : dict, optional
+        If not None, only write this window of the 3D volumes. Keyword arguments (z_range, windows, strides)
+        for logic.handlers.SubVolumeHandler.add_task()
+    probe_points    : list, optional
+        If not None, sample the slice fields at these (grid-aligned) points with a logic.handlers.ProbeHandler
+    probe_iter      : int, optional
+        Number of iterations between probe samples
+    probe_buffer    : int, optional
+        Number of probe samples to hold in memory between file writes
+    max_mode        : int, optional
+        If not None, write the coefficient-space amplitudes of all horizontal modes up to this multiple
+        of the fundamental wavenumber with a logic.handlers.ModeHandler
+    average_window  : float, optional
+        If not None, sample the slices every output_dt and write their means and mean squares once
+        per average_window with a logic.handlers.TimeAverageHandler
+    frame_stride    : int, optional
+        If not None, render quick-look RGB frames of a few slices, downsampled by this stride, at the slice
+        cadence with a logic.rendering.FrameHandler
+    stage_dir       : string, optional
+        If not None, write slices and volumes to this node-local directory and drain them to data_dir
+        in the background with logic.staging.StagedFileHandlers (or a staged logic.handlers.SubVolumeHandler, for
+        windowed volumes). Call logic.staging.finish_staging() before merging.
     """
 
     analysis_tasks = analysis_tasks = OrderedDict()
 
-    analysis_profile = solver.evaluator.add_file_handler(data_dir+"profiles", max_writes=max_writes, parallel=False, sim_dt=output_dt, mode=mode)
-    analysis_scalar = solver.evaluator.add_file_handler(data_dir+"scalar", max_writes=max_writes, parallel=False,    sim_dt=output_dt, mode=mode)
+    if buffer_writes is None:
+        analysis_profile = solver.evaluator.add_file_handler(data_dir+"profiles", max_writes=max_writes, parallel=False, sim_dt=output_dt, mode=mode)
+        analysis_scalar = solver.evaluator.add_file_handler(data_dir+"scalar", max_writes=max_writes, parallel=False,    sim_dt=output_dt, mode=mode)
+    else:
+        analysis_profile = add_buffered_file_handler(solver.evaluator, data_dir+"profiles", buffer_writes=buffer_writes, max_writes=max_writes, parallel=False, sim_dt=output_dt, mode=mode)
+        analysis_scalar  = add_buffered_file_handler(solver.evaluator, data_dir+"scalar",   buffer_writes=buffer_writes, max_writes=max_writes, parallel=False, sim_dt=output_dt, mode=mode)
 
     basic_fields  = ['u_rms', 'v_rms', 'w_rms', 'vel_rms', 'enstrophy', 'T1', 'T1_z', 'T_full', 'ln_rho1', 'rho_full', 'Bx', 'By', 'Bz', 's_over_cp', 's_over_cp_z', 'rho_fluc']
     fluid_numbers = ['Re_rms', 'Pe_rms', 'Ma_rms']
@@ -62,32 +126,199 @@ def initialize_output(solver, domain, data_dir,
     analysis_tasks['scalar'] = analysis_scalar
 
     ix, iy, iz = domain.bases[0].interval, domain.bases[1].interval, domain.bases[-1].interval
-    slices = solver.evaluator.add_file_handler(data_dir+'slices', sim_dt=slice_dt_factor*output_dt, max_writes=max_writes, mode=mode)
+    slices = add_staged_file_handler(solver.evaluator, data_dir+'slices', stage_dir=stage_dir, sim_dt=slice_dt_factor*output_dt, max_writes=max_writes, mode=mode)
+    slice_handlers = [slices]
+    if average_window is not None:
+        averages = TimeAverageHandler(data_dir+'averages', domain, solver.evaluator.vars, window=average_window,
+                                      restart_time=solver.sim_time if mode == 'append' else None,
+                                      sim_dt=output_dt, max_writes=max_writes, mode=mode)
+        solver.evaluator.add_handler(averages)
+        slice_handlers.append(averages)
     slice_fields = ['s_over_cp', 'enstrophy', 'u', 'w', 'T1', 'Vort_y', 'Vort_x', 'Bx', 'By', 'Bz']
     if not magnetic:
         bad_ks = ['Bx', 'By', 'Bz']
         for k in bad_ks: slice_fields.remove(k)
     if not threeD:
         slice_fields.remove('Vort_x')
-    for field in slice_fields:
+    for field, handler in itertools.product(slice_fields, slice_handlers):
         if threeD:
-            slices.add_task("interp({},         y={})".format(field, (iy[0] + iy[1])/2),          name='{}'.format(field))
-            slices.add_task("interp({},         z={})".format(field, iz[0] + (iz[1]-iz[0])*0.95), name='{} near top'.format(field))
-            slices.add_task("interp({},         z={})".format(field, iz[0] + (iz[1]-iz[0])*0.05), name='{} near bot'.format(field))
-            slices.add_task("interp({},         z={})".format(field, (iz[0] + iz[1])/2),          name='{} midplane'.format(field))
+            handler.add_task("interp({},         y={})".format(field, (iy[0] + iy[1])/2),          name='{}'.format(field))
+            handler.add_task("interp({},         z={})".format(field, iz[0] + (iz[1]-iz[0])*0.95), name='{} near top'.format(field))
+            handler.add_task("interp({},         z={})".format(field, iz[0] + (iz[1]-iz[0])*0.05), name='{} near bot'.format(field))
+            handler.add_task("interp({},         z={})".format(field, (iz[0] + iz[1])/2),          name='{} midplane'.format(field))
         else:
-            slices.add_task("{}".format(field), name='{}'.format(field))
+            handler.add_task("{}".format(field), name='{}'.format(field))
     analysis_tasks['slices'] = slices
+    if average_window is not None:
+        analysis_tasks['averages'] = averages
+
+    if frame_stride is not None:
+        frames = FrameHandler(data_dir+'frames', domain, solver.evaluator.vars, stride=frame_stride,
+                              sim_dt=slice_dt_factor*output_dt, max_writes=10*max_writes, mode=mode)
+        solver.evaluator.add_handler(frames)
+        frame_fields = OrderedDict([('s_over_cp', {'remove_mean' : True}), ('w', {}), ('enstrophy', {'cmap' : 'inferno', 'pos_def' : True})])
+        for field, options in frame_fields.items():
+            if threeD:
+                frames.add_task("interp({}, y={})".format(field, (iy[0] + iy[1])/2),          name='{}'.format(field), **options)
+                frames.add_task("interp({}, z={})".format(field, iz[0] + (iz[1]-iz[0])*0.95), name='{} near top'.format(field), **options)
+                frames.add_task("interp({}, z={})".format(field, (iz[0] + iz[1])/2),          name='{} midplane'.format(field), **options)
+            else:
+                frames.add_task("{}".format(field), name='{}'.format(field), **options)
+        analysis_tasks['frames'] = frames
+
+    if probe_points is not None:
+        probes = ProbeHandler(data_dir+'probes', domain, solver.evaluator.vars, probe_points, iter=probe_iter,
+                              buffer_writes=probe_buffer, max_writes=100*probe_buffer, mode=mode)
+        solver.evaluator.add_handler(probes)
+        for field in slice_fields:
+            probes.add_task(field, name=field)
+        analysis_tasks['probes'] = probes
+
+    if max_mode is not None:
+        k_horiz = []
+        for basis in domain.bases[:-1]:
+            k0 = 2*np.pi/(basis.interval[1] - basis.interval[0])
+            k_horiz.append([k for k in basis.wavenumbers if np.abs(k) <= (max_mode + 0.5)*k0])
+        modes = ModeHandler(data_dir+'modes', domain, solver.evaluator.vars, list(itertools.product(*k_horiz)),
+                            sim_dt=output_dt, max_writes=10*max_writes, mode=mode)
+        solver.evaluator.add_handler(modes)
+        mode_fields = ['u', 'v', 'w', 'T1', 'ln_rho1', 'Bx', 'By', 'Bz']
+        if not magnetic:
+            for k in ['Bx', 'By', 'Bz']: mode_fields.remove(k)
+        if not threeD:
+            mode_fields.remove('v')
+        for field in mode_fields:
+            modes.add_task(field, name=field)
+        analysis_tasks['modes'] = modes
 
     if volumes_output and threeD:
-        analysis_volume = solver.evaluator.add_file_handler(data_dir+'volumes', sim_dt=vol_dt_factor*output_dt, max_writes=max_vol_writes, mode=mode)
-        analysis_volume.add_task("T_full")
+        if volume_window is None:
+            analysis_volume = add_staged_file_handler(solver.evaluator, data_dir+'volumes', stage_dir=stage_dir, sim_dt=vol_dt_factor*output_dt, max_writes=max_vol_writes, mode=mode)
+            volume_window = dict()
+        else:
+            analysis_volume = SubVolumeHandler(data_dir+'volumes', domain, solver.evaluator.vars, stage_dir=stage_dir, sim_dt=vol_dt_factor*output_dt, max_writes=max_vol_writes, mode=mode)
+            solver.evaluator.add_handler(analysis_volume)
+        analysis_volume.add_task("T_full", **volume_window)
         if magnetic:
-            analysis_volume.add_task("B_perp")
-            analysis_volume.add_task("Bz")
-            analysis_volume.add_task("u_perp")
-            analysis_volume.add_task("w")
+            analysis_volume.add_task("B_perp", **volume_window)
+            analysis_volume.add_task("Bz", **volume_window)
+            analysis_volume.add_task("u_perp", **volume_window)
+            analysis_volume.add_task("w", **volume_window)
         analysis_tasks['volumes'] = analysis_volume
 
     return analysis_tasks
 
+def output_from_args(args, solver, domain, data_dir, checkpoint, mode, t_buoy, **kwargs):
+    """
+    Set up the output of a driver from its parsed OUTPUT_OPTIONS: the analysis
+    handlers of initialize_output(), whose buffered writes are flushed before
+    each checkpoint, and, if needed, an OutputScheduler for the analysis and
+    checkpoint handlers.
+
+    Parameters
+    ----------
+    args : dict
+        The driver's docopt arguments
+    solver, domain, data_dir : As in initialize_output()
+    checkpoint : logic.checkpointing.Checkpoint
+        The driver's checkpoint (after set_checkpoint())
+    mode : string
+        File mode, "overwrite" or "append"
+    t_buoy : float
+        The buoyancy time, in which the averaging window is given
+    **kwargs : Additional keyword arguments for initialize_output() (e.g., magnetic, threeD, output_dt)
+
+    Returns
+    -------
+    analysis_tasks : OrderedDict
+        The analysis handlers, as returned by initialize_output()
+    scheduler : OutputScheduler
+        The scheduler of the handlers, or None if no option needs one.  Its evaluate()
+        must be called immediately before each solver.step().
+    """
+    buffer_writes = args['--buffer_writes']
+    if buffer_writes is not None:
+        buffer_writes = int(buffer_writes)
+    probe_points = None
+    if args['--probe_z'] is not None:
+        center = [np.mean(basis.interval) for basis in domain.bases[:-1]]
+        probe_points = [center + [float(z)] for z in args['--probe_z'].split(',')]
+    max_mode = args['--max_mode']
+    if max_mode is not None:
+        max_mode = int(max_mode)
+    average_window = args['--average_window']
+    if average_window is not None:
+        average_window = float(average_window)*t_buoy
+    frame_stride = args['--frame_stride']
+    if frame_stride is not None:
+        frame_stride = int(frame_stride)
+    analysis_tasks = initialize_output(solver, domain, data_dir, mode=mode, buffer_writes=buffer_writes,
+                                       probe_points=probe_points, probe_iter=int(args['--probe_iter']),
+                                       max_mode=max_mode, average_window=average_window, frame_stride=frame_stride,
+                                       stage_dir=args['--stage_dir'], **kwargs)
+    checkpoint.add_flush_handlers(analysis_tasks.values())
+
+    scheduler = None
+    if args['--stagger_output'] or args['--io_budget'] is not None or args['--trigger_KE'] is not None:
+        io_budget = args['--io_budget']
+        if io_budget is not None:
+            io_budget = float(io_budget)
+        scheduler = OutputScheduler(solver, io_budget=io_budget)
+        for handler in list(analysis_tasks.values()) + [checkpoint.checkpoint]:
+            # MTBF-driven checkpoints keep their own wall-clock cadence
+            if np.isfinite(handler.sim_dt) and getattr(handler, 'mtbf', None) is None:
+                scheduler.add_handler(handler)
+        if args['--stagger_output']:
+            scheduler.stagger()
+    return analysis_tasks, scheduler
+
+def volume_window_from_args(args):
+    """
+    The volume output window of a 3D driver's parsed VOLUME_OPTIONS, for initialize_output().
+
+    Parameters
+    ----------
+    args : dict
+        The driver's docopt arguments
+
+    Returns
+    -------
+    volume_window : dict
+        Keyword arguments for SubVolumeHandler.add_task(), or None to write full volumes
+    """
+    volume_stride = int(args['--volume_stride'])
+    if args['--volume_z'] is None and volume_stride == 1:
+        return None
+    volume_window = dict(strides={'x' : volume_stride, 'y' : volume_stride})
+    if args['--volume_z'] is not None:
+        volume_window['z_range'] = [float(z) for z in args['--volume_z'].split(',')]
+    return volume_window
+
+def trigger_from_args(args, scheduler, flow, t_buoy):
+    """
+    Add the KE-triggered slice output of a driver's parsed OUTPUT_OPTIONS, if any, to its scheduler.
+
+    Parameters
+    ----------
+    args : dict
+        The driver's docopt arguments
+    scheduler : OutputScheduler
+        The scheduler returned by output_from_args()
+    flow : flow_tools.GlobalFlowProperty
+        The driver's flow properties, which must include 'KE'
+    t_buoy : float
+        The buoyancy time, in which the trigger duration is given
+
+    Returns
+    -------
+    trigger : OutputTrigger
+        The trigger, or None if --trigger_KE was not specified
+    """
+    if args['--trigger_KE'] is None:
+        return None
+    trigger = OutputTrigger(flow, 'KE', float(args['--trigger_KE']), ['slices'],
+                            cadence_factor=float(args['--trigger_factor']),
+                            duration=float(args['--trigger_time'])*t_buoy,
+                            pre_trigger_writes=int(args['--pre_trigger_writes']))
+    scheduler.add_trigger(trigger)
+    return trigger
@@ -0,0 +1,203 @@
+"""
+In-run rendering of 2D slices into colormapped, downsampled RGB frames for
+quick-look movies, without matplotlib.
+
+Colormaps are 256-entry uint8 lookup tables, built by linear interpolation
+between a few anchor colors, so a frame is just a normalization and an index
+into the table.
+"""
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from logic.handlers import RootFileHandler, TIME_SCALES, write_count
+
+logger = logging.getLogger(__name__)
+
+# Anchor colors (RGB, 0-1), evenly spaced in data value
+COLORMAP_ANCHORS = {
+    'RdBu_r'  : [(0.020, 0.188, 0.380), (0.263, 0.576, 0.765), (0.969, 0.969, 0.969), (0.839, 0.376, 0.302), (0.404, 0.000, 0.122)],
+    'viridis' : [(0.267, 0.005, 0.329), (0.231, 0.322, 0.545), (0.129, 0.569, 0.549), (0.369, 0.788, 0.384), (0.993, 0.906, 0.144)],
+    'inferno' : [(0.001, 0.000, 0.014), (0.341, 0.062, 0.429), (0.735, 0.216, 0.330), (0.978, 0.557, 0.035), (0.988, 0.998, 0.645)],
+    'gray'    : [(0.0, 0.0, 0.0), (1.0, 1.0, 1.0)],
+}
+
+
+def colormap_lut(name='RdBu_r', n_colors=256):
+    """
+    Build a colormap lookup table.
+
+    Parameters
+    ----------
+    name : string, optional
+        A key of COLORMAP_ANCHORS
+    n_colors : int, optional
+        Number of entries in the table
+
+    Returns
+    -------
+    lut : NumPy array
+        uint8 array of shape (n_colors, 3)
+    """
+    anchors = np.array(COLORMAP_ANCHORS[name])
+    anchor_values = np.linspace(0, 1, anchors.shape[0])
+    values = np.linspace(0, 1, n_colors)
+    lut = np.zeros((n_colors, 3), dtype=np.uint8)
+    for i in range(3):
+        lut[:,i] = np.round(255*np.interp(values, anchor_values, anchors[:,i]))
+    return lut
+
+def render_frame(data, lut, vmin, vmax):
+    """
+    Map 2D data onto RGB colors.
+
+    Parameters
+    ----------
+    data : NumPy array
+        2D data; the first axis becomes image rows
+    lut : NumPy array
+        A colormap lookup table from colormap_lut()
+    vmin, vmax : floats
+        Data values at the bottom and top of the colormap.  If either is not
+        finite, or vmax <= vmin, all data map to the bottom of the colormap.
+
+    Returns
+    -------
+    frame : NumPy array
+        uint8 array of shape data.shape + (3,).  NaN and -inf data map to the
+        bottom of the colormap, and +inf data to the top.
+    """
+    n_colors = lut.shape[0]
+    if np.isfinite(vmin) and np.isfinite(vmax) and vmax > vmin:
+        scale = (n_colors - 1)/(vmax - vmin)
+    else:
+        vmin, scale = 0, 0
+    with np.errstate(invalid='ignore', over='ignore'):
+        value = np.nan_to_num((data - vmin)*scale, nan=0, posinf=n_colors-1, neginf=0)
+    index = np.clip(value, 0, n_colors-1).astype(np.intp)
+    return lut[index]
+
+
+class FrameHandler(RootFileHandler):
+    """
+    A handler which renders 2D slice tasks into colormapped RGB frames.
+
+    Each process downsamples its local piece of a slice (keeping every
+    stride-th global grid point), the pieces are gathered to the root process,
+    and the root process maps the slice through a colormap lookup table and
+    appends the frame to a gzip-compressed archive, base_path/base_sN.h5:
+        tasks/<name>        : uint8 frames, shape (time x rows x columns x 3)
+        tasks/<name> limits : the (vmin, vmax) of each frame
+    The last basis of the slice runs up the image rows (top of the domain at the top).
+
+    Attributes:
+    -----------
+    stride : int
+        Downsampling stride along each axis
+    frame_options : OrderedDict
+        For each task name, a dict of the colormap lookup table and color limit options
+    """
+
+    compression = 'gzip'
+
+    def __init__(self, *args, stride=1, **kw):
+        """
+        Initialize the handler.
+
+        Parameters
+        ----------
+        stride : int, optional
+            As in class-level docstring
+        *args, **kw : Additional arguments for RootFileHandler
+        """
+        super(FrameHandler, self).__init__(*args, **kw)
+        self.stride = stride
+        self.frame_options = OrderedDict()
+
+    def add_task(self, task, name=None, cmap='RdBu_r', limits=None, remove_mean=False, pos_def=False):
+        """
+        Add a 2D slice task to render.
+
+        Parameters
+        ----------
+        task : string or Dedalus Operand
+            The slice task (constant along exactly one axis in 3D)
+        name : string, optional
+            Name of the task output
+        cmap : string, optional
+            A key of COLORMAP_ANCHORS
+        limits : tuple, optional
+            Fixed (vmin, vmax).  If None, limits are set from each frame.
+        remove_mean : bool, optional
+            If True, remove the mean of each frame before rendering
+        pos_def : bool, optional
+            If True, per-frame limits span from the min to the max value;
+            otherwise they are symmetric about zero.
+        """
+        super(FrameHandler, self).add_task(task, layout='g', name=name, scales=1)
+        self.frame_options[self.tasks[-1]['name']] = {'lut' : colormap_lut(cmap), 'limits' : limits,
+                                                      'remove_mean' : remove_mean, 'pos_def' : pos_def}
+
+    def _local_piece(self, task):
+        """ The downsampled local piece of a task, and its global (downsampled) start index """
+        out = task['out']
+        out.set_scales(task['scales'], keep_data=True)
+        out.require_grid_space()
+        constant = np.array(task['operator'].meta[:]['constant'], dtype=bool)
+        count = write_count(out.layout, task['scales'], constant)
+        start = np.array(out.layout.start(task['scales']))
+        slices, ds_start = [], []
+        for axis in range(self.domain.dim):
+            if constant[axis]:
+                slices.append(slice(0, int(count[axis])))
+                ds_start.append(0)
+            else:
+                first = (-start[axis]) % self.stride
+                slices.append(slice(int(first), int(count[axis]), self.stride))
+                ds_start.append((start[axis] + first)//self.stride)
+        return np.copy(out.data[tuple(slices)].real), ds_start
+
+    def process(self, **kw):
+        """ Gather the downsampled slices to the root process, render them, and write the frames (collective) """
+        pieces = [self._local_piece(task) for task in self.tasks]
+        gathered = self.comm.gather(pieces, root=0)
+        if self.comm.rank == 0:
+            data = OrderedDict()
+            for i, task in enumerate(self.tasks):
+                constant = np.array(task['operator'].meta[:]['constant'], dtype=bool)
+                global_shape = np.array(self.domain.dist.grid_layout.global_shape(task['scales']))
+                shape = [1 if c else int(np.ceil(n/self.stride)) for n, c in zip(global_shape, constant)]
+                plane = np.zeros(shape)
+                for proc_pieces in gathered:
+                    piece, ds_start = proc_pieces[i]
+                    plane[tuple(slice(s, s+n) for s, n in zip(ds_start, piece.shape))] = piece
+                frame, limits = self._render(np.squeeze(plane), self.frame_options[task['name']])
+                data[task['name']] = frame[None,:]
+                data['{:s} limits'.format(task['name'])] = limits[None,:]
+            record = OrderedDict()
+            for k in TIME_SCALES:
+                record[k] = kw.get(k, 0)
+            self.write_block([record], data)
+        self.total_write_num += 1
+
+    def _render(self, plane, options):
+        """ Render a gathered 2D plane into an RGB frame; per-frame means and limits skip non-finite values """
+        finite = plane[np.isfinite(plane)]
+        if finite.size < plane.size:
+            logger.warning('rendering a frame with {} non-finite values'.format(plane.size - finite.size))
+        if finite.size == 0:
+            finite = np.zeros(1)
+        if options['remove_mean']:
+            plane = plane - np.mean(finite)
+            finite = finite - np.mean(finite)
+        if options['limits'] is not None:
+            vmin, vmax = options['limits']
+        elif options['pos_def']:
+            vmin, vmax = np.min(finite), np.max(finite)
+        else:
+            vmax = np.max(np.abs(finite))
+            vmin = -vmax
+        # Last basis runs up the image, top of the domain at the top
+        image = plane.T[::-1,:]
+        return render_frame(image, options['lut'], vmin, vmax), np.array([vmin, vmax])
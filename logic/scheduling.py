@@ -0,0 +1,353 @@
+"""
+Scheduling of Dedalus output handlers by the OutputScheduler, which offsets
+the phases of handler cadences and keeps the summed write cost of each
+iteration within a budget, and of the OutputTriggers which raise handler
+cadences around events.  Only NumPy and h5py are needed; handlers, the
+solver, and its evaluator are used through their Dedalus interfaces.
+"""
+import logging
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+
+from logic.handler_tools import capture_write, write_records
+
+logger = logging.getLogger(__name__)
+
+def estimate_write_cost(handler):
+    """
+    Estimate the cost of one write of a handler as the global number of data points it writes.
+
+    Parameters
+    ----------
+    handler : Dedalus Handler
+        The handler whose tasks are being written
+    """
+    domain = handler.domain
+    cost = 0
+    for task in handler.tasks:
+        constant = task['operator'].meta[:]['constant']
+        points = 1
+        for basis, scale, const in zip(domain.bases, task['scales'], constant):
+            if not const:
+                points *= basis.base_grid_size*scale
+        cost += points
+    return cost
+
+class OutputScheduler:
+    """
+    Takes over the sim_dt scheduling of a set of Dedalus handlers and offsets
+    the phase of each handler's cadence, so that the writes of different handlers
+    (profiles, scalars, slices, volumes, checkpoints) don't pile up on a single iteration.
+    Each handler keeps its sim_dt, so long-run cadences are unchanged.
+
+    OutputTriggers can temporarily raise the cadence of chosen handlers when
+    a cheap diagnostic crosses a threshold, optionally writing ring-buffered
+    pre-trigger data (see add_trigger()).
+
+    Scheduled handlers are removed from the solver's evaluator, so evaluate()
+    must be called once per iteration, immediately before solver.step().
+    Unlike evaluator-scheduled handlers, scheduled handlers do not write at the
+    first iteration; their first write is at their first phase-shifted output time.
+
+    Attributes:
+    -----------
+    entries : OrderedDict
+        For each handler name, a dict with the handler, its sim_dt, cost, phase, and next output time,
+        as well as the state of any triggered output window and pre-trigger ring buffer.
+    io_budget : float
+        The maximum summed write cost per iteration.  Due handlers which would exceed it
+        are postponed to later iterations (most overdue first; one handler is always written).
+    slot_dt : float
+        Width of the stagger phase slots (None until stagger() is called).  Slots are kept
+        at least one timestep wide, and handlers are re-staggered as the timestep changes.
+    solver : Dedalus IVP solver
+        The solver whose handlers are being scheduled
+    """
+
+    def __init__(self, solver, io_budget=None):
+        """
+        Initialize the scheduler.
+
+        Parameters
+        ----------
+        solver : Dedalus IVP solver
+            As in class-level docstring
+        io_budget : float, optional
+            As in class-level docstring.  If None, just minimize the peak cost per iteration.
+        """
+        self.solver = solver
+        self.io_budget = io_budget
+        self.entries = OrderedDict()
+        self.triggers = []
+        self.start_time = time.time()
+        self.slot_dt = None
+        self.max_slots = None
+
+    def add_handler(self, handler, cost=None, name=None):
+        """
+        Take over the scheduling of a handler.
+
+        Parameters
+        ----------
+        handler : Dedalus Handler
+            A handler with a finite sim_dt
+        cost : float, optional
+            Cost of one write.  If None, estimated with estimate_write_cost()
+        name : string, optional
+            A name for the handler.  If None, the name of the handler's output directory.
+        """
+        if not np.isfinite(handler.sim_dt):
+            raise ValueError("OutputScheduler can only schedule handlers with a finite sim_dt")
+        if name is None:
+            name = handler.base_path.stem
+        if cost is None:
+            cost = estimate_write_cost(handler)
+        if handler in self.solver.evaluator.handlers:
+            self.solver.evaluator.handlers.remove(handler)
+        self.entries[name] = {'handler' : handler, 'sim_dt' : handler.sim_dt, 'cost' : cost, 'phase' : 0, 'next_time' : None,
+                              'boost' : 1, 'boost_until' : -np.inf, 'was_boosted' : False, 'last_write_time' : -np.inf,
+                              'ring' : None, 'ring_factor' : 1, 'ring_next_time' : None}
+
+    def stagger(self, n_slots=None, dt=None):
+        """
+        Assign a phase offset to each handler.  Time is divided into slots of width 
+        (smallest sim_dt)/n_slots, and handlers are greedily placed (most expensive first)
+        at the phase in their cadence which minimizes the peak summed cost of any slot.
+
+        Parameters
+        ----------
+        n_slots : int, optional
+            Number of phase slots per smallest cadence.  If None, the number of handlers.
+        dt : float, optional
+            The timestep.  If given, fewer slots are used if needed to keep them at least
+            one timestep wide, since writes in narrower slots land on the same iteration.
+        """
+        if n_slots is None:
+            n_slots = len(self.entries)
+        self.max_slots = n_slots
+        base_dt = np.min([e['sim_dt'] for e in self.entries.values()])
+        if dt is not None:
+            n_slots = int(max(1, min(n_slots, np.floor(base_dt/dt))))
+        slot_dt = base_dt/n_slots
+        self.slot_dt = slot_dt
+        periods = OrderedDict()
+        for k, e in self.entries.items():
+            periods[k] = max(1, int(np.round(e['sim_dt']/slot_dt)))
+        hyperperiod = 1
+        for p in periods.values():
+            hyperperiod = np.lcm(hyperperiod, p)
+        hyperperiod = int(min(hyperperiod, 100*max(periods.values())))
+
+        load = np.zeros(hyperperiod)
+        for k in sorted(self.entries.keys(), key=lambda k: -self.entries[k]['cost']):
+            e, period = self.entries[k], periods[k]
+            best_phase, best_peak = 0, np.inf
+            for phase in range(min(period, hyperperiod)):
+                peak = np.max(load[phase::period]) + e['cost']
+                if peak < best_peak:
+                    best_phase, best_peak = phase, peak
+            load[best_phase::period] += e['cost']
+            e['phase'] = best_phase*slot_dt
+            logger.info('scheduling {} every {:.3e} with phase {:.3e}'.format(k, e['sim_dt'], e['phase']))
+
+        peak = np.max(load)
+        logger.info('peak scheduled output cost per iteration: {:.3e} (unstaggered: {:.3e})'.format(peak, np.sum([e['cost'] for e in self.entries.values()])))
+        if self.io_budget is not None and peak > self.io_budget:
+            logger.warning('output cost {:.3e} exceeds io_budget {:.3e}; some iterations will be over budget'.format(peak, self.io_budget))
+
+        sim_time = self.solver.sim_time
+        for e in self.entries.values():
+            # Handlers which are due (e.g., postponed by the io_budget) stay due
+            if e['next_time'] is None or e['next_time'] > sim_time:
+                e['next_time'] = self._next_time(e, sim_time)
+
+    def _restagger(self, dt):
+        """ Re-stagger if the slots have become narrower than the timestep, or the timestep has shrunk enough for more slots """
+        if self.slot_dt is None:
+            return
+        n_slots = int(np.round(np.min([e['sim_dt'] for e in self.entries.values()])/self.slot_dt))
+        if dt > self.slot_dt or (n_slots < self.max_slots and dt < self.slot_dt/2):
+            logger.info('re-staggering output for timestep {:.3e} (slot width {:.3e})'.format(dt, self.slot_dt))
+            self.stagger(self.max_slots, dt=dt)
+
+    def _cadence(self, entry):
+        """ The current output cadence of a handler, accounting for triggered windows """
+        if self.solver.sim_time < entry['boost_until']:
+            return entry['sim_dt']/entry['boost']
+        return entry['sim_dt']
+
+    def _next_time(self, entry, sim_time, sim_dt=None):
+        """ The first phase-shifted output time of a handler after sim_time """
+        if sim_dt is None:
+            sim_dt = self._cadence(entry)
+        n = np.floor((sim_time - entry['phase'])/sim_dt) + 1
+        return entry['phase'] + n*sim_dt
+
+    def add_trigger(self, trigger):
+        """
+        Add an event trigger, which raises the cadence of some scheduled handlers when it fires.
+
+        Parameters
+        ----------
+        trigger : OutputTrigger
+            The trigger.  Its handler names must be names of handlers in this scheduler.
+        """
+        for k in trigger.handlers:
+            if k not in self.entries.keys():
+                raise ValueError("Trigger handler {} is not scheduled".format(k))
+            e = self.entries[k]
+            if trigger.pre_trigger_writes > 0:
+                e['ring'] = deque(maxlen=max(trigger.pre_trigger_writes, e['ring'].maxlen if e['ring'] is not None else 0))
+                e['ring_factor'] = max(e['ring_factor'], trigger.cadence_factor)
+                e['ring_next_time'] = None
+        self.triggers.append(trigger)
+
+    def _check_triggers(self):
+        """ Check all triggers, and open (or extend) high-cadence output windows for those which fire """
+        sim_time = self.solver.sim_time
+        for trigger in self.triggers:
+            if not trigger.check(sim_time):
+                continue
+            for k in trigger.handlers:
+                e = self.entries[k]
+                was_boosted = sim_time < e['boost_until']
+                e['boost'] = trigger.cadence_factor
+                e['boost_until'] = max(e['boost_until'], sim_time + trigger.duration)
+                if not was_boosted:
+                    logger.info('{} triggered at t = {:.4e}; writing {} every {:.3e} until t = {:.4e}'.format(trigger.name, sim_time, k, self._cadence(e), e['boost_until']))
+                    self._flush_ring(e)
+                    e['next_time'] = sim_time
+
+    def _flush_ring(self, entry):
+        """ Write the pre-trigger writes of a handler that are newer than its last regular write """
+        if entry['ring'] is None:
+            return
+        records = [r for r in entry['ring'] if r['sim_time'] > entry['last_write_time']]
+        if len(records) > 0:
+            logger.info('writing {} pre-trigger writes of {}'.format(len(records), entry['handler'].base_path.stem))
+            write_records(entry['handler'], records)
+            entry['last_write_time'] = records[-1]['sim_time']
+        entry['ring'].clear()
+
+    def evaluate(self, dt):
+        """
+        Check triggers, then evaluate and write the handlers which are due, within the io_budget.
+        Call immediately before solver.step(dt).
+
+        Parameters
+        ----------
+        dt : float
+            The timestep about to be taken
+        """
+        self._restagger(dt)
+        self._check_triggers()
+        sim_time = self.solver.sim_time
+        handlers = []
+        due = OrderedDict()
+        for k, e in self.entries.items():
+            boosted = sim_time < e['boost_until']
+            if e['next_time'] is None or (e['was_boosted'] and not boosted):
+                e['next_time'] = self._next_time(e, sim_time)
+            e['was_boosted'] = boosted
+            if sim_time >= e['next_time']:
+                due[k] = e
+
+        # Write the most overdue handlers first; postponed handlers stay due,
+        # and return to their phase-shifted cadence after their write
+        spent = 0
+        for e in sorted(due.values(), key=lambda e: e['next_time']):
+            if self.io_budget is not None and spent > 0 and spent + e['cost'] > self.io_budget:
+                logger.debug('postponing {} write at t = {:.4e} (io_budget)'.format(e['handler'].base_path.stem, sim_time))
+                continue
+            spent += e['cost']
+            handlers.append(e['handler'])
+            e['next_time'] = self._next_time(e, sim_time)
+            e['last_write_time'] = sim_time
+
+        for k, e in self.entries.items():
+            if k not in due and e['ring'] is not None and sim_time >= e['boost_until']:
+                # Quiet period: keep high-cadence pre-trigger data in memory
+                ring_dt = e['sim_dt']/e['ring_factor']
+                if e['ring_next_time'] is None:
+                    e['ring_next_time'] = self._next_time(e, sim_time, sim_dt=ring_dt)
+                if sim_time >= e['ring_next_time']:
+                    handlers.append(_RingCapture(e['handler'], e['ring']))
+                    e['ring_next_time'] = self._next_time(e, sim_time, sim_dt=ring_dt)
+        if len(handlers) == 0:
+            return
+        world_time = time.time()
+        self.solver.evaluator.evaluate_handlers(handlers, world_time=world_time, wall_time=world_time-self.start_time,
+                                                sim_time=sim_time, timestep=dt, iteration=self.solver.iteration)
+
+class _RingCapture:
+    """ Stands in for a file handler during evaluation; captures its output into a ring buffer instead of writing it """
+
+    def __init__(self, handler, ring):
+        self.handler = handler
+        self.tasks = handler.tasks
+        self.ring = ring
+
+    def process(self, **kw):
+        self.ring.append(capture_write(self.handler, **kw))
+
+class OutputTrigger:
+    """
+    An event trigger for OutputScheduler, defined on a cheap scalar diagnostic
+    tracked by a flow_tools.GlobalFlowProperty.  When the trigger condition is
+    met, the chosen handlers write at a raised cadence for a window of sim time.
+
+    Attributes:
+    -----------
+    cadence_factor : float
+        The factor by which to raise the cadence of the triggered handlers
+    derivative : bool
+        If True, the trigger condition is applied to d(value)/dt rather than value
+    duration : float
+        Sim time that triggered output windows stay open after the condition was last met
+    flow : flow_tools.GlobalFlowProperty
+        The object which tracks the diagnostic
+    handlers : list
+        Names of the scheduled handlers to raise the cadence of
+    name : string
+        Name of the trigger, for logging
+    pre_trigger_writes : int
+        Number of high-cadence writes to keep in memory (and write when the trigger fires)
+    property : string
+        The name of the diagnostic in flow
+    reduction : string
+        The flow method used to reduce the diagnostic to a number, e.g., 'grid_average' or 'max'
+    threshold : float
+        The trigger fires when the diagnostic (or its derivative) is above this value
+    """
+
+    def __init__(self, flow, property, threshold, handlers, cadence_factor=10, duration=1, derivative=False,
+                 reduction='grid_average', pre_trigger_writes=0, name=None):
+        """
+        Initialize the trigger.  All arguments are as in the class-level docstring.
+        """
+        self.flow = flow
+        self.property = property
+        self.threshold = threshold
+        self.handlers = handlers
+        self.cadence_factor = cadence_factor
+        self.duration = duration
+        self.derivative = derivative
+        self.reduction = reduction
+        self.pre_trigger_writes = pre_trigger_writes
+        if name is None:
+            name = 'd({})/dt'.format(property) if derivative else property
+        self.name = name
+        self.last_value = self.last_time = None
+
+    def check(self, sim_time):
+        """ Returns True if the trigger condition is met at sim_time """
+        value = getattr(self.flow, self.reduction)(self.property)
+        if self.derivative:
+            last_value, last_time = self.last_value, self.last_time
+            self.last_value, self.last_time = value, sim_time
+            if last_time is None or sim_time <= last_time:
+                return False
+            value = (value - last_value)/(sim_time - last_time)
+        return value > self.threshold
@@ -0,0 +1,138 @@
+"""
+Node-local staging of per-process output, with an asynchronous drain to shared storage.
+
+A StagedFileHandler writes its per-process set files to a (node-local) stage
+directory, stage_dir/base/base_sN/base_sN_pR.h5, rather than straight to
+base_path.  Whenever a process starts a new set, its completed sets are handed
+to a background thread, which moves them to base_path/base_sN/base_sN_pR.h5, so
+a busy shared filesystem no longer stalls the time loop.  The drain thread only
+moves files; it makes no HDF5 or MPI calls.
+
+The drain thread itself, a logic.handler_tools.SetDrainer, is also used by the
+custom per-process handlers of logic.handlers.  Call finish_staging() on all
+handlers (collectively) before merging output.
+"""
+import logging
+import pathlib
+
+import h5py
+from dedalus.core.evaluator import FileHandler
+
+from logic.handler_tools import SetDrainer
+
+logger = logging.getLogger(__name__.split('.')[-1])
+
+
+class StagedFileHandler(FileHandler):
+    """
+    A per-process Dedalus FileHandler which writes to a node-local stage directory
+    and drains completed sets to base_path in the background.  A set is queued
+    to drain as soon as it holds max_writes writes (e.g., after every write of
+    a max_writes=1 checkpoint handler), or when a new set is started.  If
+    stage_dir is None, it is an ordinary FileHandler.
+
+    Attributes:
+    -----------
+    drainer : SetDrainer
+        The background drain thread (None if not staging)
+    stage_path : pathlib Path
+        The stage directory of this handler, stage_dir/base
+    """
+
+    def __init__(self, base_path, *args, stage_dir=None, mode='overwrite', **kwargs):
+        """
+        Initialize the handler.
+
+        Parameters
+        ----------
+        base_path : string or pathlib Path
+            The (shared) output directory of the handler
+        stage_dir : string or pathlib Path, optional
+            The node-local directory to write to before draining to base_path
+        mode : string, optional
+            "overwrite" or "append", as in Dedalus FileHandlers.
+        *args, **kwargs : Additional arguments for the Dedalus FileHandler
+        """
+        self.stage_path = None
+        self.drainer = None
+        if stage_dir is not None:
+            if kwargs.get('parallel', False):
+                raise ValueError("Staged output is only implemented for per-process (parallel=False) files")
+            base = pathlib.Path(base_path).resolve()
+            self.stage_path = pathlib.Path(stage_dir).resolve().joinpath(base.stem)
+            self.stage_path.mkdir(parents=True, exist_ok=True)
+            rank = args[0].dist.comm_cart.rank
+            drainer = SetDrainer(self.stage_path, base, rank)
+            drainer.recover(mode)
+        super(StagedFileHandler, self).__init__(base_path, *args, mode=mode, **kwargs)
+        if stage_dir is not None:
+            self.drainer = drainer
+
+    @property
+    def current_path(self):
+        """ The current file, in the stage directory if staging """
+        path = super(StagedFileHandler, self).current_path
+        if self.stage_path is None:
+            return path
+        return self.stage_path.joinpath(path.parent.name, path.name)
+
+    def get_file(self):
+        """ Return the current file, starting a new set if the current one has been queued to drain """
+        if self.drainer is not None and self.set_num in self.drainer.queued:
+            self.set_num += 1
+            self.create_current_file()
+        return super(StagedFileHandler, self).get_file()
+
+    def process(self, **kw):
+        """ Write, then queue the current set to drain if it is full """
+        super(StagedFileHandler, self).process(**kw)
+        self.finalize_write()
+        if self.drainer is not None and self.file_write_num >= self.max_writes:
+            self.drainer.drain([self.set_num])
+
+    def finalize_write(self):
+        """ Called after each write, before the set can be drained; subclasses may add to the current file """
+        pass
+
+    def create_current_file(self):
+        """ Start a new set; if staging, queue all earlier staged sets to drain """
+        if self.stage_path is None:
+            return super(StagedFileHandler, self).create_current_file()
+        # Stage directories are node-local, so each process creates its own set folder.
+        self.current_path.parent.mkdir(parents=True, exist_ok=True)
+        self.drainer.drain([n for n in self.drainer.staged_sets() if n < self.set_num and n not in self.drainer.queued])
+        self.file_write_num = 0
+        file = h5py.File(str(self.current_path), 'w-')
+        self.setup_file(file)
+        file.close()
+
+    def finish_drain(self):
+        """ Drain all remaining staged sets (including the current one) and wait for the drain to finish """
+        if self.drainer is None:
+            return
+        self.drainer.drain([n for n in self.drainer.staged_sets() if n not in self.drainer.queued])
+        self.drainer.finish()
+        logger.info('drained {} sets of {} from {}'.format(len(self.drainer.drained), self.base_path, self.stage_path))
+
+def add_staged_file_handler(evaluator, filename, **kw):
+    """ Like evaluator.add_file_handler(), but creates a StagedFileHandler """
+    handler = StagedFileHandler(filename, evaluator.domain, evaluator.vars, **kw)
+    evaluator.add_handler(handler)
+    return handler
+
+def finish_staging(handlers, comm=None):
+    """
+    Finish draining any staged handlers in a collection of handlers.
+
+    Parameters
+    ----------
+    handlers : list
+        Output handlers
+    comm : mpi4py Comm, optional
+        If not None, barrier on this communicator once all processes have drained (e.g., before merging).
+    """
+    for handler in handlers:
+        if hasattr(handler, 'finish_drain'):
+            handler.finish_drain()
+    if comm is not None:
+        comm.Barrier()
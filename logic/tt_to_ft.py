@@ -1,12 +1,15 @@
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import glob
-from copy import deepcopy
+import logging
 
 import h5py
 import numpy as np
 from mpi4py import MPI
 import dedalus.public as de
 
+from logic.archive import window_means
+
+logger = logging.getLogger(__name__)
 
 def sort_file_list(f_list):
     """
@@ -45,66 +48,170 @@ def load_tt(path, avg_time, Lz):
         checks = sort_file_list(glob.glob('{:s}/checkpoint/*.h5'.format(path)))
         checkpoint_TT = checks[-1]
 
-    # Figure out how many scalar / profile files avg_time spans
-    scalar_files  = sort_file_list(glob.glob(  '{:s}/scalar/*.h5'.format(path)))
-    profile_files = sort_file_list(glob.glob('{:s}/profiles/*.h5'.format(path)))
-
-    # Index 0 is scalar, index 1 is profile
-    end_times  = [None, None]
-    good_files = [[], []]
-    n_writes   = np.zeros(2, dtype=np.int32)
-    for i in range(2):
-        for j in range(len(scalar_files)):
-            if i == 0:
-                this_file = scalar_files[-(j+1)]
-            else:
-                this_file = profile_files[-(j+1)]
-            good_files[i].append(this_file)
-            with h5py.File(this_file, 'r') as f:
-                if i == 1 and j == 0: 
-                    nz = len(f['scales/z/1.0'][()])
-                sim_times = f['scales']['sim_time'][()]
-                n_writes[i] += len(sim_times)
-                if end_times[i] is None:
-                    end_times[i] = sim_times[-1]
-                if end_times[i] - sim_times[0] > avg_time: 
-                    break
-    good_scalar_files  = sort_file_list(good_files[0])
-    good_profile_files = sort_file_list(good_files[1])
-
-    #Get average profiles / scalars required for TT-to-FT
-    profiles = OrderedDict()
-    scalars  = OrderedDict()
-    scalar_work_field  = np.zeros(n_writes[0])
-    profile_work_field = np.zeros((n_writes[1], nz))
-    for sk in ['Nu', 's_over_cp_z']:
-        i = 0
-        for this_file in good_scalar_files:
-            with h5py.File(this_file, 'r') as sf:
-                N = len(sf['scales']['sim_time'][()])
-                scalar_work_field[i:i+N] = sf['tasks'][sk][()].squeeze()
-                i += N
-        scalars[sk] = np.mean(scalar_work_field)
-
-    for pk in ['UdotGradw', 'T1']:
-        i = 0
-        for this_file in good_profile_files:
-            with h5py.File(this_file, 'r') as pf:
-                N = len(pf['scales']['sim_time'][()])
-                profile_work_field[i:i+N,:] = pf['tasks'][pk][()].squeeze()
-                i += N
-        profiles[pk] = np.mean(profile_work_field, axis=0)
-    
+    # Average scalars / profiles over the last avg_time of the TT run, reading
+    # only the writes inside the window, with one pass over each file
+    scalars,  n_scalar  = window_means('{:s}/scalar'.format(path),   ['Nu', 's_over_cp_z'], avg_time)
+    profiles, n_profile = window_means('{:s}/profiles'.format(path), ['UdotGradw', 'T1'],   avg_time)
+    for sk in scalars.keys():
+        scalars[sk] = float(scalars[sk])
+    logger.info('averaged {} scalar writes and {} profile writes over the last {} time units'.format(n_scalar, n_profile, avg_time))
+
     scalars['s_over_cp_z'] *= Lz # volume averaged entropy gradient * Lz = delta S
     return checkpoint_TT, profiles, scalars
 
-def structure_bvp(atmo_class, atmo_args, atmo_kwargs, profiles, scalars):
+def bvp_atmosphere(atmo_class, atmo_args, atmo_kwargs, nz, variables):
     """
-    Solves a BVP to get the right FT atmospheric structure
+    Builds an atmosphere on a 1D (z) domain, local to each process, and a NLBVP on it.
 
     Inputs:
     -------
-        atmo_class : The class type of the atmosphere object
+        atmo_class : The class type of the atmosphere object (Polytrope or LinearAtmosphere)
+        atmo_args : tuple
+            args for atmo_class.__init__()
+        atmo_kwargs : dict
+            kwargs for atmo_class.__init__()
+        nz : int
+            z resolution of the BVP
+        variables : list
+            The variables of the NLBVP
+
+    Returns:
+    --------
+        atmosphere, domain, problem, Lz
+    """
+    # Polytropes know their depth on initialization and are built on a
+    # domain later; LinearAtmospheres are built on initialization.
+    if hasattr(atmo_class, 'build_atmosphere'):
+        atmosphere = atmo_class(*atmo_args, **atmo_kwargs)
+        Lz         = atmosphere.Lz
+    else:
+        Lz         = atmo_class.Lz
+    z_basis = de.Chebyshev('z', nz, interval=[0, Lz], dealias=1)
+    domain  = de.Domain([z_basis,], grid_dtype=np.float64, comm=MPI.COMM_SELF)
+    problem = de.NLBVP(domain, variables=variables)
+    if hasattr(atmo_class, 'build_atmosphere'):
+        atmosphere.build_atmosphere(domain, problem)
+    else:
+        atmosphere = atmo_class(domain, problem, *atmo_args, **atmo_kwargs)
+    return atmosphere, domain, problem, Lz
+
+class StructureBVP:
+    """
+    The NLBVP which sets the FT atmospheric structure of a TT-to-FT transformation,
+    built once per atmosphere and resolution and reused for every solve.
+
+    The TT inputs enter as field-valued parameters (T1_FT and
+    UdotGradw_over_dS_TT = UdotGradw_TT/dS_TT), which are refilled before each
+    solve, and each solve's Newton iteration is warm-started from the previous
+    solution whose inputs are nearest (in L2 norm) to the new ones.  Only the
+    last max_solutions solutions are kept.
+
+    Attributes:
+    -----------
+    atmosphere : An atmosphere class object
+        The atmosphere, built on the BVP domain
+    domain : Dedalus Domain object
+        The 1D (z) domain of the BVP (on MPI.COMM_SELF)
+    solver : Dedalus NLBVP solver
+        The solver of the BVP
+    solutions : deque
+        For each of the last max_solutions solves, its inputs and the coefficients of its state fields
+    T1_FT, UdotGradw_over_dS_TT : Dedalus Fields
+        The field-valued parameters of the BVP
+    """
+
+    def __init__(self, atmo_class, atmo_args, atmo_kwargs, nz, max_solutions=16):
+        """
+        Build the BVP.
+
+        Parameters
+        ----------
+        atmo_class : The class type of the atmosphere object (Polytrope or LinearAtmosphere)
+        atmo_args : tuple
+            args for atmo_class.__init__()
+        atmo_kwargs : dict
+            kwargs for atmo_class.__init__()
+        nz : int
+            z resolution of the BVP (that of the TT profiles)
+        max_solutions : int, optional
+            Number of previous solutions to keep for warm starts
+        """
+        self.atmosphere, self.domain, problem, self.Lz = bvp_atmosphere(atmo_class, atmo_args, atmo_kwargs, nz, ['dS', 'S', 'ln_rho1', 'M1'])
+
+        # Feed parameters into the problem (many are fed in through atmosphere class)
+        self.T1_FT = self.domain.new_field()
+        self.UdotGradw_over_dS_TT = self.domain.new_field()
+        problem.parameters['T1_FT'] = self.T1_FT
+        problem.parameters['UdotGradw_over_dS_TT'] = self.UdotGradw_over_dS_TT
+        problem.substitutions['ln_rho0'] = 'log(rho0)'
+
+        # Hydrostatic equilibrium (modified) + mass conservation.
+        problem.add_equation("(T0 + T1_FT)*dz(ln_rho1) = -dz(T1_FT) - T1_FT*ln_rho0_z + dS*UdotGradw_over_dS_TT")
+        problem.add_equation("dz(M1) = rho0*(exp(ln_rho1) - 1)")
+        problem.add_equation("S/Cp = (1/ɣ) * log(T0 + T1_FT) - ((ɣ-1)/ɣ)*(ln_rho0 + ln_rho1)")
+        problem.add_equation("dS = right(S) - left(S)")
+        problem.add_bc(" left(M1) = 0")
+        problem.add_bc("right(M1) = 0")
+        self.solver = problem.build_solver()
+        self.solutions = deque(maxlen=max_solutions)
+
+    def solve(self, T1_FT, UdotGradw_over_dS_TT, tol=1e-10, max_iter=50):
+        """
+        Solve the BVP for new TT inputs.
+
+        Parameters
+        ----------
+        T1_FT, UdotGradw_over_dS_TT : NumPy arrays
+            Grid data of the field-valued parameters
+        tol : float, optional
+            Newton convergence tolerance on the summed absolute perturbation
+        max_iter : int, optional
+            Maximum number of Newton iterations
+
+        Returns
+        -------
+        state : Dedalus FieldSystem
+            The solved state (overwritten by the next solve)
+        """
+        self.T1_FT['g'] = T1_FT
+        self.UdotGradw_over_dS_TT['g'] = UdotGradw_over_dS_TT
+        inputs = np.concatenate((T1_FT, UdotGradw_over_dS_TT))
+
+        state = self.solver.state
+        if len(self.solutions) > 0:
+            nearest = min(self.solutions, key=lambda solution: np.linalg.norm(solution[0] - inputs))
+            for field, coeffs in zip(state.fields, nearest[1]):
+                field['c'] = coeffs
+        else:
+            for field in state.fields:
+                field['c'] = 0
+
+        pert = self.solver.perturbations.data
+        pert.fill(1+tol)
+        n_iter = 0
+        while np.sum(np.abs(pert)) > tol:
+            if n_iter >= max_iter:
+                raise RuntimeError("Structure BVP did not converge in {} iterations".format(max_iter))
+            self.solver.newton_iteration()
+            n_iter += 1
+            logger.debug('pert norm: {} / dS: {:.2e}'.format(np.sum(np.abs(pert)), np.mean(state['dS']['g'])))
+        logger.info('structure BVP converged in {} iterations ({} start)'.format(n_iter, 'warm' if len(self.solutions) > 0 else 'cold'))
+        self.solutions.append((inputs, [np.copy(field['c']) for field in state.fields]))
+        return state
+
+# Structure BVPs, by atmosphere and resolution, least recently used first
+MAX_CACHED_BVPS = 4
+bvp_cache = OrderedDict()
+
+def structure_bvp(atmo_class, atmo_args, atmo_kwargs, profiles, scalars, tol=1e-10, max_iter=50):
+    """
+    Solves a BVP to get the right FT atmospheric structure.  The BVP of each
+    atmosphere and resolution is built once and cached (see StructureBVP); only
+    the MAX_CACHED_BVPS most recently used BVPs are kept.
+
+    Inputs:
+    -------
+        atmo_class : The class type of the atmosphere object (Polytrope or LinearAtmosphere)
         atmo_args : tuple
             args for atmo_class.__init__()
         atmo_kwargs : dict
@@ -113,6 +220,8 @@ def structure_bvp(atmo_class, atmo_args, atmo_kwargs, profiles, scalars):
             A dictionary with profiles required for the BVP
         scalars : OrderedDict
             A dictionary with scalar values required for the BVP
+        tol, max_iter : optional
+            Newton iteration tolerance and maximum number of iterations
     """
 
     # Grab important raw TT values
@@ -121,13 +230,18 @@ def structure_bvp(atmo_class, atmo_args, atmo_kwargs, profiles, scalars):
     T1_TT        = profiles['T1']
     UdotGradw_TT = profiles['UdotGradw']
 
-    # Construct Dedalus setup
-    atmosphere = atmo_class(*atmo_args, **atmo_kwargs)
-    Lz         = atmosphere.Lz
-    z_basis = de.Chebyshev('z', len(T1_TT), interval=[0, Lz], dealias=1)
-    domain  = de.Domain([z_basis,], grid_dtype=np.float64, comm=MPI.COMM_SELF)
-    problem = de.NLBVP(domain, variables = ['dS', 'S', 'ln_rho1', 'M1'])
-    atmosphere.build_atmosphere(domain, problem)
+    # Get the (cached) Dedalus setup
+    key = (atmo_class.__name__, tuple(atmo_args), tuple(sorted(atmo_kwargs.items())), len(T1_TT))
+    if key in bvp_cache:
+        bvp_cache.move_to_end(key)
+    else:
+        bvp_cache[key] = StructureBVP(atmo_class, atmo_args, atmo_kwargs, len(T1_TT))
+        if len(bvp_cache) > MAX_CACHED_BVPS:
+            bvp_cache.popitem(last=False)
+    bvp        = bvp_cache[key]
+    atmosphere = bvp.atmosphere
+    domain     = bvp.domain
+    Lz         = bvp.Lz
     z = domain.grid(0)
 
     # Remove the 1/Cp from dS/Cp
@@ -136,51 +250,69 @@ def structure_bvp(atmo_class, atmo_args, atmo_kwargs, profiles, scalars):
     # Solve out for Temp profile of the FT case
     S0        = domain.new_field()
     T_TT      = domain.new_field()
-    T1_FT     = domain.new_field()
-    UdotGradw = domain.new_field()
 
     grad_ad    = -(atmosphere.g/atmosphere.Cp)
     T_TT['g']  = atmosphere.T0['g'] + T1_TT
-    T_ad       = 1 + grad_ad*(z - Lz)
+    T_top      = np.mean(T_TT.interpolate(z=Lz)['g'])
+    T_ad       = T_top + grad_ad*(z - Lz)
     dT_ad_TT   = np.abs(np.mean(T_TT.interpolate(z=Lz)['g'] - T_TT.interpolate(z=0)['g'])) - np.abs(grad_ad*Lz)
     dT_ad_FT   = dT_ad_TT / Nu
-    T1_FT['g'] = dT_ad_FT*((T_TT['g'] - T_ad)/dT_ad_TT) + T_ad - atmosphere.T0['g']
+    T1_FT      = dT_ad_FT*((T_TT['g'] - T_ad)/dT_ad_TT) + T_ad - atmosphere.T0['g']
 
     # Setup S0, other constants
     S0['g']           = atmosphere.Cp*((1/atmosphere.ɣ)*np.log(atmosphere.T0['g']) - ((atmosphere.ɣ-1)/atmosphere.ɣ)*np.log(atmosphere.rho0['g']))
     dS0               = np.mean(S0.interpolate(z=Lz)['g'] - S0.interpolate(z=0)['g'])
     evolved_Ra_factor = (dS_TT / dS0)
-    UdotGradw['g']    = UdotGradw_TT
-
-    # Feed parameters into the problem (many are fed in through atmosphere class)
-    problem.parameters['T1_FT'] = T1_FT
-    problem.parameters['dS_TT'] = dS_TT
-    problem.parameters['UdotGradw_TT'] = UdotGradw
-    problem.substitutions['ln_rho0'] = 'log(rho0)'
-
-    # Hydrostatic equilibrium (modified) + mass conservation.
-    problem.add_equation("(T0 + T1_FT)*dz(ln_rho1) = -dz(T1_FT) - T1_FT*ln_rho0_z + (dS/dS_TT)*UdotGradw_TT")
-    problem.add_equation("dz(M1) = rho0*(exp(ln_rho1) - 1)")
-    problem.add_equation("S/Cp = (1/ɣ) * log(T0 + T1_FT) - ((ɣ-1)/ɣ)*(ln_rho0 + ln_rho1)")
-    problem.add_equation("dS = right(S) - left(S)")
-    problem.add_bc(" left(M1) = 0")
-    problem.add_bc("right(M1) = 0")
 
     # Solve NLBVP
-    tol = 1e-10
-    solver = problem.build_solver()
-    dS = solver.state['dS']
-    ln_rho1_FT = solver.state['ln_rho1']
-    pert = solver.perturbations.data
-    pert.fill(1+tol)
-    while np.sum(np.abs(pert)) > tol:
-        solver.newton_iteration()
-        print('pert norm: {} / dS: {:.2e}'.format(np.sum(np.abs(pert)), np.mean(dS['g'])))
-
-    dS_FT = np.mean(dS['g'])
+    state = bvp.solve(T1_FT, UdotGradw_TT/dS_TT, tol=tol, max_iter=max_iter)
+    dS_FT = np.mean(state['dS']['g'])
     FT_Ra_factor = (dS0 / dS_FT)*evolved_Ra_factor
     
-    return T1_FT['g'], ln_rho1_FT['g'], dS_FT/dS_TT, dT_ad_FT/dT_ad_TT, FT_Ra_factor
+    return T1_FT, np.copy(state['ln_rho1']['g']), dS_FT/dS_TT, dT_ad_FT/dT_ad_TT, FT_Ra_factor
+
+def structure_bvp_sweep(atmosphere, atmo_args, atmo_kwargs, paths, time, comm=MPI.COMM_WORLD, **kwargs):
+    """
+    Loads the TT data of many runs (e.g., a Ra sweep) and solves their structure
+    BVPs, spread across processes.  Each process takes a contiguous block of
+    runs, so that neighboring runs warm-start each other's BVP solves.
+
+    Inputs:
+    -------
+        atmosphere : An atmosphere class object (e.g., Polytrope)
+            The atmosphere shared by the runs
+        atmo_args : tuple
+            args for atmo_class.__init__()
+        atmo_kwargs : dict
+            kwargs for atmo_class.__init__()
+        paths : list
+            String paths to the TT simulations, ordered along the sweep
+        time : float
+            The amount of simulation time to average profiles and scalar values over from each TT run
+        comm : mpi4py Comm, optional
+            The processes to spread the solves across
+        kwargs : dict, optional
+            Additional keyword arguments for structure_bvp()
+
+    Returns:
+    --------
+        results : list
+            For each run (on every process), (checkpoint_TT, T1_FT, ln_rho1_FT, dS_factor, dT_ad_factor, FT_Ra_factor)
+    """
+    results = OrderedDict()
+    for i in np.array_split(np.arange(len(paths)), comm.size)[comm.rank]:
+        try:
+            checkpoint_TT, profiles, scalars = load_tt(paths[i], time, atmosphere.Lz)
+            results[i] = (checkpoint_TT,) + structure_bvp(atmosphere.__class__, atmo_args, atmo_kwargs, profiles, scalars, **kwargs)
+        except Exception as e:
+            results[i] = e
+    gathered = OrderedDict()
+    for proc_results in comm.allgather(results):
+        gathered.update(proc_results)
+    for i, result in gathered.items():
+        if isinstance(result, Exception):
+            raise RuntimeError("TT-to-FT structure BVP failed for {}: {}".format(paths[i], result))
+    return [gathered[i] for i in range(len(paths))]
 
 
 def tt_to_ft_preliminaries(atmosphere, atmo_args, atmo_kwargs, path, time):
@@ -200,27 +332,81 @@ def tt_to_ft_preliminaries(atmosphere, atmo_args, atmo_kwargs, path, time):
         time : float
             The amount of simulation time to average profiles and scalar values over from the TT run
     """
-    if MPI.COMM_WORLD.rank == 0:
-        # Get average profiles/scalars from TT system
-        checkpoint_TT, profiles, scalars = load_tt(path, time, atmosphere.Lz)
+    comm = MPI.COMM_WORLD
+    header, buffer = None, None
+    if comm.rank == 0:
+        try:
+            # Get average profiles/scalars from TT system
+            checkpoint_TT, profiles, scalars = load_tt(path, time, atmosphere.Lz)
+
+            # Solve TT-to-FT BVP
+            T1_FT, ln_rho1_FT, dS_factor, dT_ad_factor, FT_Ra_factor = structure_bvp(atmosphere.__class__, atmo_args, atmo_kwargs, profiles, scalars)
+            header = (checkpoint_TT, len(T1_FT))
+            buffer = np.concatenate((T1_FT, ln_rho1_FT, [dS_factor, dT_ad_factor, FT_Ra_factor])).astype(np.float64)
+        except Exception as e:
+            header = e
+
+    # Broadcast the profiles and factors in one buffer
+    header = comm.bcast(header, root=0)
+    if isinstance(header, Exception):
+        raise header
+    checkpoint_TT, nz = header
+    if comm.rank != 0:
+        buffer = np.empty(2*nz + 3, dtype=np.float64)
+    comm.Bcast(buffer, root=0)
+    T1_FT, ln_rho1_FT = buffer[:nz], buffer[nz:2*nz]
+    dS_factor, dT_ad_factor, FT_Ra_factor = buffer[2*nz:]
 
-        # Solve TT-to-FT BVP
-        T1_FT, ln_rho1_FT, dS_factor, dT_ad_factor, FT_Ra_factor = structure_bvp(atmosphere.__class__, atmo_args, atmo_kwargs, profiles, scalars)
-    else:
-        checkpoint_TT, T1_FT, ln_rho1_FT, dS_factor, dT_ad_factor, FT_Ra_factor = [None]*6
+    return checkpoint_TT, T1_FT, ln_rho1_FT, dS_factor, dT_ad_factor, FT_Ra_factor
+
+def reset_mean_state(solver, T1_profile, ln_rho1_profile, T1_factor, velocity_factor):
+    """
+    Replaces the horizontally-averaged thermodynamic state of a simulation and
+    rescales its fluctuations.  Works for 2D, 3D, and MHD states, modifying the
+    distributed state fields in place.
 
-    checkpoint_TT   = MPI.COMM_WORLD.bcast(checkpoint_TT, root=0)
-    T1_FT           = MPI.COMM_WORLD.bcast(T1_FT, root=0)
-    ln_rho1_FT      = MPI.COMM_WORLD.bcast(ln_rho1_FT, root=0)
-    dS_factor       = MPI.COMM_WORLD.bcast(dS_factor, root=0)
-    dT_ad_factor    = MPI.COMM_WORLD.bcast(dT_ad_factor, root=0)
-    FT_Ra_factor    = MPI.COMM_WORLD.bcast(FT_Ra_factor, root=0)
+    Inputs:
+    -------
+        solver : Dedalus solver object
+            The solver whose state is modified
+        T1_profile : NumPy array
+            new mean profile of T1 (on the z grid, at scales=1)
+        ln_rho1_profile : NumPy array
+            new profile of ln_rho1 (on the z grid, at scales=1)
+        T1_factor : float
+            factor by which T1 fluctuations about the horizontal mean are multiplied
+        velocity_factor : float
+            factor by which velocities (and magnetic fields) are multiplied
+    """
+    domain = solver.domain
+    horizontal = [basis.name for basis in domain.bases[:-1]]
+    area = np.prod([basis.interval[1] - basis.interval[0] for basis in domain.bases[:-1]])
+    z_slice = domain.dist.grid_layout.slices(scales=1)[-1]
 
-    return checkpoint_TT, T1_FT, ln_rho1_FT, dS_factor, dT_ad_factor, FT_Ra_factor
+    # Rescale temperature fluctuations about the horizontal mean, and replace the mean with the new profile
+    T1 = solver.state['T1']
+    T1.set_scales(1, keep_data=True)
+    T1_mean = T1.integrate(*horizontal)
+    T1_mean.set_scales(1, keep_data=True)
+    T1['g'] = T1_factor*(T1['g'] - T1_mean['g']/area) + T1_profile[z_slice]
+    T1.differentiate('z', out=solver.state['T1_z'])
+
+    #No fluctuations in ln_rho to ensure mass conservation.
+    ln_rho1 = solver.state['ln_rho1']
+    ln_rho1.set_scales(1, keep_data=False)
+    ln_rho1['g'] = ln_rho1_profile[z_slice]
+
+    # Velocities (and magnetic fields, keeping the ratio of magnetic to kinetic
+    # energy) scale together.  Scaling is linear, so it is done in whatever
+    # layout each field is in, without transforms.
+    for field in solver.state.fields:
+        if field.name in ['u', 'v', 'w', 'u_z', 'v_z', 'w_z', 'Bx', 'By', 'Bz', 'Ax', 'Ay', 'Az', 'phi']:
+            field.data *= velocity_factor
 
 def tt_to_ft(solver, checkpoint, atmosphere, checkpoint_TT, T1_FT, ln_rho1_FT, dS_factor, dT_ad_factor):
     """
-    Starts an FT simulation from an equilibrated TT simulation.
+    Starts an FT simulation from an equilibrated TT simulation.  Works for 2D,
+    3D, and MHD states, modifying the distributed state fields in place.
 
     Inputs:
     -------
@@ -242,43 +428,9 @@ def tt_to_ft(solver, checkpoint, atmosphere, checkpoint_TT, T1_FT, ln_rho1_FT, d
             evolved superaiabatic temperature jump across domain in FT simulation (normalized by the TT one)
     """
     dt = checkpoint.restart(checkpoint_TT, solver)
-    T1 = solver.state['T1']
-    T1_z = solver.state['T1_z']
-    ln_rho1 = solver.state['ln_rho1']
-    u  = solver.state['u']
-    w  = solver.state['w']
-    uz = solver.state['u_z']
-    wz = solver.state['w_z']
-
-    z_slice = solver.domain.dist.grid_layout.slices(scales=1)[-1]
-
-    #Needs to be generalized to 3D
+    velocity_factor = np.sqrt(dS_factor)
+    reset_mean_state(solver, T1_FT, ln_rho1_FT, dT_ad_factor, velocity_factor)
 
-    T1.set_scales(solver.domain.dealias, keep_data=True)
-    T1['g'] -= T1.integrate('x')['g']/solver.domain.bases[0].interval[-1]
-    T1['g'] *= dT_ad_factor
-    T1.set_scales(1, keep_data=True)
-    T1_fluc = np.copy(T1['g'])
-    T1.set_scales(1, keep_data=True)
-    T1['g'] += T1_FT[z_slice]
-    T1.differentiate('z', out=T1_z)
-
-
-    #No fluctuations in ln_rho to ensure mass conservation.
-    ### non-mass-conserving -- atmosphere.T0.set_scales(1, keep_data=True)
-    ### non-mass-conserving -- ln_rho_fluc = -np.log(1 + T1_fluc / (T1_FT[z_slice] + atmosphere.T0['g']))
-    ln_rho1['g'] *= 0
-    ln_rho1.set_scales(1, keep_data=True)
-    ln_rho1['g'] = ln_rho1_FT[z_slice] ### + ln_rho_fluc
-
-    u['g'] *= np.sqrt(dS_factor)
-    w['g'] *= np.sqrt(dS_factor)
-    u.differentiate('z', out=uz)
-    w.differentiate('z', out=wz)
-
-    dt /= np.sqrt(dS_factor)
-    print(solver, dt)
+    dt /= velocity_factor
+    logger.info('starting FT run with dt = {:.3e}'.format(dt))
     return solver, dt
-
-
-
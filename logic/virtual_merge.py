@@ -0,0 +1,112 @@
+"""
+Zero-copy alternatives to dedalus.tools.post.merge_process_files() and merge_analysis().
+
+Rather than copying every per-process file into a joined file, the joined
+file holds HDF5 virtual datasets which stitch together the per-process pieces
+into a global view.  The joined file has the same layout as a file produced by
+post.merge_process_files(), so solver.load_state(), Checkpoint.restart(), and the
+plotting file readers can all use it directly.
+
+The virtual datasets reference their sources by paths relative to the joined
+file, so the base directory can be moved as a whole, but the per-process set
+folders must NOT be deleted.
+"""
+import logging
+import pathlib
+
+import h5py
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def _process_number(path):
+    """ Returns the process number of a per-process file, e.g. checkpoint_s1_p12.h5 -> 12 """
+    return int(pathlib.Path(path).stem.split('_p')[-1])
+
+def merge_virtual_set(set_path):
+    """
+    Create a joined file of virtual datasets for a single set of per-process output files.
+
+    Parameters
+    ----------
+    set_path : string or pathlib Path
+        Path to the per-process set folder, e.g., data_dir/checkpoint/checkpoint_s1/
+
+    Returns
+    -------
+    joint_path : pathlib Path
+        Path to the joined file, e.g., data_dir/checkpoint/checkpoint_s1.h5
+    """
+    set_path = pathlib.Path(set_path)
+    joint_path = set_path.parent.joinpath('{:s}.h5'.format(set_path.stem))
+    proc_paths = sorted(set_path.glob('{:s}_p*.h5'.format(set_path.stem)), key=_process_number)
+    if len(proc_paths) == 0:
+        logger.warning('no process files found in {}'.format(set_path))
+        return None
+    logger.info('Virtually merging {} process files into {}'.format(len(proc_paths), joint_path))
+
+    with h5py.File(str(joint_path), 'w') as joint_file:
+        with h5py.File(str(proc_paths[0]), 'r') as proc_file:
+            for attr in ['set_number', 'handler_name', 'checksum']:
+                if attr in proc_file.attrs:
+                    joint_file.attrs[attr] = proc_file.attrs[attr]
+            writes = proc_file['scales/write_number'].shape[0]
+            joint_file.attrs['writes'] = writes
+            # Scales are global (and small); copy them.
+            scale_group = joint_file.create_group('scales')
+            proc_file['scales'].visititems(lambda name, obj: _copy_scale(scale_group, name, obj))
+            layouts = {}
+            for name, dset in proc_file['tasks'].items():
+                global_shape = tuple(dset.attrs['global_shape'])
+                layouts[name] = h5py.VirtualLayout(shape=(writes,) + global_shape, dtype=dset.dtype)
+            task_attrs = {name: dict(dset.attrs) for name, dset in proc_file['tasks'].items()}
+
+        for proc_path in proc_paths:
+            source_file = str(proc_path.relative_to(joint_path.parent))
+            with h5py.File(str(proc_path), 'r') as proc_file:
+                for name, dset in proc_file['tasks'].items():
+                    start = dset.attrs['start']
+                    count = dset.attrs['count']
+                    if np.prod(count) == 0:
+                        continue
+                    source = h5py.VirtualSource(source_file, 'tasks/{:s}'.format(name), shape=dset.shape)
+                    spatial_slices = tuple(slice(int(s), int(s+c)) for (s, c) in zip(start, count))
+                    layouts[name][(slice(0, writes),) + spatial_slices] = source[(slice(0, writes),) + tuple(slice(0, int(c)) for c in count)]
+
+        task_group = joint_file.create_group('tasks')
+        for name, layout in layouts.items():
+            joint_dset = task_group.create_virtual_dataset(name, layout, fillvalue=0)
+            for attr in ['task_number', 'constant', 'grid_space', 'scales']:
+                if attr in task_attrs[name]:
+                    joint_dset.attrs[attr] = task_attrs[name][attr]
+            joint_dset.attrs['global_shape'] = task_attrs[name]['global_shape']
+            joint_dset.attrs['start'] = 0
+            joint_dset.attrs['count'] = task_attrs[name]['global_shape']
+    return joint_path
+
+def _copy_scale(scale_group, name, obj):
+    """ h5py visititems() callback which copies scale datasets (without dimension scale bookkeeping) """
+    if isinstance(obj, h5py.Dataset):
+        scale_group.create_dataset(name, data=obj[()])
+
+def merge_virtual(base_path, comm=None):
+    """
+    Virtually merge all per-process sets of a file handler.  Drop-in
+    replacement for post.merge_analysis(base_path) / post.merge_process_files(base_path).
+
+    Parameters
+    ----------
+    base_path : string or pathlib Path
+        Base path of the file handler, e.g., data_dir/checkpoint/
+    comm : mpi4py Comm, optional
+        Sets are distributed over the processes of this communicator (default: MPI.COMM_WORLD).
+    """
+    if comm is None:
+        from mpi4py import MPI
+        comm = MPI.COMM_WORLD
+    base_path = pathlib.Path(base_path)
+    set_paths = sorted([p for p in base_path.glob('{:s}_s*'.format(base_path.stem)) if p.is_dir()])
+    for set_path in set_paths[comm.rank::comm.size]:
+        merge_virtual_set(set_path)
+    comm.Barrier()
@@ -29,11 +29,13 @@ class FileReader:
         lists of string paths to output files that this processor is responsible for reading, split by sub_dirs
     run_dir : str
         Path to root dedalus directory
+    write_slices : OrderedDict
+        For consolidated archive files, the slice of archive writes that falls within the requested files
     sub_dirs : list
         List of strings of subdirectories in run_dir to consider files in
     """
 
-    def __init__(self, run_dir, sub_dirs=['slices',], num_files=[None,], start_file=1, comm=MPI.COMM_WORLD, **kwargs):
+    def __init__(self, run_dir, sub_dirs=['slices',], num_files=[None,], start_file=1, comm=MPI.COMM_WORLD, use_archive=True, **kwargs):
         """
         Initializes the file reader.
 
@@ -49,11 +51,14 @@ class FileReader:
             File number to start reading from (1 by default)
         comm : mpi4py Comm, optional
             As defined in class-level docstring
+        use_archive : bool, optional
+            If True, read from a consolidated archive (e.g., run_dir/profiles.h5) in place of set files when one exists.
         **kwargs : Additional keyword arguments for the self._distribute_files() function.
         """
         self.run_dir    = os.path.expanduser(run_dir)
         self.sub_dirs   = sub_dirs
         self.file_lists = OrderedDict()
+        self.write_slices = OrderedDict()
         self.comm       = comm
         if comm.rank == 0:
            print('reading files from {}'.format(run_dir))
@@ -61,6 +66,11 @@ class FileReader:
            sys.stdout.flush()
 
         for d, n in zip(sub_dirs, num_files):
+            archive = '{:s}/{:s}.h5'.format(self.run_dir, d)
+            if use_archive and os.path.exists(archive):
+                self.file_lists[d] = (archive,)
+                self.write_slices[archive] = self._archive_writes(archive, start_file, n)
+                continue
             files = []
             for f in os.listdir('{:s}/{:s}/'.format(self.run_dir, d)):
                 if f.endswith('.h5'):
@@ -76,6 +86,28 @@ class FileReader:
         self._distribute_files(**kwargs)
 
 
+    def _archive_writes(self, archive, start_file, n_files):
+        """
+        Find the writes in a consolidated archive that came from the requested set files.
+
+        Arguments:
+        ----------
+        archive : string
+            string path to the archive file
+        start_file : integer
+            First set number to read
+        n_files : integer
+            Number of sets to read. If None, read them all.
+        """
+        with h5py.File(archive, 'r') as f:
+            set_nums = f['scales']['set_number'][()]
+        first = np.searchsorted(set_nums, start_file, side='left')
+        if n_files is None:
+            last = len(set_nums)
+        else:
+            last = np.searchsorted(set_nums, start_file+n_files, side='right')
+        return slice(int(first), int(last))
+
     def _distribute_files(self, distribution='one'):
         """
         Distribute files across MPI processes according to a given type of file distribution.
@@ -144,13 +176,14 @@ class FileReader:
         """
         out_bases = OrderedDict()
         out_tasks = OrderedDict()
+        writes = self.write_slices.get(file_name, slice(None))
         with h5py.File(file_name, 'r') as f:
             for b in bases:
                 out_bases[b] = f['scales/{:s}/1.0'.format(b)][()]
-            out_write_num = f['scales']['write_number'][()]
-            out_sim_time = f['scales']['sim_time'][()]
+            out_write_num = f['scales']['write_number'][writes]
+            out_sim_time = f['scales']['sim_time'][writes]
             for t in tasks:
-                out_tasks[t] = f['tasks'][t][()]
+                out_tasks[t] = f['tasks'][t][writes]
         return out_bases, out_tasks, out_write_num, out_sim_time
 
 class SingleFiletypePlotter():
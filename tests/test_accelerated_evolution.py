@@ -0,0 +1,77 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+from logic.ae_tools import add_profile_sample, mean_profiles, superadiabatic_jump, velocity_factor, state_change
+
+
+class ThreadComm():
+    """ The Allreduce of an MPI communicator, over ranks run as threads """
+
+    def __init__(self, rank, size, barrier, slots):
+        self.rank, self.size = rank, size
+        self.barrier, self.slots = barrier, slots
+
+    def Allreduce(self, sendbuf, recvbuf):
+        self.barrier.wait()
+        self.slots[self.rank] = np.copy(sendbuf)
+        self.barrier.wait()
+        recvbuf[:] = np.sum(self.slots, axis=0)
+        self.barrier.wait()
+
+def run_ranks(size, fn):
+    barrier, slots, results = threading.Barrier(size, timeout=10), [None]*size, [None]*size
+    def run(rank):
+        results[rank] = fn(ThreadComm(rank, size, barrier, slots))
+    threads = [threading.Thread(target=run, args=(rank,)) for rank in range(size)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+nx, nz = 6, 8
+samples = [np.random.RandomState(i).standard_normal((2, nx, nz)) for i in range(3)]
+
+def profiles(comm, x_slice, z_slice):
+    """ The averaged profiles of the samples, from this rank's local (x, z) part """
+    sums, counts = OrderedDict([('F_conv', np.zeros(nz)), ('T1', np.zeros(nz))]), np.zeros(nz)
+    for sample in samples:
+        add_profile_sample(sums, counts, OrderedDict(zip(['F_conv', 'T1'], sample[:, x_slice, z_slice])), z_slice)
+    return mean_profiles(comm, sums, counts)
+
+@pytest.mark.parametrize("slices", [
+    # 2D: z split unevenly over processes, x local
+    [(slice(0, nx), slice(0, 2)), (slice(0, nx), slice(2, 5)), (slice(0, nx), slice(5, nz))],
+    # 3D: a 2x2 mesh, with x standing in for the distributed horizontal axis
+    [(slice(0, 2), slice(0, 3)), (slice(2, nx), slice(0, 3)), (slice(0, 2), slice(3, nz)), (slice(2, nx), slice(3, nz))],
+])
+def test_profiles_independent_of_processes(slices):
+    serial,   = run_ranks(1, lambda comm: profiles(comm, slice(0, nx), slice(0, nz)))
+    for name, data in zip(['F_conv', 'T1'], np.mean(samples, axis=(0, 2))):
+        assert np.allclose(serial[name], data)
+    for parallel in run_ranks(len(slices), lambda comm: profiles(comm, *slices[comm.rank])):
+        for name in serial.keys():
+            assert np.allclose(parallel[name], serial[name])
+
+def test_profiles_unsampled_z():
+    # No rank holds the top of the domain yet
+    results = run_ranks(2, lambda comm: profiles(comm, slice(0, nx), [slice(0, 3), slice(3, 5)][comm.rank]))
+    assert results == [None, None]
+
+
+def test_velocity_factor():
+    dT0_sad = 2.
+    # a**2 = dT_sad / dT_sad_evolved
+    assert superadiabatic_jump(dT0_sad, 0.5, 0.1) == 2.4
+    assert np.isclose(velocity_factor(dT0_sad, 0.5, 0.1, 0.1, 0.5), np.sqrt(2.4/1.6))
+    # The closure of the AE BVP, written with dT_sad_ratio = dT0_sad / dT_sad_evolved
+    ratio = dT0_sad/superadiabatic_jump(dT0_sad, 0.1, 0.5)
+    assert np.isclose(velocity_factor(dT0_sad, 0.5, 0.1, 0.1, 0.5)**2, ratio*(1 + (0.5 - 0.1)/dT0_sad))
+    # An unchanged state is unchanged, and has no change
+    assert velocity_factor(dT0_sad, 0.3, 0.2, 0.3, 0.2) == 1
+    assert state_change(1, np.ones(4), np.ones(4), dT0_sad) == 0
+    assert state_change(1.01, np.ones(4), np.ones(4) + 0.1, dT0_sad) == pytest.approx(0.05)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip("h5py")
+
+from logic.archive import consolidate_handler, find_writes, window_means, archive_path
+
+
+def write_set(handler_path, num, sim_time, write_number):
+    """ A merged set file whose task T is sim_time at each of 4 z points """
+    handler_path.mkdir(exist_ok=True)
+    path = handler_path / '{:s}_s{:d}.h5'.format(handler_path.name, num)
+    with h5py.File(str(path), 'w') as f:
+        f.attrs['handler_name'] = handler_path.name
+        f['scales/sim_time']     = np.array(sim_time, dtype=np.float64)
+        f['scales/write_number'] = np.array(write_number, dtype=np.int64)
+        f['scales/iteration']    = np.array(write_number, dtype=np.int64)
+        f['scales/z/1.0']        = np.linspace(0, 1, 4)
+        f['tasks/T']             = np.array(sim_time)[:,None]*np.ones(4)
+    return path
+
+
+def test_consolidate_incremental(tmp_path):
+    handler_path = tmp_path / 'profiles'
+    write_set(handler_path, 1, [0, 1, 2], [1, 2, 3])
+    write_set(handler_path, 2, [3, 4], [4, 5])
+    archive_file = consolidate_handler(handler_path)
+    assert archive_file == archive_path(handler_path)
+    with h5py.File(str(archive_file), 'r') as f:
+        assert list(f['scales/sim_time']) == [0, 1, 2, 3, 4]
+        assert list(f['scales/set_number']) == [1, 1, 1, 2, 2]
+        assert np.allclose(f['scales/z/1.0'], np.linspace(0, 1, 4))
+
+    # Again, with new writes in set 2, and after an overwrite-mode restart
+    # whose write numbers start back at 1
+    write_set(handler_path, 2, [3, 4, 5], [4, 5, 6])
+    write_set(handler_path, 3, [4.5, 6, 7], [1, 2, 3])
+    consolidate_handler(handler_path)
+    consolidate_handler(handler_path)
+    with h5py.File(str(archive_file), 'r') as f:
+        assert list(f['scales/sim_time']) == [0, 1, 2, 3, 4, 5, 6, 7]
+        assert list(f['scales/set_number']) == [1, 1, 1, 2, 2, 2, 3, 3]
+        assert list(f['scales/write_number']) == [1, 2, 3, 4, 5, 6, 2, 3]
+        assert np.allclose(f['tasks/T'][:,0], f['scales/sim_time'][()])
+        assert f.attrs['writes'] == 8
+        assert find_writes(f, 2, 5) == slice(2, 6)
+        assert find_writes(f, 5.5) == slice(6, 8)
+
+
+def test_window_means_by_sim_time(tmp_path):
+    handler_path = tmp_path / 'profiles'
+    write_set(handler_path, 1, [0, 1, 2, 3], [1, 2, 3, 4])
+    consolidate_handler(handler_path)
+    # Set 1 is both archived and still on disk; set 2 restarted from t = 2
+    write_set(handler_path, 2, [2, 4, 5, 6], [1, 2, 3, 4])
+
+    means, n_writes = window_means(handler_path, ['T'], 3)
+    assert n_writes == 4
+    assert np.allclose(means['T'], np.mean([3, 4, 5, 6]))
+
+    means, n_writes = window_means(handler_path, ['T'], 10, chunk_writes=2)
+    assert n_writes == 7
+    assert np.allclose(means['T'], np.mean([0, 1, 2, 3, 4, 5, 6]))
+
+
+def test_window_means_no_output(tmp_path):
+    (tmp_path / 'profiles').mkdir()
+    with pytest.raises(ValueError):
+        window_means(tmp_path / 'profiles', ['T'], 1)
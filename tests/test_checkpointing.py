@@ -0,0 +1,399 @@
+import itertools
+import threading
+import types
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip("h5py")
+
+from logic.checkpoint_files import optimal_interval, expected_overhead, select_evictions, set_time, set_bytes, \
+                                   crc32, add_checksums, verify_checksums, read_header, scan_process_set, \
+                                   newest_shared_set, newest_local_set, set_file_path, load_hyperslabs, load_process_set, \
+                                   partner_shift, exchange_pieces, DoubleBufferedWriter
+
+
+def test_optimal_interval():
+    # Daly: sqrt(2*cost*mtbf)*(1 + sqrt(cost/(2*mtbf))/3 + cost/(18*mtbf)) - cost
+    assert np.isclose(optimal_interval(1, 50), 10*(1 + 0.1/3 + 0.01/9) - 1)
+    # Writes as slow as the failures: checkpoint every mtbf
+    assert optimal_interval(200, 50) == 50
+
+def test_expected_overhead():
+    write, rework = expected_overhead(10, 1, 50)
+    assert np.isclose(write, 0.1)
+    assert np.isclose(rework, 0.11)
+    # The optimal interval minimizes the total
+    intervals = np.linspace(2, 40, 200)
+    totals = [sum(expected_overhead(i, 1, 50)) for i in intervals]
+    # (to first order in cost/mtbf)
+    assert np.isclose(intervals[np.argmin(totals)], optimal_interval(1, 50), rtol=0.1)
+
+
+@pytest.fixture
+def sets():
+    return OrderedDict((n, {'sim_time' : 10.*n, 'bytes' : 100}) for n in range(1, 11))
+
+@pytest.mark.parametrize("kwargs, evict", [
+    ({},                                   []),
+    ({'keep_last' : 2},                    [1, 2, 3, 4, 5, 6, 7]),
+    ({'keep_last' : 2, 'keep_every' : 35}, [2, 3, 5, 6]),
+    ({'max_bytes' : 450},                  [1, 2, 3, 4, 5, 6]),
+    ({'keep_every' : 35, 'max_bytes' : 450}, [1, 2, 3, 5, 6, 8]),
+    ({'keep_last' : 2, 'max_bytes' : 100}, [1, 2, 3, 4, 5, 6, 7]),
+])
+def test_select_evictions(sets, kwargs, evict):
+    assert select_evictions(sets, 9, **kwargs) == evict
+
+def test_set_time_and_bytes(tmp_path):
+    # A set being merged: its process files, and a merged file missing its writes
+    set_path = tmp_path / 'checkpoint_s3'
+    set_path.mkdir()
+    for rank in range(2):
+        with h5py.File(str(set_path / 'checkpoint_s3_p{:d}.h5'.format(rank)), 'w') as f:
+            f['scales/sim_time'] = [2.5]
+    with h5py.File(str(tmp_path / 'checkpoint_s3.h5'), 'w') as f:
+        f.create_dataset('scales/sim_time', shape=(0,), dtype=np.float64)
+    paths = [tmp_path / 'checkpoint_s3.h5', set_path]
+    assert set_time(paths) == 2.5
+    assert set_bytes(paths) == sum(p.stat().st_size for p in [paths[0]] + list(set_path.iterdir()))
+    assert np.isnan(set_time([tmp_path / 'checkpoint_s3.h5']))
+
+
+def write_set(path, data, checksum=True):
+    with h5py.File(str(path), 'w') as f:
+        f.attrs['checksum'] = checksum
+        f.create_dataset('tasks/T', data=data)
+        if checksum:
+            for i, d in enumerate(data):
+                add_checksums(f, {'T' : crc32(d)}, i)
+
+def test_verify_checksums(tmp_path):
+    path = tmp_path / 'checkpoint_s1.h5'
+    write_set(path, np.arange(12.).reshape(3, 4))
+    assert verify_checksums(path) == 1
+    with h5py.File(str(path), 'r+') as f:
+        f['tasks/T'][1, 2] = -1
+    assert verify_checksums(path, index=0) == 1
+    with pytest.raises(ValueError):
+        verify_checksums(path, index=1)
+
+def test_verify_checksums_no_writes(tmp_path):
+    # A file whose datasets were created, but never written
+    path = tmp_path / 'checkpoint_s1.h5'
+    with h5py.File(str(path), 'w') as f:
+        f.attrs['checksum'] = True
+        f.create_dataset('scales/write_number', shape=(0,), maxshape=(None,), dtype=np.int64)
+        dset = f.create_dataset('tasks/T', shape=(0, 4), maxshape=(None, 4), dtype=np.float64)
+        dset.attrs['crc32'] = np.zeros(0, dtype=np.uint32)
+    with pytest.raises(ValueError):
+        verify_checksums(path)
+    with h5py.File(str(path), 'r') as f, pytest.raises(ValueError):
+        read_header(f, -1)
+
+def test_verify_checksums_missing(tmp_path):
+    path = tmp_path / 'checkpoint_s1.h5'
+    write_set(path, np.zeros((1, 4)))
+    with h5py.File(str(path), 'r+') as f:
+        del f['tasks/T'].attrs['crc32']
+    with pytest.raises(ValueError):
+        verify_checksums(path)
+
+
+def write_piece(path, start, count, complete=True, sim_time=1.):
+    with h5py.File(str(path), 'w') as f:
+        f.attrs['complete'] = complete
+        f['scales/sim_time'] = [sim_time]
+        dset = f.create_dataset('tasks/T', shape=(1,) + tuple(count), dtype=np.float64)
+        dset.attrs['global_shape'] = [8, 4]
+        dset.attrs['grid_space']   = [True, True]
+        dset.attrs['start']        = start
+        dset.attrs['count']        = count
+
+def test_scan_process_set(tmp_path):
+    set_path = tmp_path / 'checkpoint_s1'
+    set_path.mkdir()
+    write_piece(set_path / 'checkpoint_s1_p1.h5', [4, 0], [4, 4])
+    write_piece(set_path / 'checkpoint_s1_p0.h5', [0, 0], [4, 4])
+    pieces, tasks = scan_process_set(set_path)
+    assert [p.name for p, _ in pieces] == ['checkpoint_s1_p0.h5', 'checkpoint_s1_p1.h5']
+    assert [list(piece['T'][0]) for _, piece in pieces] == [[0, 0], [4, 0]]
+    assert list(tasks['T']['global_shape']) == [8, 4]
+
+    write_piece(set_path / 'checkpoint_s1_p1.h5', [4, 0], [4, 4], complete=False)
+    with pytest.raises(ValueError):
+        scan_process_set(set_path)
+
+
+class Comm():
+    """ The collectives of an mpi4py communicator, as seen by rank 0, given what the other ranks contribute to each allgather """
+
+    def __init__(self, others=()):
+        self.rank, self.size = 0, 1 + len(others)
+        self.others = list(others)
+
+    def bcast(self, obj, root=0):
+        return obj
+
+    def allgather(self, obj):
+        return [obj] + [contributions.pop(0) for contributions in self.others]
+
+def test_newest_shared_set(tmp_path):
+    checkpoint_dir = tmp_path / 'checkpoint'
+    for n, complete in [(1, True), (2, True), (3, False)]:
+        set_path = checkpoint_dir / 'checkpoint_s{:d}'.format(n)
+        set_path.mkdir(parents=True)
+        write_piece(set_path / 'checkpoint_s{:d}_p0.h5'.format(n), [0, 0], [4, 4], sim_time=n)
+        write_piece(set_path / 'checkpoint_s{:d}_p1.h5'.format(n), [4, 0], [4, 4], complete=complete, sim_time=n)
+    # Set 2 is missing the piece of process 1; set 3 has an incomplete piece
+    (checkpoint_dir / 'checkpoint_s2' / 'checkpoint_s2_p1.h5').unlink()
+    path, sim_time = newest_shared_set(checkpoint_dir, Comm())
+    assert (path, sim_time) == (checkpoint_dir / 'checkpoint_s1', 1)
+
+    # A complete merged file is preferred to its set folder
+    with h5py.File(str(checkpoint_dir / 'checkpoint_s2.h5'), 'w') as f:
+        f.attrs['complete'] = True
+        f['scales/sim_time'] = [2.]
+    path, sim_time = newest_shared_set(checkpoint_dir, Comm())
+    assert (path, sim_time) == (checkpoint_dir / 'checkpoint_s2.h5', 2)
+
+def write_local(path, sim_time, holder=None, complete=True, size=2):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with h5py.File(str(path), 'w') as f:
+        f.attrs['complete'] = complete
+        f.attrs['mpi_size'] = size
+        if holder is not None:
+            f.attrs['holder'] = holder
+        f['scales/sim_time'] = [sim_time]
+
+def test_newest_local_set(tmp_path):
+    base_path, partner_path = tmp_path / 'local_checkpoint', tmp_path / 'local_checkpoint_partner'
+    # Process 0 has its own files of sets 1 and 2, and a copy of process 1's file of set 2
+    write_local(set_file_path(base_path, 1, 0), 1.)
+    write_local(set_file_path(base_path, 2, 0), 2.)
+    write_local(set_file_path(partner_path, 2, 1), 2., holder=0)
+    # A copy held by another process sharing the node-local directory
+    write_local(set_file_path(partner_path, 3, 1), 3., holder=2)
+    # Process 1 lost its file of set 2, and has only its own file of set 1
+    comm = Comm(others=[[{1 : 1.}, []]])
+    assert newest_local_set(base_path, partner_path, comm) == (2, 2., {1 : 0})
+
+    # Without the copy, set 1 is the newest complete set
+    set_file_path(partner_path, 2, 1).unlink()
+    comm = Comm(others=[[{1 : 1.}, []]])
+    assert newest_local_set(base_path, partner_path, comm) == (1, 1., {})
+
+    # Files written with another number of processes are not used
+    write_local(set_file_path(base_path, 1, 0), 1., size=4)
+    comm = Comm(others=[[{1 : 1.}, []]])
+    assert newest_local_set(base_path, partner_path, comm) == (None, None, {})
+
+
+@pytest.mark.parametrize('names, shift', [
+    (['a', 'a', 'b', 'b'], 2),
+    (['a', 'b', 'a', 'b'], 1),
+    (['a', 'a', 'a', 'b', 'b', 'b'], 3),
+    (['a', 'a'], 1),
+])
+def test_partner_shift(names, shift):
+    assert partner_shift(names) == shift
+
+class PairComm():
+    """ The point-to-point calls of an mpi4py communicator, with a process sending to itself """
+
+    def __init__(self):
+        self.pickled = 0
+
+    def sendrecv(self, obj, dest, source):
+        self.pickled += 1
+        return obj
+
+    def Sendrecv(self, sendbuf, dest, recvbuf, source):
+        np.copyto(recvbuf, sendbuf)
+
+def test_exchange_pieces():
+    comm = PairComm()
+    pieces = OrderedDict()
+    pieces['T'] = {'data' : np.arange(6.).reshape(2, 3), 'count' : np.array([2, 3]), 'start' : np.array([4, 0])}
+    pieces['u'] = {'data' : np.ones((2, 3), dtype=np.complex128), 'count' : np.array([2, 3]), 'start' : np.array([4, 0])}
+    received = exchange_pieces(comm, pieces, 1, 1)
+    assert list(received['T']['start']) == [4, 0]
+    assert received['u']['data'].dtype == np.complex128
+    # Later exchanges only send data, into the same buffers
+    buffer = received['T']['data']
+    pieces['T']['data'] = pieces['T']['data'] + 1
+    received = exchange_pieces(comm, pieces, 1, 1, received=received)
+    assert comm.pickled == 1
+    assert received['T']['data'] is buffer
+    assert np.array_equal(buffer, np.arange(1., 7.).reshape(2, 3))
+    assert buffer is not pieces['T']['data']
+
+
+
+class Layout():
+    """ A grid layout of an (8, 4) grid, of which a process holds the given slices """
+
+    grid_space = [True, True]
+
+    def __init__(self, slices):
+        self.local_slices = slices
+
+    def global_shape(self, scales):
+        return (8, 4)
+
+    def slices(self, scales):
+        return self.local_slices
+
+    def local_shape(self, scales):
+        return tuple(sl.stop - sl.start for sl in self.local_slices)
+
+    def start(self, scales):
+        return tuple(sl.start for sl in self.local_slices)
+
+class Field():
+    """ A state field, which stores the data it is set to """
+
+    def __init__(self, name):
+        self.name = name
+        self.data = None
+
+    def set_scales(self, scales, keep_data=True):
+        pass
+
+    def __setitem__(self, layout, data):
+        self.data = data
+
+class Solver():
+    """ The state, time and domain of a Dedalus IVP solver on one process """
+
+    def __init__(self, slices):
+        self.domain = types.SimpleNamespace(dealias=(1, 1), dist=types.SimpleNamespace(layouts=[Layout(slices)]))
+        self.state = types.SimpleNamespace(fields=[Field('T')])
+        self.iteration = self.sim_time = None
+
+class RootComm():
+    """ The collectives of an mpi4py communicator of size processes, run one rank at a time, rank 0 first """
+
+    def __init__(self, size):
+        self.rank, self.size = 0, size
+        self.root = {}
+
+    def bcast(self, obj, root=0):
+        if self.rank == root:
+            self.root['bcast'] = obj
+        return self.root['bcast']
+
+    def allgather(self, obj):
+        return [obj]
+
+    def allreduce(self, obj):
+        return obj
+
+def write_process_file(path, data, start, count):
+    """ A checkpoint process file of 2 writes of the [start, start+count) piece of data, with checksums """
+    piece = data[(slice(None),) + tuple(slice(s, s+c) for s, c in zip(start, count))]
+    with h5py.File(str(path), 'w') as f:
+        f.attrs['complete'] = True
+        f.attrs['checksum'] = True
+        f['scales/sim_time'] = [1., 2.]
+        f['scales/iteration'] = [10, 20]
+        f['scales/timestep'] = [0.1, 0.05]
+        f['scales/write_number'] = [1, 2]
+        dset = f.create_dataset('tasks/T', data=piece)
+        dset.attrs['global_shape'] = [8, 4]
+        dset.attrs['grid_space'] = [True, True]
+        dset.attrs['start'] = start
+        dset.attrs['count'] = count
+        for i, d in enumerate(piece):
+            add_checksums(f, {'T' : crc32(d)}, i)
+
+def test_load_hyperslabs(tmp_path):
+    data = np.random.RandomState(4).standard_normal((2, 8, 4))
+    path = tmp_path / 'checkpoint_s1.h5'
+    write_process_file(path, data, [0, 0], [8, 4])
+    # Each process reads only its own slices; the last holds none
+    comm = RootComm(3)
+    for rank, slices in enumerate([(slice(0, 5), slice(0, 4)), (slice(5, 8), slice(0, 4)), (slice(8, 8), slice(0, 4))]):
+        comm.rank = rank
+        solver = Solver(slices)
+        assert load_hyperslabs(solver, path, index=0, comm=comm) == (1, 0.1)
+        assert (solver.iteration, solver.sim_time) == (10, 1.)
+        assert np.array_equal(solver.state.fields[0].data, data[(0,) + slices])
+
+    with h5py.File(str(path), 'w') as f:
+        f.create_dataset('scales/write_number', shape=(0,), dtype=np.int64)
+    with pytest.raises(ValueError):
+        load_hyperslabs(Solver((slice(0, 8), slice(0, 4))), path, comm=RootComm(1))
+
+def test_load_process_set_new_mesh(tmp_path):
+    data = np.random.RandomState(3).standard_normal((2, 8, 4))
+    set_path = tmp_path / 'checkpoint_s1'
+    set_path.mkdir()
+    # Written by two processes splitting x, read by four processes splitting x and z
+    write_process_file(set_path / 'checkpoint_s1_p0.h5', data, [0, 0], [5, 4])
+    write_process_file(set_path / 'checkpoint_s1_p1.h5', data, [5, 0], [3, 4])
+    comm = RootComm(4)
+    for rank, slices in enumerate(itertools.product([slice(0, 4), slice(4, 8)], [slice(0, 2), slice(2, 4)])):
+        comm.rank = rank
+        solver = Solver(slices)
+        write_num, dt = load_process_set(solver, set_path, comm=comm)
+        assert (write_num, dt) == (2, 0.05)
+        assert (solver.iteration, solver.sim_time) == (20, 2.)
+        assert np.array_equal(solver.state.fields[0].data, data[(1,) + slices])
+
+def test_load_process_set_errors(tmp_path):
+    data = np.zeros((2, 8, 4))
+    set_path = tmp_path / 'checkpoint_s1'
+    set_path.mkdir()
+    with pytest.raises(FileNotFoundError):
+        load_process_set(Solver((slice(0, 8), slice(0, 4))), set_path, comm=RootComm(1))
+    write_process_file(set_path / 'checkpoint_s1_p0.h5', data, [0, 0], [8, 4])
+    with h5py.File(str(set_path / 'checkpoint_s1_p0.h5'), 'r+') as f:
+        f['tasks/T'][0, 1, 1] = 1
+    # The first write is corrupted; the second still loads
+    load_process_set(Solver((slice(0, 8), slice(0, 4))), set_path, comm=RootComm(1))
+    with pytest.raises(ValueError):
+        load_process_set(Solver((slice(0, 8), slice(0, 4))), set_path, index=0, comm=RootComm(1))
+
+
+def test_double_buffered_writer():
+    release = threading.Event()
+    written = []
+    def write(buffer, set_num):
+        release.wait()
+        written.append((set_num, buffer['T'].copy()))
+    writer = DoubleBufferedWriter(write)
+    data = np.zeros(4)
+    writer.copy({'T' : data}, 1)
+    # The buffers are copies, independent of the data and each other
+    data[:] = 1
+    writer.copy({'T' : data}, 2)
+    data[:] = 2
+    assert writer.buffers[0]['T'] is not writer.buffers[1]['T']
+    assert not any(event.is_set() for event in writer.buffer_free)
+
+    # Both buffers are queued, so a third copy waits for the first write
+    third = threading.Thread(target=writer.copy, args=({'T' : data}, 3))
+    third.start()
+    third.join(0.1)
+    assert third.is_alive() and not written
+    release.set()
+    third.join()
+    writer.wait()
+    assert [n for n, _ in written] == [1, 2, 3]
+    for n, buffer in written:
+        assert np.array_equal(buffer, np.full(4, n-1.))
+    assert all(event.is_set() for event in writer.buffer_free)
+
+def test_double_buffered_writer_errors():
+    def write(buffer, set_num):
+        if set_num == 1:
+            raise OSError('disk full')
+    writer = DoubleBufferedWriter(write)
+    for set_num in range(1, 4):
+        writer.copy({'T' : np.ones(2)}, set_num)
+    # A failed write frees its buffer, and later writes go ahead
+    writer.wait()
+    assert writer.n_copies == 3
+    assert all(event.is_set() for event in writer.buffer_free)
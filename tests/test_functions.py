@@ -0,0 +1,34 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from logic.functions import pencil_noise
+
+
+def split(n, parts):
+    """ The slices of n points split into parts blocks, as in a Dedalus distribution """
+    edges = np.linspace(0, n, parts+1).astype(int)
+    return [slice(int(a), int(b)) for a, b in zip(edges[:-1], edges[1:])]
+
+@pytest.mark.parametrize('global_shape, mesh', [
+    ((16, 12), (1, 4)),
+    ((16, 12), (1, 5)),
+    ((16, 12), (3, 2)),
+    ((8, 6, 10), (1, 2, 3)),
+])
+def test_pencil_noise_mesh(global_shape, mesh):
+    whole = pencil_noise(global_shape, tuple(slice(0, n) for n in global_shape), seed=7)
+    assert whole.shape == tuple(global_shape)
+    # Each process draws only its own pencils, bit-identical to the whole grid's
+    pieces = np.zeros(global_shape)
+    for slices in itertools.product(*[split(n, parts) for n, parts in zip(global_shape, mesh)]):
+        pieces[slices] = pencil_noise(global_shape, slices, seed=7)
+    assert np.array_equal(pieces, whole)
+
+def test_pencil_noise_streams():
+    noise = pencil_noise((32, 4, 4), (slice(0, 32), slice(0, 4), slice(0, 4)), seed=7)
+    # Pencils are distinct, and change with the seed
+    pencils = noise.reshape(32, -1).T
+    assert len(np.unique(pencils[:,0])) == 16
+    assert not np.array_equal(noise, pencil_noise((32, 4, 4), (slice(0, 32), slice(0, 4), slice(0, 4)), seed=8))
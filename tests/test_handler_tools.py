@@ -0,0 +1,186 @@
+import itertools
+from collections import OrderedDict
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip("h5py")
+
+from logic.handler_tools import TIME_SCALES, write_records, intersect_window, snap_points, owned_points, \
+                                mode_indices, local_modes, save_running_sums, load_running_sums, \
+                                SetDrainer
+
+
+class SetFileHandler():
+    """ The set bookkeeping of a per-process Dedalus FileHandler, writing task T of shape (3,) """
+
+    def __init__(self, base_path, max_writes):
+        self.base_path = base_path
+        self.max_writes = max_writes
+        self.set_num = 0
+        self.file_write_num = 0
+        self.total_write_num = 0
+        self.tasks = [{'name': 'T'}]
+
+    def get_file(self):
+        if (self.set_num == 0) or (self.file_write_num >= self.max_writes):
+            self.set_num += 1
+            self.file_write_num = 0
+            with h5py.File(str(self.current_path), 'w') as file:
+                for k in TIME_SCALES + ['write_number']:
+                    file.create_dataset('scales/' + k, shape=(0,), maxshape=(None,), dtype=np.float64)
+                file.create_dataset('tasks/T', shape=(0, 3), maxshape=(None, 3), dtype=np.float64)
+        return h5py.File(str(self.current_path), 'a')
+
+    @property
+    def current_path(self):
+        return self.base_path / 'profiles_s{:d}.h5'.format(self.set_num)
+
+
+def record(n):
+    return {'sim_time': 0.5*n, 'world_time': 0, 'wall_time': 0, 'timestep': 0.5, 'iteration': n,
+            'tasks': {'T': n*np.ones(3)}}
+
+
+def test_write_records_across_sets(tmp_path):
+    handler = SetFileHandler(tmp_path, max_writes=4)
+    write_records(handler, [record(n) for n in range(3)])
+    write_records(handler, [record(n) for n in range(3, 10)])
+    assert handler.total_write_num == 10
+    assert handler.set_num == 3
+
+    sim_time, write_number, T = [], [], []
+    for num, writes in [(1, 4), (2, 4), (3, 2)]:
+        with h5py.File(str(tmp_path / 'profiles_s{:d}.h5'.format(num)), 'r') as f:
+            assert f.attrs['writes'] == writes
+            sim_time += list(f['scales/sim_time'])
+            write_number += list(f['scales/write_number'])
+            T.append(f['tasks/T'][()])
+    assert sim_time == [0.5*n for n in range(10)]
+    assert write_number == list(range(1, 11))
+    assert np.array_equal(np.concatenate(T), np.arange(10)[:,None]*np.ones(3))
+
+def test_write_records_empty(tmp_path):
+    handler = SetFileHandler(tmp_path, max_writes=4)
+    write_records(handler, [])
+    assert handler.set_num == 0
+    assert not any(tmp_path.iterdir())
+
+
+@pytest.mark.parametrize('window', [slice(0, 16, 1), slice(3, 14, 1), slice(1, 16, 3), slice(5, 6, 4)])
+def test_intersect_window_pieces(window):
+    # Pieces of the window on 3 processes holding grid indices [0, 5), [5, 11), [11, 16)
+    data = np.arange(16)
+    pieces = np.zeros(len(range(16)[window]), dtype=int) - 1
+    for local in [slice(0, 5), slice(5, 11), slice(11, 16)]:
+        size, start, count, data_slice = intersect_window(window, local)
+        local_data = data[local][data_slice]
+        assert len(local_data) == count
+        assert np.all(pieces[start:start+count] == -1)
+        pieces[start:start+count] = local_data
+    assert size == len(pieces)
+    assert np.array_equal(pieces, data[window])
+
+def test_intersect_window_empty():
+    assert intersect_window(slice(2, 8, 2), slice(8, 12)) == (3, 0, 0, slice(0, 0))
+    # Local points between strided window points
+    assert intersect_window(slice(0, 16, 4), slice(5, 8))[1:3] == (0, 0)
+
+
+def test_snap_points_nearest_grid():
+    x = np.linspace(0, 4, 8, endpoint=False)
+    z = 0.5*(1 - np.cos(np.pi*(np.arange(6) + 0.5)/6))
+    indices, snapped = snap_points([(1.1, 0.45), (3.9, 0.02), (-1, 2)], [x, z])
+    # Points outside the domain snap to its edges
+    assert indices.tolist() == [[2, 2], [7, 0], [0, 5]]
+    assert np.allclose(snapped[0], (x[2], z[2]))
+    assert np.allclose(snapped[1], (x[7], z[0]))
+
+def test_owned_points():
+    indices = np.array([[2, 2], [7, 0], [0, 5], [5, 3]])
+    data = np.arange(48).reshape((8, 6))
+    owned_by = np.zeros(len(indices), dtype=int)
+    # Four processes, splitting x in two and z in two
+    for local in [(slice(0, 4), slice(0, 3)), (slice(4, 8), slice(0, 3)), (slice(0, 4), slice(3, 6)), (slice(4, 8), slice(3, 6))]:
+        owned, local_indices = owned_points(indices, local)
+        owned_by[owned] += 1
+        assert np.array_equal(data[local][local_indices], data[tuple(indices[owned].T)])
+    assert owned_by.tolist() == [1, 1, 1, 1]
+
+
+def test_mode_indices():
+    kx = 2*np.pi/4*np.array([0, 1, 2, 3, -4, -3, -2, -1])
+    ky = 2*np.pi/2*np.arange(4)
+    indices = mode_indices([(0, 0), (np.pi/2, np.pi), (-np.pi/2, 3*np.pi)], [kx, ky])
+    assert indices.tolist() == [[0, 0], [1, 1], [7, 3]]
+    with pytest.raises(ValueError):
+        mode_indices([(np.pi/4, 0)], [kx, ky], names=['x', 'y'])
+
+def test_local_modes_gather():
+    rng = np.random.RandomState(2)
+    data = rng.standard_normal((8, 4, 6)) + 1j*rng.standard_normal((8, 4, 6))
+    indices = np.array([[0, 0], [1, 1], [7, 3], [4, 2]])
+    modes = np.zeros((len(indices), 6), dtype=np.complex128)
+    # Four processes, splitting kx and z
+    for local in itertools.product([slice(0, 5), slice(5, 8)], [slice(0, 4)], [slice(0, 2), slice(2, 6)]):
+        for m, z_slice, amplitudes in local_modes(indices, local, data[local]):
+            modes[m, z_slice] = amplitudes
+    assert np.array_equal(modes, data[indices[:,0], indices[:,1], :])
+
+
+def test_running_sums_round_trip(tmp_path):
+    path = tmp_path / 'averages_running_sums' / 'p0.h5'
+    sums = OrderedDict([('w', np.arange(6.).reshape((2, 3))), ('w_sq', np.arange(6.).reshape((2, 3))**2)])
+    last_sample = {'sim_time' : 2.5, 'iteration' : 40}
+    save_running_sums(path, 2.5, 7, 1.25, sums, last_sample)
+    n_samples, window_start, loaded, loaded_sample = load_running_sums(path, 2.5)
+    assert (n_samples, window_start) == (7, 1.25)
+    assert list(loaded.keys()) == ['w', 'w_sq']
+    assert all(np.array_equal(loaded[k], sums[k]) for k in sums)
+    assert loaded_sample == last_sample
+    # Only restored at the time they were saved at
+    assert load_running_sums(path, 2.5 + 1e-6) is None
+
+def test_running_sums_empty_window(tmp_path):
+    path = tmp_path / 'p0.h5'
+    save_running_sums(path, 1, 7, 0.5, OrderedDict([('w', np.ones(3))]), {})
+    # Saving again replaces the file
+    save_running_sums(path, 2, 0, None, OrderedDict(), {})
+    assert load_running_sums(path, 2) == (0, None, OrderedDict(), {})
+    assert not path.with_suffix('.tmp').exists()
+
+
+def stage_file(stage_path, set_num, rank):
+    path = stage_path / 'volumes_s{:d}'.format(set_num) / 'volumes_s{:d}_p{:d}.h5'.format(set_num, rank)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with h5py.File(str(path), 'w') as f:
+        f['tasks/T'] = np.full(4, set_num)
+    return path
+
+def test_set_drainer(tmp_path):
+    stage_path, base_path = tmp_path / 'stage' / 'volumes', tmp_path / 'data' / 'volumes'
+    for set_num in [1, 2, 3]:
+        stage_file(stage_path, set_num, 0)
+    other = stage_file(stage_path, 1, 1)
+    drainer = SetDrainer(stage_path, base_path, 0)
+    assert drainer.staged_sets() == [1, 2, 3]
+    drainer.drain([1, 2])
+    drainer.finish()
+    assert drainer.drained == {1, 2}
+    assert drainer.staged_sets() == [3]
+    for set_num in [1, 2]:
+        with h5py.File(str(drainer.file_paths(set_num)[1]), 'r') as f:
+            assert np.all(f['tasks/T'][()] == set_num)
+    # Files of other processes on the node stay staged, and so does their set folder
+    assert other.exists()
+    assert not (stage_path / 'volumes_s2').exists()
+
+@pytest.mark.parametrize('mode', ['append', 'overwrite'])
+def test_set_drainer_recover(tmp_path, mode):
+    stage_path, base_path = tmp_path / 'stage' / 'volumes', tmp_path / 'data' / 'volumes'
+    staged = stage_file(stage_path, 4, 0)
+    drainer = SetDrainer(stage_path, base_path, 0)
+    drainer.recover(mode)
+    drainer.finish()
+    assert not staged.exists()
+    assert drainer.file_paths(4)[1].exists() == (mode == 'append')
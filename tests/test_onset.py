@@ -0,0 +1,36 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("dedalus.public")
+
+from logic.fc_equations import FCEquations2D
+from logic.polytrope    import Polytrope
+from logic.onset        import OnsetEVP
+
+# Nearly Boussinesq: a thin (n_rho = 0.01), nearly adiabatic polytrope
+ATMO_ARGS = (0.01, 1e-4)
+BCS       = ['temp_L', 'temp_R', 'stressfree', 'impenetrable']
+
+
+def onset_evp(kx, nz=32):
+    return OnsetEVP(FCEquations2D(), Polytrope, ATMO_ARGS, {}, BCS, nz, kx, Pr=1)
+
+
+def test_critical_Ra_boussinesq():
+    # Rayleigh-Benard onset between stress-free, fixed-temperature plates:
+    # Ra_c = 27*pi**4/4 at kx = pi/(sqrt(2)*Lz)
+    Lz = Polytrope(*ATMO_ARGS).Lz
+    evp = onset_evp([np.pi/np.sqrt(2)/Lz])
+    kx, Ra_crit = evp.critical_Ra(1e2, 1e4, rtol=1e-5)
+    assert np.isclose(Ra_crit[0], 27*np.pi**4/4, rtol=3e-2)
+
+def test_set_Ra():
+    # Rescaling a built EVP matches building it at the new Rayleigh number
+    Lz = Polytrope(*ATMO_ARGS).Lz
+    kx = np.pi/np.sqrt(2)/Lz*np.arange(1, 3)
+    evp = onset_evp(kx)
+    evp.growth_rates(1e3)
+    solver = evp.solver
+    growth = evp.growth_rates(2e3)[1]
+    assert evp.solver is solver
+    assert np.allclose(growth, onset_evp(kx).growth_rates(2e3)[1])
@@ -0,0 +1,135 @@
+import pathlib
+
+import numpy as np
+import pytest
+
+import logic.scheduling
+from logic.scheduling import OutputScheduler, OutputTrigger
+
+
+class Evaluator():
+    """ The handler list of a Dedalus evaluator, recording which handlers are evaluated at each iteration """
+
+    def __init__(self, handlers):
+        self.handlers = list(handlers)
+        self.writes = []
+
+    def evaluate_handlers(self, handlers, **kw):
+        self.writes.append((kw['iteration'], [h.base_path.stem for h in handlers if isinstance(h, Handler)]))
+        for handler in handlers:
+            handler.process(**kw)
+
+class Solver():
+    """ The time and evaluator of a Dedalus IVP solver """
+
+    def __init__(self, handlers):
+        self.sim_time = 0
+        self.iteration = 0
+        self.evaluator = Evaluator(handlers)
+
+    def step(self, dt):
+        self.sim_time += dt
+        self.iteration += 1
+
+class Handler():
+    """ A handler with a sim_dt and an output directory, recording the times of its writes """
+
+    def __init__(self, name, sim_dt):
+        self.base_path = pathlib.Path(name)
+        self.sim_dt = sim_dt
+        self.tasks = []
+        self.times = []
+        self.pre_trigger_times = []
+
+    def process(self, **kw):
+        self.times.append(kw['sim_time'])
+
+
+class Flow():
+    """ The grid_average of a GlobalFlowProperty, from a function of sim_time """
+
+    def __init__(self, solver, function):
+        self.solver = solver
+        self.function = function
+
+    def grid_average(self, name):
+        return self.function(self.solver.sim_time)
+
+
+def run(handlers, io_budget=None, stagger=True, costs=None, dt=0.125, n_steps=160, trigger=None):
+    solver = Solver(handlers)
+    scheduler = OutputScheduler(solver, io_budget=io_budget)
+    for handler in handlers:
+        cost = 1 if costs is None else costs[handler.base_path.stem]
+        scheduler.add_handler(handler, cost=cost)
+    if stagger:
+        scheduler.stagger(dt=dt)
+    if trigger is not None:
+        scheduler.add_trigger(trigger(solver))
+    for i in range(n_steps):
+        scheduler.evaluate(dt)
+        solver.step(dt)
+    return solver, scheduler
+
+
+def test_add_handler_takes_over_evaluator():
+    handlers = [Handler('profiles', 1), Handler('slices', 2)]
+    solver, scheduler = run(handlers, n_steps=0)
+    assert solver.evaluator.handlers == []
+    assert list(scheduler.entries.keys()) == ['profiles', 'slices']
+    with pytest.raises(ValueError):
+        scheduler.add_handler(Handler('volumes', np.inf), cost=1)
+
+def test_stagger_spreads_writes():
+    handlers = [Handler('profiles', 1), Handler('scalars', 1), Handler('slices', 2)]
+    solver, scheduler = run(handlers)
+    phases = [e['phase'] for e in scheduler.entries.values()]
+    assert len(set(phases)) == 3
+    # No two handlers write on the same iteration, and cadences are unchanged
+    writes = solver.evaluator.writes
+    assert all(len(names) == 1 for i, names in writes)
+    for handler in handlers:
+        times = [0.125*i for i, names in writes if handler.base_path.stem in names]
+        assert len(times) >= 9
+        assert np.allclose(np.diff(times), handler.sim_dt, atol=0.125)
+
+def test_stagger_slots_at_least_one_timestep():
+    handlers = [Handler('profiles', 1), Handler('scalars', 1), Handler('slices', 1)]
+    solver, scheduler = run(handlers, dt=0.4, n_steps=0)
+    assert scheduler.slot_dt >= 0.4
+
+def test_io_budget_postpones_writes():
+    handlers = [Handler('profiles', 1), Handler('scalars', 1), Handler('volumes', 1)]
+    costs = {'profiles' : 1, 'scalars' : 1, 'volumes' : 4}
+    solver, scheduler = run(handlers, io_budget=4, stagger=False, costs=costs)
+    writes = solver.evaluator.writes
+    for i, names in writes:
+        assert names == ['volumes'] or sum(costs[k] for k in names) <= 4
+    # Postponed writes land on the next iteration, and keep their cadence
+    iterations = {k : [i for i, names in writes if k in names] for k in costs}
+    assert iterations['profiles'] == iterations['scalars']
+    assert all(abs(i - j) == 1 for i, j in zip(iterations['profiles'], iterations['volumes']))
+    assert [len(v) for v in iterations.values()] == [19, 19, 19]
+
+def test_trigger_writes_ring_buffer(monkeypatch):
+    monkeypatch.setattr(logic.scheduling, 'capture_write', lambda handler, **kw: {'sim_time' : kw['sim_time']})
+    monkeypatch.setattr(logic.scheduling, 'write_records', lambda handler, records: handler.pre_trigger_times.extend(r['sim_time'] for r in records))
+    # KE is above threshold for 5.875 <= t < 6; the window stays open until t = 6.875
+    trigger = lambda solver: OutputTrigger(Flow(solver, lambda t: 2 if 5.875 <= t < 6 else 0), 'KE', 1, ['slices'],
+                                           cadence_factor=4, duration=1, pre_trigger_writes=3)
+    slices = Handler('slices', 1)
+    run([slices], stagger=False, n_steps=80, trigger=trigger)
+    assert slices.times == [1, 2, 3, 4, 5, 5.875, 6, 6.25, 6.5, 6.75, 7, 8, 9]
+    # The newest three quarter-cadence captures since the last regular write
+    assert slices.pre_trigger_times == [5.25, 5.5, 5.75]
+
+def test_trigger_derivative():
+    solver = Solver([])
+    trigger = OutputTrigger(Flow(solver, lambda t: t**2), 'KE', 3, ['slices'], derivative=True)
+    assert trigger.name == 'd(KE)/dt'
+    checks = []
+    for t in [0, 1, 2, 3]:
+        solver.sim_time = t
+        checks.append(trigger.check(t))
+    # Finite differences of t**2 are 1, 3, 5
+    assert checks == [False, False, False, True]
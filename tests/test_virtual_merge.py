@@ -0,0 +1,77 @@
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+h5py = pytest.importorskip("h5py")
+
+from logic.virtual_merge import merge_virtual_set, merge_virtual
+
+
+def write_process_file(set_path, rank, global_data, start, count, checksum=True):
+    """ A per-process file holding the [start, start+count) piece of each write of global_data """
+    path = set_path / '{:s}_p{:d}.h5'.format(set_path.name, rank)
+    piece = tuple(slice(s, s+c) for s, c in zip(start, count))
+    with h5py.File(str(path), 'w') as f:
+        f.attrs['set_number'] = 1
+        f.attrs['handler_name'] = set_path.parent.name
+        f.attrs['checksum'] = checksum
+        f['scales/sim_time'] = np.arange(global_data.shape[0], dtype=np.float64)
+        f['scales/write_number'] = np.arange(1, global_data.shape[0]+1)
+        f['scales/x/1.0'] = np.linspace(0, 1, global_data.shape[1])
+        dset = f.create_dataset('tasks/T', data=global_data[(slice(None),) + piece])
+        dset.attrs['global_shape'] = global_data.shape[1:]
+        dset.attrs['start'] = start
+        dset.attrs['count'] = count
+        dset.attrs['grid_space'] = [True, True]
+
+def write_set(base_path, global_data):
+    """ The per-process set base_s1/ of global_data, split in x over two processes and in z over two more """
+    set_path = base_path / '{:s}_s1'.format(base_path.name)
+    set_path.mkdir(parents=True)
+    write_process_file(set_path, 0, global_data, [0, 0], [4, 3])
+    write_process_file(set_path, 1, global_data, [4, 0], [4, 3])
+    write_process_file(set_path, 2, global_data, [0, 3], [8, 2])
+    # A process with no data in this write
+    write_process_file(set_path, 3, global_data, [0, 5], [8, 0])
+    return set_path
+
+
+def test_merge_virtual_set(tmp_path):
+    data = np.random.RandomState(0).standard_normal((3, 8, 5))
+    set_path = write_set(tmp_path / 'checkpoint', data)
+    joint_path = merge_virtual_set(set_path)
+    assert joint_path == tmp_path / 'checkpoint' / 'checkpoint_s1.h5'
+    with h5py.File(str(joint_path), 'r') as f:
+        assert f['tasks/T'].is_virtual
+        assert np.array_equal(f['tasks/T'][()], data)
+        assert f.attrs['checksum']
+        assert f.attrs['writes'] == 3
+        assert list(f['tasks/T'].attrs['global_shape']) == [8, 5]
+        assert np.allclose(f['scales/x/1.0'], np.linspace(0, 1, 8))
+        # Sources are relative to the joined file
+        sources = [vs.file_name for vs in f['tasks/T'].virtual_sources()]
+        assert all(not os.path.isabs(s) for s in sources)
+
+def test_merge_virtual_moved(tmp_path, monkeypatch):
+    data = np.random.RandomState(1).standard_normal((2, 8, 5))
+    write_set(tmp_path / 'run' / 'volumes', data)
+    merge_virtual(tmp_path / 'run' / 'volumes', comm=SingleComm())
+    # The base directory can be moved as a whole, and read from anywhere
+    shutil.move(str(tmp_path / 'run'), str(tmp_path / 'moved'))
+    monkeypatch.chdir(tmp_path)
+    with h5py.File(str(tmp_path / 'moved' / 'volumes' / 'volumes_s1.h5'), 'r') as f:
+        assert np.array_equal(f['tasks/T'][()], data)
+
+def test_merge_virtual_set_empty(tmp_path):
+    (tmp_path / 'slices' / 'slices_s1').mkdir(parents=True)
+    assert merge_virtual_set(tmp_path / 'slices' / 'slices_s1') is None
+
+
+class SingleComm():
+    """ The rank, size and Barrier of a one-process communicator """
+    rank, size = 0, 1
+
+    def Barrier(self):
+        pass